@@ -0,0 +1,401 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import os
+import asyncio
+import logging
+import select
+import socket
+import struct
+
+from ir import tools
+from ir.crypto import Cryptor, preload_crypto_lib
+from ir.gcmanager import GCManager
+from ir.handler import UDPHandler, get_orig_dest_af
+from ir.protocol import PacketMaker, PacketParser
+from ir.server import TCPServer, UDPServer, RECV_ARENA_SIZE
+from ir.stats import Stats
+from ir.timer import TimerWheel
+
+
+__all__ = ['AioTCPServer',
+           'AioUDPServer',
+           'TCPRelay',
+           'install_event_loop_policy']
+
+
+'''An alternative engine based on asyncio
+
+The servers in this module do the same thing as ir.server.TCPServer and
+ir.server.UDPServer, and speak the same protocol, but leave the event loop,
+write buffering and flow control to asyncio.
+
+Set config['engine'] to 'asyncio' to use it. If uvloop is installed,
+it will be used unless config['aio_use_uvloop'] is false.
+'''
+
+
+def install_event_loop_policy(use_uvloop=True):
+    '''use uvloop's event loop policy if it's available
+
+    :rtype: boolean, True if uvloop is used
+    '''
+
+    if not use_uvloop:
+        return False
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+class AioServerMixin(object):
+
+    def __init__(self, config_path, worker_id=0):
+        self._config = self._read_config(config_path)
+        self._worker_id = worker_id
+        self._stats = Stats('%s worker %d' % (self.__class__.__name__,
+                                              worker_id))
+        self._timers = TimerWheel()
+        # events are dispatched by asyncio, this is always empty
+        self._pending_events = {}
+        self._shared_stats = None
+        self._shared_stats_slot = None
+        self._handover_sock = None
+        self._fd_limit = tools.set_nofile_limit(
+                                    self._config.get('max_open_files'))
+        # data is buffered by the transports, it's not counted here
+        self._buffered_bytes = 0
+        # used by AioUDPHandler, asyncio receives data for the others
+        self._recv_arena = tools.RecvArena(RECV_ARENA_SIZE)
+        # only used by AioUDPHandler, see ServerMixin._init_egress
+        self._egress = self._init_egress()
+        # only applied to the listening socket, accepted sockets inherit
+        # the buffers and the congestion control of it
+        self._tunnel_profile, self._dest_profile = self._init_tuning()
+        self._local_sock = self._take_over_socket() or self._init_socket()
+        self._local_sock_fd = self._local_sock.fileno()
+        self._epoll = None
+        self._loop = None
+
+    def _start(self):
+        raise NotImplementedError()
+
+    def _drive_timers(self):
+        self._timers.advance()
+        self._loop.call_later(self._timers._tick, self._drive_timers)
+
+    def run(self):
+        preload_crypto_lib(self._config.get('cipher_name'),
+                           self._config.get('crypto_libpath'))
+        use_uvloop = self._config.get('aio_use_uvloop', True)
+        if install_event_loop_policy(use_uvloop):
+            logging.info('[AIO] Using uvloop')
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._before_run()
+        self._start()
+        self._start_stats_logging()
+        self._listen_handover()
+        GCManager(self._config, self._stats, self._timers).start()
+        self._loop.call_soon(self._drive_timers)
+        try:
+            self._loop.run_forever()
+        except KeyboardInterrupt:
+            self.shutdown()
+        self._after_run()
+
+    def shutdown(self):
+        self._loop.stop()
+
+
+class _RelayProtocol(asyncio.Protocol):
+
+    '''one side of a TCPRelay, passes every callback to the relay
+    '''
+
+    def __init__(self, relay):
+        self._relay = relay
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._relay.on_connection_made(self)
+
+    def data_received(self, data):
+        self._relay.on_data_received(self, data)
+
+    def eof_received(self):
+        self._relay.on_eof_received(self)
+
+    def connection_lost(self, exc):
+        self._relay.on_connection_lost(self, exc)
+
+    def pause_writing(self):
+        self._relay.on_pause_writing(self)
+
+    def resume_writing(self):
+        self._relay.on_resume_writing(self)
+
+
+class _RefusedProtocol(asyncio.Protocol):
+
+    def connection_made(self, transport):
+        sock = transport.get_extra_info('socket')
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                        struct.pack('ii', 1, 0))
+        transport.abort()
+
+
+class TCPRelay(object):
+
+    '''asyncio version of ir.handler.TCPHandler
+
+    Just like TCPHandler, the "local" side is the accepted connection and
+    the "remote" side is the connection we made. When the write buffer of
+    one side is full, we stop reading from the other side.
+    '''
+
+    def __init__(self, server, loop, config, is_local):
+        self._server = server
+        self._loop = loop
+        self._config = config
+        self._is_local = is_local
+        self._local = _RelayProtocol(self)
+        self._remote = _RelayProtocol(self)
+        self._data_2_remote = []
+        self._connect_task = None
+        self._closed = False
+        self._server._stats.incr('connections')
+        self._idle_timer = None
+        self._idle_timeout = self._config.get('tcp_idle_timeout')
+        if self._idle_timeout:
+            self._idle_timer = self._server._timers.call_later(
+                                        self._idle_timeout, self._on_timeout)
+        if self._is_local:
+            self._iv_len = self._config.get('iv_len') or 32
+            self._iv = os.urandom(self._iv_len)
+            self._remote_af = (self._config.get('server_addr'),
+                               self._config.get('server_tcp_port'))
+            self._cryptor = Cryptor(self._config.get('cipher_name'),
+                                    self._config.get('passwd'),
+                                    self._config.get('crypto_libpath'),
+                                    self._iv)
+        else:
+            self._remote_af = None
+            self._cryptor = None
+
+    @property
+    def local_protocol(self):
+        return self._local
+
+    def _connect(self, af):
+        # stop reading until the connection is established,
+        # the data will be stored in self._data_2_remote
+        self._local.transport.pause_reading()
+        coro = self._loop.create_connection(lambda: self._remote, *af)
+        connect_timeout = self._config.get('tcp_connect_timeout') or 10
+        coro = asyncio.wait_for(coro, connect_timeout)
+        self._connect_task = self._loop.create_task(coro)
+        self._connect_task.add_done_callback(self._on_connect_done)
+
+    def _on_connect_done(self, task):
+        if task.cancelled():
+            return
+        if task.exception():
+            logging.warn('[AIO] Cannot connect to %s:%d, do close' %\
+                                                         self._remote_af)
+            self.close()
+
+    def _on_timeout(self):
+        logging.info('[AIO] Connection idle timeout, do close')
+        self.close()
+
+    def _handle_fpacket(self, data):
+        if self._is_local:
+            self._dest_af = get_orig_dest_af(
+                                self._local.transport.get_extra_info('socket'))
+            data = PacketMaker.make_tcp_fpacket(data, self._dest_af,
+                                                self._iv, self._cryptor,
+                                                self._server._iv_cryptor)
+            logging.info('[AIO] Connecting to %s:%d' % self._dest_af)
+        else:
+            res = PacketParser.parse_tcp_fpacket(data,
+                                                 self._server._iv_cryptor,
+                                                 self._config)
+            if not res['valid'] or not res['dest_af']:
+                logging.info('[AIO] Got invalid data from %s:%d' %\
+                                                         self._src)
+                self.close()
+                return
+            data = res['data']
+            self._remote_af = res['dest_af']
+            self._cryptor = res['cryptor']
+            logging.info('[AIO] Connecting to %s:%d' % self._remote_af)
+        if data:
+            self._data_2_remote.append(data)
+        self._connect(self._remote_af)
+
+    def on_connection_made(self, protocol):
+        if protocol is self._local:
+            self._src = protocol.transport.get_extra_info('peername')
+            self._server._stats.incr('accepted')
+            if self._is_local:
+                self._handle_fpacket(b'')
+        else:
+            if self._closed:
+                protocol.transport.close()
+                return
+            if self._data_2_remote:
+                protocol.transport.write(b''.join(self._data_2_remote))
+                self._data_2_remote = []
+            self._local.transport.resume_reading()
+
+    def on_data_received(self, protocol, data):
+        self._server._stats.incr('bytes_received', len(data))
+        if self._idle_timer:
+            self._idle_timer.rearm(self._idle_timeout)
+        if protocol is self._local:
+            if self._is_local:
+                data = self._cryptor.encrypt(data)
+            elif not self._cryptor:
+                self._handle_fpacket(data)
+                return
+            else:
+                data = self._cryptor.decrypt(data)
+            if self._remote.transport:
+                self._remote.transport.write(data)
+            else:
+                self._data_2_remote.append(data)
+        else:
+            if self._is_local:
+                data = self._cryptor.decrypt(data)
+            else:
+                data = self._cryptor.encrypt(data)
+            self._local.transport.write(data)
+
+    def on_eof_received(self, protocol):
+        # the transport will be closed after eof_received returned,
+        # close the other side after its write buffer is flushed
+        self.close()
+
+    def on_connection_lost(self, protocol, exc):
+        self.close()
+
+    def on_pause_writing(self, protocol):
+        peer = self._remote if protocol is self._local else self._local
+        if peer.transport:
+            peer.transport.pause_reading()
+
+    def on_resume_writing(self, protocol):
+        peer = self._remote if protocol is self._local else self._local
+        if peer.transport:
+            peer.transport.resume_reading()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._server._stats.incr('connections', -1)
+        if self._idle_timer:
+            self._idle_timer.cancel()
+        if self._connect_task and not self._connect_task.done():
+            self._connect_task.cancel()
+        for protocol in (self._local, self._remote):
+            if protocol.transport:
+                protocol.transport.close()
+        logging.debug('[AIO] Relay closed')
+
+
+class AioTCPServer(AioServerMixin, TCPServer):
+
+    def _start(self):
+        for key in ('tcp_compress', 'tcp_mux', 'tcp_stripe'):
+            if self._config.get(key):
+                # the peer would get frames it doesn't expect, or vice versa
+                raise Exception('%s is not supported by the asyncio engine' %
+                                key)
+
+        def factory():
+            reason = self._admit()
+            if reason:
+                self._shed(reason)
+                return _RefusedProtocol()
+            relay = TCPRelay(self, self._loop, self._config, self._is_local)
+            return relay.local_protocol
+
+        coro = self._loop.create_server(factory, sock=self._local_sock)
+        self._aio_server = self._loop.run_until_complete(coro)
+
+    def _stop_accepting(self):
+        self._aio_server.close()
+
+
+class _UDPServerProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self._server = server
+
+    def datagram_received(self, data, src):
+        self._server._on_server_datagram(data, src)
+
+    def error_received(self, exc):
+        logging.warn('[AIO] Server socket got error: %s' % exc)
+
+
+class AioUDPHandler(UDPHandler):
+
+    '''UDPHandler that waits for responses in an asyncio loop
+    '''
+
+    def _add_sock_to_poll(self, sock, mode):
+        fd = sock.fileno()
+        self._server._loop.add_reader(fd, self._server.handle_event,
+                                      fd, select.EPOLLIN)
+        self._server._add_handler(self, fd=fd)
+        if self._server._multi_transmit and not self._is_local:
+            self._server._add_handler(self, src_port=self._src[1])
+
+    def _remove_sock_from_poll(self, sock):
+        self._server._loop.remove_reader(sock.fileno())
+
+
+class AioUDPServer(AioServerMixin, UDPServer):
+
+    '''asyncio version of ir.server.UDPServer
+
+    On the remote side, the server socket is driven by a DatagramProtocol
+    and the responses are sent through its transport. On the local side,
+    we need the original destination from the ancillary data, which is
+    not provided by asyncio's datagram transports, so we just watch the
+    server socket and reuse UDPServer.handle_event.
+    '''
+
+    def _start(self):
+        self._server_transport = None
+        if self._is_local:
+            self._loop.add_reader(self._local_sock_fd, self.handle_event,
+                                  self._local_sock_fd, select.EPOLLIN)
+        else:
+            coro = self._loop.create_datagram_endpoint(
+                                        lambda: _UDPServerProtocol(self),
+                                        sock=self._local_sock)
+            self._server_transport, _ = self._loop.run_until_complete(coro)
+
+    def _stop_accepting(self):
+        if self._server_transport:
+            # the transport is still used to send responses
+            self._server_transport.pause_reading()
+        else:
+            self._loop.remove_reader(self._local_sock_fd)
+
+    def _new_handler(self, src, dest, key=None):
+        server_sock = self._server_transport or self._local_sock
+        return AioUDPHandler(src, dest, self, server_sock, None,
+                             self._config, self._is_local, key)
+
+    def _on_server_datagram(self, data, src):
+        data, src, dest = self._parse_remote_packet(data, src)
+        self._dispatch_local_packet(data, src, dest)
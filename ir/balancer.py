@@ -0,0 +1,145 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import time
+import logging
+
+
+__all__ = ['Remote', 'RemoteBalancer']
+
+
+'''Choose one of several remotes for a new TCP connection
+
+Every remote keeps an EWMA of the time its connections took to be
+established and of the throughput they got. A remote costs
+
+    connect time * (active connections + 1) * best throughput / its throughput
+
+and the cheapest ones are picked, so new connections move away from a
+remote that slows down or gets crowded. A remote that has not been measured
+for a while is picked once more, to find out whether it has recovered.
+'''
+
+
+EWMA_ALPHA = 0.3
+
+# seconds before an unmeasured remote is probed again
+RECHECK_INTERVAL = 30
+
+# connections that moved less data tell nothing about the throughput
+THROUGHPUT_MIN_BYTES = 65536
+
+
+def _ewma(old, sample, alpha=EWMA_ALPHA):
+    if old is None:
+        return sample
+    return old + alpha * (sample - old)
+
+
+class Remote(object):
+
+    '''a remote server and what we have learned about it
+    '''
+
+    def __init__(self, af):
+        self.af = af
+        self.active = 0
+        # seconds
+        self.connect_time = None
+        # bytes per second
+        self.throughput = None
+        self.sampled_at = 0
+
+    def on_connect(self, elapsed):
+        self.connect_time = _ewma(self.connect_time, elapsed)
+        self.sampled_at = time.time()
+
+    def on_transfer(self, nbytes, duration):
+        if nbytes < THROUGHPUT_MIN_BYTES or duration <= 0:
+            return
+        self.throughput = _ewma(self.throughput, nbytes / duration)
+        self.sampled_at = time.time()
+
+
+class RemoteBalancer(object):
+
+    def __init__(self, afs, stats, connect_timeout=10):
+        self._remotes = [Remote(af) for af in afs]
+        self._stats = stats
+        # a failed connect counts as slow as a timeout
+        self._failure_penalty = connect_timeout
+
+    @property
+    def remotes(self):
+        return self._remotes
+
+    def _cost(self, remote, best_throughput, now):
+        if (remote.connect_time is None or
+                now - remote.sampled_at >= RECHECK_INTERVAL):
+            return 0
+        cost = remote.connect_time * (remote.active + 1)
+        if remote.throughput and best_throughput:
+            cost *= best_throughput / remote.throughput
+        return cost
+
+    def pick(self, n=1, exclude=None):
+        '''
+        :param exclude: a Remote that must not be picked
+        :rtype: list of at most n Remote, the cheapest first
+        '''
+
+        now = time.time()
+        candidates = [r for r in self._remotes if r is not exclude]
+        best_throughput = max([r.throughput or 0 for r in candidates] or [0])
+        ranked = sorted(candidates,
+                        key=lambda r: (self._cost(r, best_throughput, now),
+                                       r.active))
+        picked = ranked[:n]
+        for remote in picked:
+            if now - remote.sampled_at >= RECHECK_INTERVAL:
+                # one probe is enough, don't send everything to it
+                # before the result comes back
+                remote.sampled_at = now
+                self._stats.incr('remote_probes')
+        return picked
+
+    def acquire(self, remote):
+        remote.active += 1
+
+    def release(self, remote):
+        remote.active -= 1
+
+    def connected(self, remote, elapsed):
+        remote.on_connect(elapsed)
+
+    def lost_race(self, remote, elapsed):
+        # The connection was still in progress, it takes at least elapsed.
+        # A lower bound must not make the remote look faster, or a remote
+        # that always loses would stay in the race with the winner's time.
+        if remote.connect_time is None or elapsed > remote.connect_time:
+            remote.on_connect(elapsed)
+        self._stats.incr('remote_race_lost')
+
+    def connect_failed(self, remote):
+        remote.on_connect(self._failure_penalty)
+        self._stats.incr('remote_connect_failed')
+
+    def transferred(self, remote, nbytes, duration):
+        remote.on_transfer(nbytes, duration)
+
+    def collect_stats(self):
+        '''set gauges for each remote, in the order of the config
+        '''
+
+        for i, remote in enumerate(self._remotes):
+            self._stats.set('remote%d_active' % i, remote.active)
+            if remote.connect_time is not None:
+                self._stats.set('remote%d_connect_ms' % i,
+                                int(remote.connect_time * 1000))
+            if remote.throughput is not None:
+                self._stats.set('remote%d_kbps' % i,
+                                int(remote.throughput / 1024))
+
+    def log_remotes(self):
+        for i, remote in enumerate(self._remotes):
+            logging.info('[TCP] Remote %d: %s:%d' % (i, *remote.af))
@@ -0,0 +1,194 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import math
+import time
+import zlib
+import struct
+from collections import Counter
+
+
+__all__ = ['Compressor', 'Decompressor']
+
+
+'''Compress the relayed data between the local side and the remote
+
+The data of a connection is cut into frames before it's encrypted:
+
+    +----------------------+---------+
+    | flag (1 bit) | size  | payload |
+    +----------------------+---------+
+    |   4 bytes, network order       |
+    +----------------------+---------+
+
+A frame with the flag set carries deflate data, the frames of a connection
+in one direction form one zlib stream, each of them ends with a sync flush,
+so it can be decompressed as soon as it's received. The others carry the
+data as it is.
+
+The first chunks of a stream are probed, if they look random (TLS, media,
+archives), the stream is sent as it is, and it's probed again after a
+while. The compression also stops when the output is not much smaller than
+the input.
+'''
+
+
+FRAME_HEADER = struct.Struct('!I')
+FLAG_DEFLATE = 0x80000000
+
+# a frame is a chunk received from a socket, far below this
+MAX_FRAME_SIZE = 4194304
+
+DEFAULT_LEVEL = 6
+
+# chunks shorter than this tell nothing about the entropy
+ENTROPY_MIN_SAMPLE = 256
+ENTROPY_SAMPLE = 4096
+# bits per byte, random data is close to 8
+ENTROPY_MAX = 7.5
+
+# bytes checked after compression is turned on, before it's trusted
+PROBE_BYTES = 65536
+
+# the compression is turned off if it saves less than this
+MAX_RATIO = 0.9
+
+# bytes sent as they are before the stream is probed again
+REPROBE_BYTES = 1048576
+
+
+def entropy(data):
+    '''estimate the Shannon entropy of the beginning of data
+
+    :rtype: float, bits per byte
+    '''
+
+    sample = data[:ENTROPY_SAMPLE]
+    n = len(sample)
+    return -sum(c / n * math.log2(c / n) for c in Counter(sample).values())
+
+
+class Compressor(object):
+
+    '''frame and compress the data of one direction of a connection
+    '''
+
+    def __init__(self, level=None):
+        self._zobj = zlib.compressobj(level or DEFAULT_LEVEL)
+        self._enabled = True
+        # bytes in and out since compression is turned on, for the ratio
+        self._window_in = 0
+        self._window_out = 0
+        # when compression is off, the stream is probed again at this
+        # number of bytes in
+        self._probe_at = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # seconds of CPU time spent on compressing
+        self.cpu_time = 0
+        # times the compression is turned off
+        self.disabled = 0
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def _disable(self):
+        self._enabled = False
+        self._probe_at = self.bytes_in + REPROBE_BYTES
+        self.disabled += 1
+
+    def _probe(self, data):
+        '''
+        :rtype: bool, whether data looks compressible
+        '''
+
+        if len(data) < ENTROPY_MIN_SAMPLE:
+            return True
+        started = time.process_time()
+        compressible = entropy(data) <= ENTROPY_MAX
+        self.cpu_time += time.process_time() - started
+        return compressible
+
+    def compress(self, data):
+        '''
+        :rtype: bytes, frames of data, empty if data is empty
+        '''
+
+        if not data:
+            return b''
+        if not self._enabled and self.bytes_in >= self._probe_at:
+            if self._probe(data):
+                self._enabled = True
+                self._window_in = self._window_out = 0
+            else:
+                self._probe_at = self.bytes_in + REPROBE_BYTES
+        elif (self._enabled and self._window_in < PROBE_BYTES and
+                not self._probe(data)):
+            self._disable()
+        self.bytes_in += len(data)
+        if not self._enabled:
+            self.bytes_out += FRAME_HEADER.size + len(data)
+            return FRAME_HEADER.pack(len(data)) + data
+
+        started = time.process_time()
+        payload = (self._zobj.compress(data) +
+                   self._zobj.flush(zlib.Z_SYNC_FLUSH))
+        self.cpu_time += time.process_time() - started
+        self.bytes_out += FRAME_HEADER.size + len(payload)
+        self._window_in += len(data)
+        self._window_out += len(payload)
+        if (self._window_in >= PROBE_BYTES and
+                self._window_out > self._window_in * MAX_RATIO):
+            self._disable()
+        elif self._window_in >= PROBE_BYTES * 16:
+            # judge by the recent data only
+            self._window_in //= 2
+            self._window_out //= 2
+        return FRAME_HEADER.pack(FLAG_DEFLATE | len(payload)) + payload
+
+
+class Decompressor(object):
+
+    '''take the frames made by Compressor apart, and decompress them
+    '''
+
+    def __init__(self):
+        self._zobj = zlib.decompressobj()
+        self._buf = bytearray()
+        # seconds of CPU time spent on decompressing
+        self.cpu_time = 0
+
+    def decompress(self, data):
+        '''
+        :rtype: bytes, the data of the complete frames received so far
+        :raises ValueError: if the frames are broken
+        '''
+
+        self._buf += data
+        chunks = []
+        offset = 0
+        while len(self._buf) - offset >= FRAME_HEADER.size:
+            header, = FRAME_HEADER.unpack_from(self._buf, offset)
+            size = header & ~FLAG_DEFLATE
+            if size > MAX_FRAME_SIZE:
+                raise ValueError('frame of %d bytes is too large' % size)
+            end = offset + FRAME_HEADER.size + size
+            if len(self._buf) < end:
+                break
+            payload = bytes(self._buf[offset + FRAME_HEADER.size:end])
+            offset = end
+            if not header & FLAG_DEFLATE:
+                chunks.append(payload)
+                continue
+            started = time.process_time()
+            try:
+                chunk = self._zobj.decompress(payload, MAX_FRAME_SIZE)
+            except zlib.error as e:
+                raise ValueError(str(e))
+            self.cpu_time += time.process_time() - started
+            if self._zobj.unconsumed_tail:
+                raise ValueError('frame is inflated too large')
+            chunks.append(chunk)
+        del self._buf[:offset]
+        return b''.join(chunks)
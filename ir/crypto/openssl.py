@@ -2,13 +2,17 @@
 # coding: utf-8
 
 import logging
-from ctypes import (byref, CDLL, c_void_p, c_int, c_long,
-                    c_char_p, create_string_buffer)
+from ctypes import (byref, CDLL, c_void_p, c_int, c_long, c_char,
+                    c_char_p, create_string_buffer, string_at)
 
 
 libcrypto = None
 lib_loaded = False
 
+# output buffer shared by all the cryptors,
+# they are only used in the thread of the event loop
+out_buf = None
+
 
 def load_libcrypto(libpath='libcrypto.so.1.1'):
     global lib_loaded, libcrypto
@@ -74,14 +78,25 @@ class OpenSSLCryptor(object):
         self._mod = mod
 
     def update(self, data):
-        in_ = c_char_p(data)
+        '''
+        :param data: bytes or memoryview, a writable memoryview (such as
+                     one of ir.tools.RecvArena) is passed without copying
+        :rtype: bytes
+        '''
+
+        global out_buf
         inl = len(data)
+        if isinstance(data, memoryview) and not data.readonly:
+            in_ = (c_char * inl).from_buffer(data)
+        else:
+            in_ = bytes(data)
         buf_size = self.buf_size if self.buf_size >= inl else inl * 2
-        out = create_string_buffer(buf_size)
+        if out_buf is None or len(out_buf) < buf_size:
+            out_buf = create_string_buffer(buf_size)
         outl = c_long(0)
-        libcrypto.EVP_CipherUpdate(self._cph_ctx, byref(out),
+        libcrypto.EVP_CipherUpdate(self._cph_ctx, byref(out_buf),
                                    byref(outl), in_, inl)
-        return out.raw[:outl.value]
+        return string_at(out_buf, outl.value)
 
     def clean(self):
         if hasattr(self, '_cph_ctx'):
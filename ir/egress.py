@@ -0,0 +1,154 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import time
+import errno
+import socket
+import logging
+
+from ir import tools
+
+
+__all__ = ['EgressPool']
+
+
+'''Spread the outbound sockets of the remote over several source addresses
+
+With one source address, the connections to one destination share one
+range of ephemeral ports, heavy fan-out to the same CDN endpoints runs out
+of them. Every outbound socket is bound to one address of egress_addrs
+instead of 0.0.0.0.
+
+TCP sockets are bound with IP_BIND_ADDRESS_NO_PORT, the kernel chooses the
+port at connect() time by the whole 4-tuple, so a port of an address can
+be used by connections to different destinations at the same time. An
+address out of ports then fails connect() with EADDRNOTAVAIL instead of
+bind(), connect() of the pool tries the next address with a new socket.
+'''
+
+
+IP_BIND_ADDRESS_NO_PORT = 24
+
+POLICY_ROUND_ROBIN = 'round_robin'
+POLICY_LEAST_CONN = 'least_conn'
+
+# seconds an address that cannot be bound is tried after the others
+BIND_RETRY_INTERVAL = 60
+
+
+class EgressPool(object):
+
+    def __init__(self, addrs, policy=None, stats=None):
+        policy = policy or POLICY_ROUND_ROBIN
+        if policy not in (POLICY_ROUND_ROBIN, POLICY_LEAST_CONN):
+            raise Exception('Invalid egress_policy: %s' % policy)
+        self._addrs = list(addrs)
+        self._policy = policy
+        self._stats = stats
+        # sockets bound to each address, so ports in use, {addr: number}
+        self._in_use = dict.fromkeys(self._addrs, 0)
+        # addresses that could not be bound, {addr: time of the failure}
+        self._failed_at = {}
+        self._next = 0
+
+    def _mark_failed(self, addr, e):
+        logging.warn('[EGRESS] Cannot use %s: %s' % (addr, e))
+        if self._stats:
+            self._stats.incr('egress_bind_failed')
+        self._failed_at[addr] = time.time()
+
+    def _candidates(self):
+        if self._policy == POLICY_LEAST_CONN:
+            addrs = sorted(self._addrs, key=lambda a: self._in_use[a])
+        else:
+            i = self._next
+            self._next = (self._next + 1) % len(self._addrs)
+            addrs = self._addrs[i:] + self._addrs[:i]
+        if self._failed_at:
+            now = time.time()
+            failed = [a for a in addrs if now - self._failed_at.get(a, 0) <
+                                                        BIND_RETRY_INTERVAL]
+            addrs = [a for a in addrs if a not in failed] + failed
+        return addrs
+
+    def bind(self, sock, exclude=()):
+        '''bind sock to a source address of the pool, the others are tried
+        if the address is out of ports
+
+        :param exclude: addresses not to be tried
+        :rtype: str, the address, pass it to release() when sock is closed
+        '''
+
+        if sock.type == socket.SOCK_STREAM:
+            sock.setsockopt(socket.SOL_IP, IP_BIND_ADDRESS_NO_PORT, 1)
+        error = None
+        for addr in self._candidates():
+            if addr in exclude:
+                continue
+            try:
+                sock.bind((addr, 0))
+            except (OSError, IOError) as e:
+                if tools.errno_from_exception(e) not in (errno.EADDRINUSE,
+                                                         errno.EADDRNOTAVAIL):
+                    raise
+                self._mark_failed(addr, e)
+                error = e
+                continue
+            self._failed_at.pop(addr, None)
+            self._in_use[addr] += 1
+            return addr
+        raise error or OSError(errno.EADDRNOTAVAIL,
+                               'No egress address is left to try')
+
+    def connect(self, new_sock, address):
+        '''connect a socket made by new_sock() to address, from a source
+        address of the pool. If the source address is out of ports, the
+        socket is closed and the next address is tried with a new one
+
+        :rtype: tuple, (socket, address of the pool), the connection may be
+                in progress
+        :raises OSError: the error of the last try, its socket is closed
+        '''
+
+        tried = []
+        while True:
+            sock = new_sock()
+            try:
+                addr = self.bind(sock, tried)
+            except (OSError, IOError):
+                sock.close()
+                raise
+            try:
+                sock.connect(address)
+            except (OSError, IOError) as e:
+                err = tools.errno_from_exception(e)
+                if err == errno.EINPROGRESS:
+                    return sock, addr
+                self.release(addr)
+                sock.close()
+                if err != errno.EADDRNOTAVAIL:
+                    raise
+                self._mark_failed(addr, e)
+                tried.append(addr)
+                if len(tried) == len(self._addrs):
+                    raise
+                continue
+            return sock, addr
+
+    def connect_failed(self, addr, e):
+        '''mark addr failed after connect() found it out of ports, for
+        the connections made elsewhere, e.g. by io_uring
+        '''
+
+        self._mark_failed(addr, e)
+
+    def release(self, addr):
+        self._in_use[addr] -= 1
+
+    def collect_stats(self):
+        '''set gauges of ports in use for each address, in the order of
+        the config
+        '''
+
+        for i, addr in enumerate(self._addrs):
+            self._stats.set('egress%d_ports' % i, self._in_use[addr])
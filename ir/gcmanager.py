@@ -0,0 +1,95 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import gc
+import time
+import logging
+
+
+__all__ = ['GCManager']
+
+
+'''Keep the cyclic garbage collector away from busy moments
+
+Every collection is timed and recorded in the stats of the server, as
+"gc_pause_ms_genN" histograms and "gc_collections_genN" counters.
+
+If config['gc_tuning'] is true, we also:
+    1. move the objects created during startup to the permanent generation
+       with gc.freeze (python3.7+), the collector won't scan them again
+    2. raise the thresholds, so collections happen less often
+    3. run full collections while the server is idle, the high threshold
+       of generation 2 leaves them to us in most of the time
+'''
+
+
+# thresholds used in gc tuning mode, see gc.set_threshold
+GC_THRESHOLDS = (10000, 50, 1000)
+
+# min interval between two full collections run while idle
+GC_IDLE_INTERVAL = 60
+
+# the server is idle if nothing is received during this interval
+IDLE_CHECK_INTERVAL = 0.5
+
+# bounds of the gc pause histograms, in milliseconds
+GC_PAUSE_BOUNDS = (1, 5, 20, 100)
+
+
+class GCManager(object):
+
+    def __init__(self, config, stats, timers):
+        self._config = config
+        self._stats = stats
+        self._timers = timers
+        self._started_at = None
+        self._last_full_collect = time.time()
+        self._last_activity = None
+
+    def _on_gc(self, phase, info):
+        if phase == 'start':
+            self._started_at = time.perf_counter()
+        elif self._started_at is not None:
+            pause = (time.perf_counter() - self._started_at) * 1000
+            self._started_at = None
+            gen = info['generation']
+            self._stats.incr('gc_collections_gen%d' % gen)
+            self._stats.incr('gc_collected', info['collected'])
+            self._stats.observe('gc_pause_ms_gen%d' % gen, int(pause),
+                                GC_PAUSE_BOUNDS)
+
+    def _activity(self):
+        return (self._stats.get('bytes_received') +
+                self._stats.get('packets_received') +
+                self._stats.get('accepted'))
+
+    def _check_idle(self):
+        activity = self._activity()
+        now = time.time()
+        if (activity == self._last_activity and
+                now - self._last_full_collect >= self._idle_interval):
+            gc.collect()
+            self._last_full_collect = now
+            self._stats.incr('gc_idle_collections')
+        self._last_activity = activity
+        self._timers.call_later(IDLE_CHECK_INTERVAL, self._check_idle)
+
+    def start(self):
+        '''call it after the server is initialized, before the event loop
+        '''
+
+        gc.callbacks.append(self._on_gc)
+        if not self._config.get('gc_tuning'):
+            return
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        thresholds = self._config.get('gc_thresholds') or GC_THRESHOLDS
+        gc.set_threshold(*thresholds)
+        self._idle_interval = self._config.get('gc_idle_interval')
+        if self._idle_interval is None:
+            self._idle_interval = GC_IDLE_INTERVAL
+        if self._idle_interval:
+            self._last_activity = self._activity()
+            self._timers.call_later(IDLE_CHECK_INTERVAL, self._check_idle)
+        logging.info('[GC] Tuning on, thresholds: %s' % str(thresholds))
@@ -9,25 +9,90 @@ import select
 import socket
 import struct
 import time
+from collections import deque
 
 from ir import tools
 from ir.crypto import Cryptor
-from ir.protocol import PacketMaker, PacketParser
+from ir.compress import Compressor, Decompressor
+from ir.protocol import (PacketMaker, PacketParser, MUX_DEST_AF,
+                         STRIPE_DEST_AF)
 
 
 __all__ = ['TCPHandler',
            'UDPHandler',
            'UDPMultiTransmitHandler',
-           'CacheQueue']
+           'CacheQueue',
+           'SendQueue',
+           'get_orig_dest_af']
 
 
 SO_ADDR_SIZE = 16
 SO_ORIGINAL_DST = 80
-
+MSG_FASTOPEN = 0x20000000
+
+# see Documentation/networking/msg_zerocopy.rst of the kernel
+SO_ZEROCOPY = 60
+MSG_ZEROCOPY = 0x4000000
+IP_RECVERR = 11
+IPV6_RECVERR = 25
+SO_EE_ORIGIN_ZEROCOPY = 5
+SO_EE_CODE_ZEROCOPY_COPIED = 1
+# struct sock_extended_err
+SOCK_EXTENDED_ERR = struct.Struct('IBBBBII')
+
+# initial read sizes of tcp sockets, see TCPHandler._adapt_recv_size
 UP_STREAM_BUF_SIZE = 16384
 DOWN_STREAM_BUF_SIZE = 32768
 UDP_BUFFER_SIZE = 65536
 
+# bounds of the read size of a tcp socket
+RECV_SIZE_MIN = 4096
+RECV_SIZE_MAX = 262144
+
+# max bytes read from a socket in one turn
+SCHED_SLICE_BYTES = 65536
+
+# Watermarks of the data stored for one direction of a connection. We stop
+# reading from the producing socket above the high one, and resume reading
+# below the low one.
+BUFFER_HIGH_WATERMARK = 262144
+BUFFER_LOW_WATERMARK = 65536
+
+# max buffers passed to one sendmsg call, far below IOV_MAX (1024)
+SEND_IOV_MAX = 64
+
+# Sends of at least this many bytes use MSG_ZEROCOPY in tcp_zerocopy mode,
+# smaller ones cost more to pin and notify than to copy.
+ZEROCOPY_THRESHOLD = 32768
+
+# seconds the buffers of unfinished zerocopy sends are kept after the
+# socket is closed, the kernel may still be sending them
+ZEROCOPY_LINGER = 60
+
+# percent of the compressed size to the original, per connection
+COMPRESS_RATIO_BOUNDS = (25, 50, 75, 90, 100)
+
+# In tcp_fast_open mode, the local side waits this long for the first data
+# of the client before sending the first packet without it.
+FAST_OPEN_WAIT = 0.05
+
+EPOLL_RO = select.EPOLLIN | select.EPOLLRDHUP | select.EPOLLERR
+EPOLL_RW = EPOLL_RO | select.EPOLLOUT
+# In edge-triggered mode, sockets are registered once with this mask and
+# never modified, handlers drain reads and writes until EAGAIN.
+EPOLL_ET = EPOLL_RW | select.EPOLLET
+
+
+def get_orig_dest_af(sock):
+    '''get the original destination of a redirected tcp connection
+    '''
+
+    opt = sock.getsockopt(socket.SOL_IP, SO_ORIGINAL_DST, SO_ADDR_SIZE)
+    dest_info = tools.unpack_sockopt(opt)[1:]
+    port = dest_info[0]
+    ip = '.'.join([str(u) for u in dest_info[1:]])
+    return (ip, port)
+
 
 class TCPHandler():
 
@@ -40,11 +105,59 @@ class TCPHandler():
         self._epoll = epoll
         self._config = config
         self._is_local = is_local
-        self._data_2_local_sock = []
-        self._data_2_remote_sock = []
+        self._data_2_local_sock = SendQueue()
+        self._data_2_remote_sock = SendQueue()
+        self._buffer_high = (self._config.get('tcp_buffer_high') or
+                             BUFFER_HIGH_WATERMARK)
+        self._buffer_low = (self._config.get('tcp_buffer_low') or
+                            BUFFER_LOW_WATERMARK)
+        # fds we stopped reading from
+        self._read_paused = set()
         self._remote_sock = None
         self._fpacket_handled = False
         self._destroyed = False
+        self._server._stats.incr('connections')
+        self._edge_triggered = bool(self._config.get('tcp_edge_triggered'))
+        self._slice_bytes = self._config.get('sched_slice_bytes',
+                                             SCHED_SLICE_BYTES)
+        if self._is_local:
+            self._local_recv_size = UP_STREAM_BUF_SIZE
+        else:
+            self._local_recv_size = DOWN_STREAM_BUF_SIZE
+        self._remote_recv_size = self._local_recv_size
+        # bytes received while handling current event
+        self._event_bytes = 0
+        # cached interest mask of sockets, {fd: events}
+        self._poll_events = {}
+        self._remote_connected = False
+        self._connect_timer = None
+        # source address of the remote socket, from the server's egress pool
+        self._egress_addr = None
+        # ir.balancer.Remote we connected to, when tcp_multi_remote is on
+        self._remote = None
+        # (socket, Remote) connecting in parallel with self._remote_sock
+        self._racer = None
+        self._connect_started = 0
+        self._connected_at = 0
+        self._remote_failed = False
+        self._failed_over = False
+        self._remote_bytes = 0
+        self._remote_last_read_at = 0
+        self._fpacket_timer = None
+        # only used on the local to remote hop
+        self._fast_open = bool(self._is_local and
+                               self._config.get('tcp_fast_open') and
+                               not self._server._fast_open_disabled)
+        self._race = bool(self._server._remotes and
+                          self._config.get('tcp_race_connect'))
+        if self._race:
+            # the first packet must not be sent to both remotes
+            self._fast_open = False
+        self._idle_timer = None
+        self._idle_timeout = self._config.get('tcp_idle_timeout')
+        if self._idle_timeout:
+            self._idle_timer = self._server._timers.call_later(
+                                    self._idle_timeout, self._on_idle_timeout)
         if self._is_local:
             self._iv_len = self._config.get('iv_len') or 32
             self._iv = os.urandom(self._iv_len)
@@ -61,42 +174,137 @@ class TCPHandler():
             self._remote_port = None
             self._remote_af = None
             self._cryptor = None
-        events = select.EPOLLIN | select.EPOLLRDHUP | select.EPOLLERR
-        self._add_sock_to_poll(self._local_sock, events)
+        # ir.compress of the data between the local side and the remote,
+        # in tcp_compress mode
+        self._compressor = None
+        self._decompressor = None
+        if self._config.get('tcp_compress'):
+            self._compressor = Compressor(
+                                    self._config.get('tcp_compress_level'))
+            self._decompressor = Decompressor()
+        if (not self._is_local and self._config.get('tcp_zerocopy') and
+                not self._server._zerocopy_disabled):
+            self._enable_zerocopy()
+        self._add_sock_to_poll(self._local_sock, EPOLL_RO)
         if self._is_local:
-            self._handle_fpacket()
-            self._fpacket_handled = True
-        self._local_sock_poll_mode = 'ro'
-        self._remote_sock_poll_mode = 'ro'
+            if self._fast_open:
+                # the first data of the client will be sent with the first
+                # packet, and the first packet will be sent with the SYN
+                wait = self._config.get('tcp_fast_open_wait')
+                if wait is None:
+                    wait = FAST_OPEN_WAIT
+                self._fpacket_timer = self._server._timers.call_later(
+                                            wait, self._on_fpacket_timeout)
+            else:
+                self._handle_fpacket()
+                self._fpacket_handled = True
 
     def _fd_2_sock(self, fd):
         if fd == self._local_sock.fileno():
             return self._local_sock
         if self._remote_sock and self._remote_sock.fileno() == fd:
             return self._remote_sock
+        if self._racer and self._racer[0].fileno() == fd:
+            return self._racer[0]
         return None
 
     def _add_sock_to_poll(self, sock, mode):
+        if self._edge_triggered:
+            mode = EPOLL_ET
         self._epoll.register(sock.fileno(), mode)
+        self._poll_events[sock.fileno()] = mode
         self._server._add_handler(sock.fileno(), self)
 
     def _local_get_dest_af(self):
-        opt = self._local_sock.getsockopt(socket.SOL_IP,
-                                          SO_ORIGINAL_DST,
-                                          SO_ADDR_SIZE)
-        dest_info = tools.unpack_sockopt(opt)[1:]
-        port = dest_info[0]
-        ip = '.'.join([str(u) for u in dest_info[1:]])
-        return (ip, port)
+        return get_orig_dest_af(self._local_sock)
+
+    def _enable_zerocopy(self):
+        # the data to the local is encrypted into new buffers, which are
+        # never changed, so they can be sent without copying
+        threshold = (self._config.get('tcp_zerocopy_threshold') or
+                     ZEROCOPY_THRESHOLD)
+        if not self._data_2_local_sock.enable_zerocopy(self._local_sock,
+                                                       threshold):
+            logging.warn('[TCP] MSG_ZEROCOPY is not supported by the kernel')
+            self._server._zerocopy_disabled = True
+
+    def _reap_zerocopy(self):
+        '''EPOLLERR also tells that zerocopy sends are finished, drop their
+        buffers and check if there is a real error
+
+        :rtype: boolean, True if the socket has no error
+        '''
 
-    def _create_remote_sock(self, remote_af):
+        try:
+            finished, copied = self._data_2_local_sock.reap_zerocopy(
+                                                            self._local_sock)
+        except (OSError, IOError):
+            return False
+        self._server._stats.incr('zerocopy_finished', finished)
+        if copied:
+            self._server._stats.incr('zerocopy_copied')
+        return not self._local_sock.getsockopt(socket.SOL_SOCKET,
+                                               socket.SO_ERROR)
+
+    def _connect_fast_open(self, remote_sock, remote_af):
+        # send the stored data with the SYN, the kernel falls back to a
+        # normal handshake if the server has not given us a cookie yet
+        try:
+            sent, _ = self._data_2_remote_sock.send(remote_sock, MSG_FASTOPEN,
+                                                    remote_af)
+        except (OSError, IOError) as e:
+            if tools.errno_from_exception(e) != errno.EOPNOTSUPP:
+                raise
+            logging.warn('[TCP] TCP fast open is disabled by the kernel, '
+                         'see net.ipv4.tcp_fastopen')
+            self._server._fast_open_disabled = True
+            self._fast_open = False
+            remote_sock.connect(remote_af)
+            return
+        self._server._stats.incr('tcp_fast_open')
+        self._server._stats.incr('bytes_sent', sent)
+        self._server._release_buffer(sent)
+
+    def _new_remote_sock(self):
         remote_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         remote_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         remote_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        profile = self._server._connected_profile
+        if profile:
+            profile.apply(remote_sock)
         remote_sock.setblocking(False)
-        remote_sock.bind(('0.0.0.0', 0))
+        return remote_sock
+
+    def _create_remote_sock(self, remote_af):
+        if self._server._conn_pool:
+            remote_sock = self._server._conn_pool.take()
+            if remote_sock:
+                return remote_sock
+        if self._server._egress and not self._is_local:
+            # the next source address is tried if one is out of ports
+            try:
+                remote_sock, self._egress_addr = self._server._egress.connect(
+                                            self._new_remote_sock, remote_af)
+            except (OSError, IOError) as e:
+                logging.warn('[TCP] Cannot connect to %s:%d: %s' % (
+                                                        remote_af + (e,)))
+                return None
+            return remote_sock
+        remote_sock = self._new_remote_sock()
         try:
-            remote_sock.connect(remote_af)
+            remote_sock.bind(('0.0.0.0', 0))
+        except (OSError, IOError) as e:
+            logging.warn('[TCP] Cannot bind the remote socket: %s' % e)
+            remote_sock.close()
+            return None
+        if self._server._fast_open_disabled:
+            # found by another handler after this one started waiting
+            self._fast_open = False
+        try:
+            if self._fast_open and self._data_2_remote_sock:
+                self._connect_fast_open(remote_sock, remote_af)
+            else:
+                remote_sock.connect(remote_af)
         except (OSError, IOError) as e:
             if tools.errno_from_exception(e) == errno.EINPROGRESS:
                 pass
@@ -104,53 +312,313 @@ class TCPHandler():
                 return None
         return remote_sock
 
+    def _connect_remotes(self):
+        '''connect to the cheapest of tcp_multi_remote, and to the second
+        cheapest in parallel if tcp_race_connect is on
+
+        :rtype: socket, None if no remote can be connected
+        '''
+
+        balancer = self._server._remotes
+        self._connect_started = time.time()
+        remote_sock = None
+        for remote in balancer.pick(2 if self._race else 1):
+            sock = self._create_remote_sock(remote.af)
+            if not sock:
+                balancer.connect_failed(remote)
+                continue
+            balancer.acquire(remote)
+            if not remote_sock:
+                remote_sock = sock
+                self._remote = remote
+                self._remote_af = remote.af
+            else:
+                self._racer = (sock, remote)
+                self._add_sock_to_poll(sock, EPOLL_RW)
+                self._server._stats.incr('remote_races')
+        return remote_sock
+
+    def _failover(self):
+        '''connect to another remote once, when the connection to
+        self._remote failed before it was established
+
+        :rtype: boolean, True if another connection is in progress
+        '''
+
+        # data sent with the SYN is gone with the failed connection
+        if (not self._remote or self._remote_connected or
+                self._failed_over or self._fast_open):
+            return False
+        self._failed_over = True
+        balancer = self._server._remotes
+        failed = self._remote
+        balancer.connect_failed(failed)
+        balancer.release(failed)
+        self._remote = None
+        self._close_remote_sock(self._remote_sock)
+        self._remote_sock = None
+        for remote in balancer.pick(exclude=failed):
+            sock = self._create_remote_sock(remote.af)
+            if not sock:
+                balancer.connect_failed(remote)
+                continue
+            balancer.acquire(remote)
+            self._remote_sock = sock
+            self._remote = remote
+            self._remote_af = remote.af
+            self._add_sock_to_poll(sock, EPOLL_RW)
+            self._server._stats.incr('remote_failovers')
+            logging.info('[TCP] Cannot connect to %s:%d, trying %s:%d' % (
+                                                    *failed.af, *remote.af))
+            return True
+        return False
+
+    def _close_remote_sock(self, sock):
+        fd = sock.fileno()
+        self._server._remove_handler(fd)
+        self._epoll.unregister(fd)
+        self._poll_events.pop(fd, None)
+        self._read_paused.discard(fd)
+        sock.close()
+
+    def _settle_race(self, sock, evt):
+        '''keep the first of the racing connections that is established,
+        or the one that has not failed
+
+        :rtype: socket, the remote socket to handle evt with, None if
+                there is nothing more to do
+        '''
+
+        racer_sock, racer = self._racer
+        failed = evt & (select.EPOLLERR | select.EPOLLHUP | select.EPOLLRDHUP)
+        if sock is racer_sock:
+            # the racer failed or won
+            use_racer = not failed
+        else:
+            # the first one failed or won
+            use_racer = bool(failed)
+        self._racer = None
+        if use_racer:
+            loser_sock, loser = self._remote_sock, self._remote
+            self._remote_sock, self._remote = racer_sock, racer
+            self._remote_af = racer.af
+        else:
+            loser_sock, loser = racer_sock, racer
+        balancer = self._server._remotes
+        if failed:
+            balancer.connect_failed(loser)
+        else:
+            balancer.lost_race(loser, time.time() - self._connect_started)
+        balancer.release(loser)
+        self._close_remote_sock(loser_sock)
+        logging.debug('[TCP] Connection to %s:%d lost the race' % loser.af)
+        if failed:
+            # the other one is still connecting
+            return None
+        return self._remote_sock
+
+    def _epoll_modify(self, sock, events):
+        # epoll_ctl is called only if the interest mask really changes
+        if self._edge_triggered or not sock:
+            return
+        fd = sock.fileno()
+        if fd in self._read_paused:
+            events &= ~select.EPOLLIN
+        if self._poll_events.get(fd) == events:
+            return
+        self._epoll.modify(fd, events)
+        self._poll_events[fd] = events
+
     def _epoll_modify_2_ro(self, sock):
-        events = select.EPOLLIN | select.EPOLLRDHUP | select.EPOLLERR
-        self._epoll.modify(sock.fileno(), events)
-        if sock == self._local_sock:
-            self._local_sock_poll_mode = 'ro'
-        elif sock == self._remote_sock:
-            self._remote_sock_poll_mode = 'ro'
+        self._epoll_modify(sock, EPOLL_RO)
 
     def _epoll_modify_2_rw(self, sock):
-        events = select.EPOLLIN | select.EPOLLOUT |\
-                    select.EPOLLRDHUP | select.EPOLLERR
-        self._epoll.modify(sock.fileno(), events)
-        if sock == self._local_sock:
-            self._local_sock_poll_mode = 'rw'
-        elif sock == self._remote_sock:
-            self._remote_sock_poll_mode = 'rw'
-
-    def _write_to_sock(self, data, sock):
-        # This function is copied from
-        #      shadowsocks.tcprelay.TCPRelayHandler._write_to_sock
-        # I made some change to fit my project.
+        self._epoll_modify(sock, EPOLL_RW)
 
-        # Copyright 2013-2015 clowwindy
-        # Licensed under the Apache License, Version 2.0
-        # https://www.apache.org/licenses/LICENSE-2.0
+    def _pause_reading(self, sock):
+        fd = sock.fileno()
+        if fd in self._read_paused:
+            return
+        self._read_paused.add(fd)
+        self._server._stats.incr('tcp_read_paused')
+        self._epoll_modify(sock, self._poll_events[fd])
+
+    def _resume_reading(self, sock):
+        if not sock or sock.fileno() not in self._read_paused:
+            return
+        fd = sock.fileno()
+        self._read_paused.discard(fd)
+        if self._edge_triggered:
+            # there may be data left in the socket, and no more edge
+            self._server.reschedule(fd, select.EPOLLIN)
+        else:
+            self._epoll_modify(sock, self._poll_events[fd] | select.EPOLLIN)
+
+    def _check_backpressure(self, producer, stored):
+        '''stop reading from producer if too much data is stored
+
+        :param stored: size of the data that is read from producer and
+                       waiting for sending
+        :rtype: boolean, True if producer is paused
+        '''
+
+        if stored >= self._buffer_high:
+            self._pause_reading(producer)
+            return True
+        if self._server._over_buffer_budget():
+            self._pause_reading(producer)
+            # the server will resume us when the total goes down
+            self._server._wait_for_buffer_budget(self)
+            return True
+        return False
+
+    def resume_reading(self):
+        '''called by the server when the buffer budget is available again
+        '''
+
+        if self._destroyed:
+            return
+        if self._data_2_remote_sock.size <= self._buffer_low:
+            self._resume_reading(self._local_sock)
+        if self._data_2_local_sock.size <= self._buffer_low:
+            self._resume_reading(self._remote_sock)
+
+    def _on_idle_timeout(self):
+        logging.info('[TCP] Connection idle timeout, do destroy()')
+        self.destroy()
+
+    def _on_connect_timeout(self):
+        logging.warn('[TCP] Connecting timeout, do destroy()')
+        self._remote_failed = True
+        self.destroy()
+
+    def _on_fpacket_timeout(self):
+        self._fpacket_timer = None
+        if self._fpacket_handled:
+            return
+        # the client is waiting for the server to speak first
+        self._fpacket_handled = True
+        self._handle_fpacket()
+
+    def _on_remote_connected(self):
+        self._remote_connected = True
+        if self._connect_timer:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+        if self._remote:
+            self._connected_at = time.time()
+            self._server._remotes.connected(
+                        self._remote, self._connected_at - self._connect_started)
+
+    def _recv(self, sock, buf_size):
+        '''receive data from sock
+
+        :rtype: memoryview of the server's RecvArena, empty if the peer
+                closed the connection, None if there is nothing to read
+        '''
 
-        if not data or not sock:
-            return None
-        uncomplete = False
         try:
-            l = len(data)
-            s = sock.send(data)
-            if s < l:
-                data = data[s:]
-                uncomplete = True
+            data = self._server._recv_arena.recv(sock, buf_size)
+            self._server._stats.incr('tcp_recv_calls')
+            self._event_bytes += len(data)
+            if data and self._idle_timer:
+                self._idle_timer.rearm(self._idle_timeout)
+            return data
         except (OSError, IOError) as e:
-            if tools.errno_from_exception(e) in (errno.EAGAIN, errno.EINPROGRESS,
+            if tools.errno_from_exception(e) in (errno.ETIMEDOUT, errno.EAGAIN,
                                                  errno.EWOULDBLOCK):
-                uncomplete = True
-            else:
-                self.destroy()
                 return None
-        if uncomplete:
-            if sock == self._local_sock:
-                self._data_2_local_sock.append(data)
-            elif sock == self._remote_sock:
-                self._data_2_remote_sock.append(data)
+            logging.warn('[TCP] Got error while receiving data, do destroy()')
+            self.destroy()
+            return None
+
+    def _adapt_recv_size(self, size, received):
+        '''grow the read size of a socket while reads keep filling it,
+        shrink it while the socket trickles
+
+        Bulk transfers get fewer recv calls and fewer, larger cipher calls,
+        interactive connections don't ask for large reads.
+        '''
+
+        if received >= size:
+            return min(size * 2, RECV_SIZE_MAX)
+        if received < size // 4:
+            return max(size // 2, RECV_SIZE_MIN)
+        return size
+
+    def _slice_used_up(self, sock):
+        if self._slice_bytes and self._event_bytes >= self._slice_bytes:
+            # In edge-triggered mode, we won't be notified again for the
+            # data left in the socket, so ask the server to come back later.
+            if self._edge_triggered:
+                self._server.reschedule(sock.fileno(), select.EPOLLIN)
+            return True
+        return False
+
+    def _compress(self, data):
+        if not self._compressor:
+            return data
+        return self._compressor.compress(data)
+
+    def _decompress(self, data):
+        '''
+        :rtype: bytes, None if the data is broken, the handler is destroyed
+        '''
+
+        if not self._decompressor:
+            return data
+        try:
+            return self._decompressor.decompress(data)
+        except ValueError as e:
+            logging.warn('[TCP] Got broken compressed data: %s, '
+                         'do destroy()' % e)
+            self.destroy()
+            return None
+
+    def _record_compression(self):
+        compressor = self._compressor
+        stats = self._server._stats
+        stats.incr('compress_bytes_in', compressor.bytes_in)
+        stats.incr('compress_bytes_out', compressor.bytes_out)
+        stats.incr('compress_cpu_us', int(compressor.cpu_time * 1000000))
+        stats.incr('decompress_cpu_us',
+                   int(self._decompressor.cpu_time * 1000000))
+        stats.incr('compress_disabled', compressor.disabled)
+        if compressor.bytes_in:
+            ratio = compressor.bytes_out * 100 // compressor.bytes_in
+            stats.observe('compress_ratio_pct', ratio, COMPRESS_RATIO_BOUNDS)
+            logging.info('[TCP] Compressed %dB to %dB (%d%%), cpu %.1fms' % (
+                            compressor.bytes_in, compressor.bytes_out, ratio,
+                            compressor.cpu_time * 1000))
+
+    def _store_data(self, buf, data):
+        # buf is self._data_2_local_sock or self._data_2_remote_sock,
+        # the server keeps the total size of data stored by all handlers
+        buf.append(data)
+        self._server._buffered_bytes += len(data)
+
+    def _send_stored(self, buf, sock):
+        '''send the data stored in buf to sock until it's empty or the
+        socket cannot take more, wait for EPOLLOUT in the latter case
+        '''
+
+        if not sock:
+            return
+        try:
+            while buf:
+                s, complete = buf.send(sock)
+                self._server._stats.incr('bytes_sent', s)
+                self._server._release_buffer(s)
+                if not complete:
+                    break
+        except (OSError, IOError) as e:
+            if tools.errno_from_exception(e) not in (errno.EAGAIN,
+                                                     errno.EINPROGRESS,
+                                                     errno.EWOULDBLOCK):
+                self.destroy()
+                return
+        if buf:
+            self._epoll_modify_2_rw(sock)
         else:
             self._epoll_modify_2_ro(sock)
 
@@ -166,35 +634,47 @@ class TCPHandler():
         if self._destroyed:
             return
 
-        if self._is_local:
-            buf_size = UP_STREAM_BUF_SIZE
-        else:
-            buf_size = DOWN_STREAM_BUF_SIZE
-        try:
-            data = self._local_sock.recv(buf_size)
-        except (OSError, IOError) as e:
-            if tools.errno_from_exception(e) in (errno.ETIMEDOUT, errno.EAGAIN,
-                                                 errno.EWOULDBLOCK):
+        # Read until the socket is drained or the slice is used up. In
+        # edge-triggered mode, we have to do so, otherwise, we will never
+        # be notified again. A short read means the socket is drained.
+        while not (self._destroyed or
+                   self._local_sock.fileno() in self._read_paused):
+            buf_size = self._local_recv_size
+            data = self._recv(self._local_sock, buf_size)
+            if not data:
+                if data == b'':
+                    logging.info('[TCP] Local socket got null data')
                 return
-        if not data:
-            logging.info('[TCP] Local socket got null data')
-            return
+            drained = len(data) < buf_size
+            self._local_recv_size = self._adapt_recv_size(buf_size,
+                                                          len(data))
 
-        if self._is_local:
-            data = self._cryptor.encrypt(data)
-        else:
             if not self._fpacket_handled:
-                self._handle_fpacket(data)
+                if self._fpacket_timer:
+                    self._fpacket_timer.cancel()
+                    self._fpacket_timer = None
                 self._fpacket_handled = True
-                self._epoll_modify_2_rw(self._remote_sock)
-                return
+                self._handle_fpacket(data)
+                if self._destroyed or drained:
+                    return
+                continue
+            if self._is_local:
+                data = self._cryptor.encrypt(self._compress(data))
             else:
-                data = self._cryptor.decrypt(data)
-        self._data_2_remote_sock.append(data)
-        if self._remote_sock_poll_mode == 'ro':
-            self._epoll_modify_2_rw(self._remote_sock)
-        logging.debug(
+                data = self._decompress(self._cryptor.decrypt(data))
+                if data is None:
+                    return
+            self._store_data(self._data_2_remote_sock, data)
+            logging.debug(
                 '[TCP] %dB to %s:%d, stored' % (len(data), *self._remote_af))
+            # try to send it directly, the socket will be switched to
+            # EPOLLOUT mode only if the data cannot be sent completely
+            self._on_remote_write()
+            if self._destroyed or self._check_backpressure(
+                        self._local_sock, self._data_2_remote_sock.size):
+                return
+            if drained or self._slice_used_up(self._local_sock):
+                return
 
     def _on_remote_write(self):
         # This function is copied from
@@ -207,13 +687,21 @@ class TCPHandler():
 
         if self._destroyed:
             return
+        if self._racer:
+            # the data goes to the winner only, it's sent when the race
+            # is settled
+            return
 
         if self._data_2_remote_sock:
-            data = b''.join(self._data_2_remote_sock)
-            self._data_2_remote_sock = []
-            self._write_to_sock(data, self._remote_sock)
-            logging.debug(
-                    '[TCP] Sent %dB to %s:%d' % (len(data), *self._remote_af))
+            size = self._data_2_remote_sock.size
+            self._send_stored(self._data_2_remote_sock, self._remote_sock)
+            logging.debug('[TCP] Sent %dB to %s:%d' % (
+                    size - self._data_2_remote_sock.size, *self._remote_af))
+            if (not self._destroyed and
+                    self._data_2_remote_sock.size <= self._buffer_low):
+                self._resume_reading(self._local_sock)
+        else:
+            self._epoll_modify_2_ro(self._remote_sock)
 
     def _on_remote_read(self):
         # This function is copied from
@@ -226,30 +714,37 @@ class TCPHandler():
 
         if self._destroyed:
             return
-        if self._is_local:
-            buf_size = UP_STREAM_BUF_SIZE
-        else:
-            buf_size = DOWN_STREAM_BUF_SIZE
 
-        data = None
-        try:
-            data = self._remote_sock.recv(buf_size)
-        except (OSError, IOError) as e:
-            if tools.errno_from_exception(e) in (errno.ETIMEDOUT, errno.EAGAIN,
-                                                 errno.EWOULDBLOCK):
+        while not (self._destroyed or
+                   self._remote_sock.fileno() in self._read_paused):
+            buf_size = self._remote_recv_size
+            data = self._recv(self._remote_sock, buf_size)
+            if not data:
+                if data == b'':
+                    logging.info('[TCP] Remote socket got null data')
                 return
-        if not data:
-            logging.info('[TCP] Remote socket got null data')
-            return
+            drained = len(data) < buf_size
+            self._remote_recv_size = self._adapt_recv_size(buf_size,
+                                                           len(data))
+            if self._remote:
+                self._remote_bytes += len(data)
+                self._remote_last_read_at = time.time()
 
-        if self._is_local:
-            data = self._cryptor.decrypt(data)
-        else:
-            data = self._cryptor.encrypt(data)
-        self._data_2_local_sock.append(data)
-        if self._local_sock_poll_mode == 'ro':
-            self._epoll_modify_2_rw(self._local_sock)
-        logging.debug('[TCP] %dB to %s:%d, stored' % (len(data), *self._src))
+            if self._is_local:
+                data = self._decompress(self._cryptor.decrypt(data))
+                if data is None:
+                    return
+            else:
+                data = self._cryptor.encrypt(self._compress(data))
+            self._store_data(self._data_2_local_sock, data)
+            logging.debug(
+                    '[TCP] %dB to %s:%d, stored' % (len(data), *self._src))
+            self._on_local_write()
+            if self._destroyed or self._check_backpressure(
+                        self._remote_sock, self._data_2_local_sock.size):
+                return
+            if drained or self._slice_used_up(self._remote_sock):
+                return
 
     def _on_local_write(self):
         # This function is copied from
@@ -264,11 +759,15 @@ class TCPHandler():
             return
 
         if self._data_2_local_sock:
-            data = b''.join(self._data_2_local_sock)
-            self._data_2_local_sock = []
-            self._write_to_sock(data, self._local_sock)
-            logging.debug(
-                    '[TCP] Sent %dB to %s:%d' % (len(data), *self._src))
+            size = self._data_2_local_sock.size
+            self._send_stored(self._data_2_local_sock, self._local_sock)
+            logging.debug('[TCP] Sent %dB to %s:%d' % (
+                    size - self._data_2_local_sock.size, *self._src))
+            if (not self._destroyed and
+                    self._data_2_local_sock.size <= self._buffer_low):
+                self._resume_reading(self._remote_sock)
+        else:
+            self._epoll_modify_2_ro(self._local_sock)
 
     def _on_local_disconnect(self):
         logging.info('[TCP] Local socket got EPOLLRDHUP, do destroy()')
@@ -276,6 +775,7 @@ class TCPHandler():
 
     def _on_remote_disconnect(self):
         logging.info('[TCP] Remote socket got EPOLLRDHUP, do destroy()')
+        self._remote_failed = True
         self.destroy()
 
     def _on_local_error(self):
@@ -284,13 +784,15 @@ class TCPHandler():
 
     def _on_remote_error(self):
         logging.warn('[TCP] Remote socket got EPOLLERR, do destroy()')
+        self._remote_failed = True
         self.destroy()
 
     def _handle_fpacket(self, data=b''):
         if self._is_local:
             self._dest_af = self._local_get_dest_af()
             data = PacketMaker.make_tcp_fpacket(
-                                            data, self._dest_af,
+                                            self._compress(data),
+                                            self._dest_af,
                                             self._iv, self._cryptor,
                                             self._server._iv_cryptor
                                             )
@@ -305,14 +807,25 @@ class TCPHandler():
                         '[TCP] Got invalid data from %s:%d' % self._src)
                 self.destroy()
                 return
-            data = res['data']
+            if res['dest_af'] == MUX_DEST_AF and self._config.get('tcp_mux'):
+                self._hand_over(self._server._accept_tunnel,
+                                res['cryptor'], res['data'])
+                return
+            if (res['dest_af'] == STRIPE_DEST_AF and
+                    self._config.get('tcp_stripe')):
+                self._hand_over(self._server._accept_stripe,
+                                res['cryptor'], res['data'])
+                return
+            data = self._decompress(res['data'])
+            if data is None:
+                return
             self._remote_af = res['dest_af']
             self._remote_ip = self._remote_af[0]
             self._remote_port = self._remote_af[1]
             self._cryptor = res['cryptor']
             self._iv = res['iv']
         if len(data) > 0:
-            self._data_2_remote_sock.append(data)
+            self._store_data(self._data_2_remote_sock, data)
         logging.debug('[TCP] %dB to %s:%d, stored' % (len(data),
                                                       *self._remote_af))
 
@@ -326,7 +839,10 @@ class TCPHandler():
                 self.destroy()
                 return
 
-        self._remote_sock = self._create_remote_sock(self._remote_af)
+        if self._is_local and self._server._remotes:
+            self._remote_sock = self._connect_remotes()
+        else:
+            self._remote_sock = self._create_remote_sock(self._remote_af)
         if not self._remote_sock:
             logging.warn('[TCP] Cannot connect to %s:%d, do destroy' %\
                                                          self._remote_af)
@@ -337,28 +853,66 @@ class TCPHandler():
         else:
             logging.info('[TCP] Connecting to %s:%d' % self._remote_af)
 
-        events = select.EPOLLIN | select.EPOLLRDHUP | select.EPOLLERR
-        self._add_sock_to_poll(self._remote_sock, events)
+        # we will get EPOLLOUT when the connection is established,
+        # and the stored data will be sent at that time
+        self._add_sock_to_poll(self._remote_sock, EPOLL_RW)
+        connect_timeout = self._config.get('tcp_connect_timeout') or 10
+        self._connect_timer = self._server._timers.call_later(
+                                    connect_timeout, self._on_connect_timeout)
+
+    def _hand_over(self, accept, cryptor, data):
+        # The connection is a tunnel of ir.mux or a stripe of ir.stripe,
+        # accept takes the socket over, and this handler is done without
+        # closing it.
+        sock = self._local_sock
+        fd = sock.fileno()
+        self._server._remove_handler(fd)
+        self._epoll.unregister(fd)
+        self._local_sock = None
+        self._destroyed = True
+        self._server._stats.incr('connections', -1)
+        if self._idle_timer:
+            self._idle_timer.cancel()
+        accept(sock, cryptor, data)
 
     def handle_event(self, fd, evt):
+        '''handle events of a socket
+
+        :rtype: int, bytes received while handling the events
+        '''
+
         if self._destroyed:
             logging.info('[TCP] Handler destroyed')
-            return
+            return 0
         sock = self._fd_2_sock(fd)
         if not sock:
             logging.warn('[TCP] Unknow socket error, do destroy()')
-            return
+            return 0
+        self._event_bytes = 0
+
+        if self._racer and sock != self._local_sock:
+            sock = self._settle_race(sock, evt)
+            if not sock:
+                return 0
 
         if sock == self._remote_sock:
+            if (evt & (select.EPOLLERR | select.EPOLLHUP |
+                       select.EPOLLRDHUP) and self._failover()):
+                return 0
             if evt & select.EPOLLRDHUP:
                 self._on_remote_disconnect()
             if evt & select.EPOLLERR:
                 self._on_remote_error()
+            elif not self._remote_connected:
+                self._on_remote_connected()
             if evt & (select.EPOLLIN):
                 self._on_remote_read()
             if evt & select.EPOLLOUT:
                 self._on_remote_write()
         elif sock == self._local_sock:
+            if (evt & select.EPOLLERR and self._data_2_local_sock.zerocopy
+                    and self._reap_zerocopy()):
+                evt &= ~select.EPOLLERR
             if evt & select.EPOLLRDHUP:
                 self._on_local_disconnect()
             if evt & select.EPOLLERR:
@@ -367,6 +921,8 @@ class TCPHandler():
                 self._on_local_read()
             if evt & select.EPOLLOUT:
                 self._on_local_write()
+        self._server._stats.incr('bytes_received', self._event_bytes)
+        return self._event_bytes
 
     def destroy(self):
         if self._destroyed:
@@ -374,9 +930,27 @@ class TCPHandler():
             return
 
         self._destroyed = True
+        self._server._stats.incr('connections', -1)
+        self._server._release_buffer(self._data_2_local_sock.size +
+                                     self._data_2_remote_sock.size)
+        inflight = self._data_2_local_sock.take_zerocopy_inflight()
+        if inflight:
+            # keep the buffers until the kernel surely stopped sending them
+            self._server._timers.call_later(ZEROCOPY_LINGER, inflight.clear)
+        self._data_2_local_sock.clear()
+        self._data_2_remote_sock.clear()
+        if self._idle_timer:
+            self._idle_timer.cancel()
+        if self._connect_timer:
+            self._connect_timer.cancel()
+        if self._fpacket_timer:
+            self._fpacket_timer.cancel()
         loc_fd = self._local_sock.fileno()
         self._server._remove_handler(loc_fd)
         self._epoll.unregister(loc_fd)
+        profile = self._server._accepted_profile
+        if profile:
+            profile.record(self._local_sock)
         self._local_sock.close()
         self._local_sock = None
         logging.debug('[TCP] Local socket destroyed, fd: %d' % loc_fd)
@@ -384,6 +958,9 @@ class TCPHandler():
             rmt_fd = self._remote_sock.fileno()
             self._server._remove_handler(rmt_fd)
             self._epoll.unregister(rmt_fd)
+            profile = self._server._connected_profile
+            if profile:
+                profile.record(self._remote_sock)
             self._remote_sock.close()
             self._remote_sock = None
             if self._is_local:
@@ -391,6 +968,31 @@ class TCPHandler():
             else:
                 af = self._remote_af
             logging.info('[TCP] Remote socket @ %s:%d destroyed' % af)
+        if self._egress_addr:
+            self._server._egress.release(self._egress_addr)
+            self._egress_addr = None
+        if self._racer:
+            racer_sock, racer = self._racer
+            self._racer = None
+            self._server._remotes.release(racer)
+            self._close_remote_sock(racer_sock)
+        if self._remote:
+            self._release_remote()
+        if self._compressor:
+            self._record_compression()
+
+    def _release_remote(self):
+        balancer = self._server._remotes
+        if not self._remote_connected:
+            if self._remote_failed:
+                # refused, broken or timed out while connecting
+                balancer.connect_failed(self._remote)
+            # else the client left early, nothing is learned
+        else:
+            balancer.transferred(self._remote, self._remote_bytes,
+                                 self._remote_last_read_at - self._connected_at)
+        balancer.release(self._remote)
+        self._remote = None
 
     @property
     def destroyed(self):
@@ -412,6 +1014,8 @@ class UDPHandler():
         self._key = key
         self._min_salt_len = config.get('udp_min_salt_len') or 4
         self._max_salt_len = config.get('udp_max_salt_len') or 32
+        self._max_idle_time = config.get('udp_socket_max_idle_time') or 60
+        self._egress_addr = None
         if self._is_local:
             server_addr = config.get('server_addr')
             server_port = config.get('server_udp_port')
@@ -419,7 +1023,8 @@ class UDPHandler():
                 logging.error('invalid remote udp server configuration')
                 import sys
                 sys.exit()
-            self._remote_af = (server_addr, server_port)
+            # see UDPServer._init_socket
+            self._remote_af = (server_addr, server_port + server._worker_id)
 
         self._client_sock = self._create_client_sock()
         if not self._client_sock:
@@ -428,6 +1033,8 @@ class UDPHandler():
         self._add_sock_to_poll(self._client_sock,
                                select.EPOLLIN | select.EPOLLERR)
         self._destroyed = False
+        self._idle_timer = self._server._timers.call_later(
+                                self._max_idle_time, self._on_idle_timeout)
         if self._is_local:
             self._return_sock = self._create_return_sock()
             self._iv_len = self._config.get('iv_len') or 32
@@ -441,7 +1048,15 @@ class UDPHandler():
         client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         client_sock.setblocking(False)
-        client_sock.bind(('0.0.0.0', 0))
+        try:
+            if self._server._egress and not self._is_local:
+                self._egress_addr = self._server._egress.bind(client_sock)
+            else:
+                client_sock.bind(('0.0.0.0', 0))
+        except (OSError, IOError) as e:
+            logging.warn('[UDP] Cannot bind the client socket: %s' % e)
+            client_sock.close()
+            return None
         fd = client_sock.fileno()
         logging.debug('[UDP] created client socket fd: %d' % fd)
         return client_sock
@@ -461,10 +1076,18 @@ class UDPHandler():
         if self._server._multi_transmit and not self._is_local:
             self._server._add_handler(self, src_port=self._src[1])
 
+    def _remove_sock_from_poll(self, sock):
+        self._epoll.unregister(sock.fileno())
+
+    def _on_idle_timeout(self):
+        logging.debug('[UDP] Handler expired')
+        self.destroy()
+
     def update_last_call_time(self):
         if self._destroyed:
             return False
         self.last_call_time = time.time()
+        self._idle_timer.rearm(self._max_idle_time, self.last_call_time)
         return True
 
     def handle_local_recv(self, data):
@@ -509,7 +1132,11 @@ class UDPHandler():
                                                               *target))
 
     def handle_remote_resp(self):
-        data, src = self._client_sock.recvfrom(UDP_BUFFER_SIZE)
+        data, src = self._server._recv_arena.recvfrom(self._client_sock,
+                                                      UDP_BUFFER_SIZE)
+        stats = self._server._stats
+        stats.incr('packets_received')
+        stats.incr('bytes_received', len(data))
         excl = self._server._excl
         if self._is_local:
             cryptor = excl.current_cryptor
@@ -518,11 +1145,13 @@ class UDPHandler():
                 err_msg = '[UDP] Got invalid packet from %s:%d' % src
                 if not (excl.old_cryptor and cryptor != excl.old_cryptor):
                     logging.info(err_msg)
+                    stats.incr('packets_dropped')
                     return
                 cryptor = excl.old_cryptor
                 res = PacketParser.parse_udp_packet(cryptor, data)
                 if not res['valid']:
                     logging.info(err_msg)
+                    stats.incr('packets_dropped')
                     return
 
             if self._server._multi_transmit:
@@ -530,6 +1159,7 @@ class UDPHandler():
                 if is_duplicate:
                     logging.debug(
                             '[UDP_MT] Dropped duplicate packet')
+                    stats.incr('packets_dropped')
                     return
             decrypted_by_nc = cryptor == excl.nc_in_progress
             iv = res['iv']
@@ -572,15 +1202,19 @@ class UDPHandler():
             return False
 
         self._destroyed = True
+        self._idle_timer.cancel()
         fd = None
         if hasattr(self, '_return_sock') and self._return_sock:
             self._return_sock.close()
             self._return_sock = None
         if hasattr(self, '_client_sock') and self._client_sock:
             fd = self._client_sock.fileno()
-            self._epoll.unregister(fd)
+            self._remove_sock_from_poll(self._client_sock)
             self._client_sock.close()
             self._client_sock = None
+        if self._egress_addr:
+            self._server._egress.release(self._egress_addr)
+            self._egress_addr = None
         if fd:
             self._server._remove_handler(fd=fd)
         if self._key:
@@ -597,7 +1231,7 @@ class UDPHandler():
 
 class UDPMultiTransmitHandler():
 
-    def __init__(self, config, is_local):
+    def __init__(self, config, is_local, worker_id=0):
         self._config = config
         self._is_local = is_local
         self._min_salt_len = config.get('udp_min_salt_len') or 4
@@ -607,7 +1241,8 @@ class UDPMultiTransmitHandler():
             multi_remote = config.get('udp_multi_remote')
             if not isinstance(multi_remote, dict):
                 raise Exception('Format of udp_multi_remote is invalid')
-            self._server_af_list = [(ip, pt) for ip, pt in multi_remote.items()]
+            self._server_af_list = [(ip, pt + worker_id)
+                                    for ip, pt in multi_remote.items()]
         # else:
             # self._source_list = config.get('udp_multi_source')
             # if not isinstance(self._source_list, list):
@@ -691,6 +1326,158 @@ class CacheQueue():
         return True
 
 
+class SendQueue(object):
+
+    '''data waiting to be sent to a socket
+
+    The buffers are sent with sendmsg (scatter-gather) instead of being
+    joined, and the sent part of the first buffer is skipped through a
+    memoryview instead of being sliced off, so the data is not copied
+    before it reaches the kernel.
+    '''
+
+    def __init__(self):
+        self._bufs = deque()
+        # bytes of self._bufs[0] that are already sent
+        self._offset = 0
+        self.size = 0
+        # 0 if MSG_ZEROCOPY is not used
+        self._zerocopy_threshold = 0
+        # buffers of zerocopy sends the kernel may still read from,
+        # deque of (notification id, buffers)
+        self._zerocopy_inflight = deque()
+        self._zerocopy_id = 0
+
+    def __len__(self):
+        return len(self._bufs)
+
+    def append(self, data):
+        if data:
+            self._bufs.append(data)
+            self.size += len(data)
+
+    def send(self, sock, flags=0, address=None):
+        '''send the first SEND_IOV_MAX buffers with one sendmsg call
+
+        :rtype: tuple, (bytes sent, True if all the buffers passed to
+                sendmsg are sent)
+        '''
+
+        iov = []
+        total = -self._offset
+        for data in self._bufs:
+            iov.append(data)
+            total += len(data)
+            if len(iov) == SEND_IOV_MAX:
+                break
+        if self._offset:
+            iov[0] = memoryview(iov[0])[self._offset:]
+        zerocopy = bool(self._zerocopy_threshold and not address and
+                        total >= self._zerocopy_threshold)
+        if zerocopy:
+            try:
+                sent = sock.sendmsg(iov, [], flags | MSG_ZEROCOPY)
+            except (OSError, IOError) as e:
+                # ENOBUFS: too much memory is pinned, copy this time
+                if tools.errno_from_exception(e) != errno.ENOBUFS:
+                    raise
+                zerocopy = False
+        if zerocopy:
+            if sent:
+                # the kernel numbers every zerocopy send that sent data
+                self._zerocopy_inflight.append((self._zerocopy_id, iov))
+                self._zerocopy_id = (self._zerocopy_id + 1) & 0xffffffff
+        elif address:
+            sent = sock.sendmsg(iov, [], flags, address)
+        else:
+            sent = sock.sendmsg(iov, [], flags)
+        self.consume(sent)
+        return sent, sent == total
+
+    def consume(self, n):
+        '''drop n bytes from the head of the queue
+        '''
+
+        self.size -= n
+        n += self._offset
+        while self._bufs and n >= len(self._bufs[0]):
+            n -= len(self._bufs.popleft())
+        self._offset = n
+
+    def clear(self):
+        self._bufs.clear()
+        self._offset = 0
+        self.size = 0
+
+    def enable_zerocopy(self, sock, threshold=ZEROCOPY_THRESHOLD):
+        '''send with MSG_ZEROCOPY when at least threshold bytes are sent at
+        once, the buffers must not be changed after they are appended
+
+        :rtype: boolean, False if the kernel doesn't support it
+        '''
+
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_ZEROCOPY, 1)
+        except (OSError, IOError):
+            return False
+        self._zerocopy_threshold = threshold
+        return True
+
+    @property
+    def zerocopy(self):
+        return bool(self._zerocopy_threshold or self._zerocopy_inflight)
+
+    def reap_zerocopy(self, sock):
+        '''read the notifications of finished zerocopy sends from the error
+        queue of sock, and drop the buffers of them
+
+        If the kernel had to copy the data anyway, e.g. on loopback,
+        MSG_ZEROCOPY is turned off for the queue, it only costs more.
+
+        :rtype: tuple, (sends finished, True if any of them was copied)
+        '''
+
+        finished = 0
+        copied = False
+        while True:
+            try:
+                _, ancdata, _, _ = sock.recvmsg(0, socket.CMSG_SPACE(64),
+                                                socket.MSG_ERRQUEUE)
+            except (OSError, IOError) as e:
+                if tools.errno_from_exception(e) in (errno.EAGAIN,
+                                                     errno.EWOULDBLOCK):
+                    break
+                raise
+            for level, type_, data in ancdata:
+                if not ((level == socket.SOL_IP and type_ == IP_RECVERR) or
+                        (level == socket.SOL_IPV6 and type_ == IPV6_RECVERR)):
+                    continue
+                _, origin, _, code, _, first, last = \
+                                        SOCK_EXTENDED_ERR.unpack_from(data)
+                if origin != SO_EE_ORIGIN_ZEROCOPY:
+                    continue
+                # ids in [first, last] are finished, the range may wrap
+                span = (last - first) & 0xffffffff
+                finished += span + 1
+                self._zerocopy_inflight = deque(
+                        item for item in self._zerocopy_inflight
+                        if (item[0] - first) & 0xffffffff > span)
+                if code & SO_EE_CODE_ZEROCOPY_COPIED:
+                    copied = True
+        if copied:
+            self._zerocopy_threshold = 0
+        return finished, copied
+
+    def take_zerocopy_inflight(self):
+        '''
+        :rtype: list, buffers the kernel may still read from
+        '''
+
+        inflight = [bufs for _, bufs in self._zerocopy_inflight]
+        self._zerocopy_inflight.clear()
+        return inflight
+
+
 def test_socket_bind_time_spent():
     # UDPHandler.handle_remote_resp中向客户端socket写入数据部分的处理
     # 使用了和ss-libev相同的方法，此处测试socket新建、绑定、关闭所用的时间
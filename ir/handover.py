@@ -0,0 +1,93 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import os
+import errno
+import array
+import struct
+import socket
+import logging
+
+from ir import tools
+
+
+__all__ = ['receive_socket', 'send_socket', 'listen']
+
+
+'''Pass a listening socket from a running process to a new one
+
+The running process listens on a unix socket. A new process connects to it
+and receives the listening socket through SCM_RIGHTS, so the kernel keeps
+the socket open and no connection or datagram is lost while restarting.
+'''
+
+
+HANDOVER_TIMEOUT = 5
+
+# address family of the socket, sent with the fd
+HANDOVER_MSG = struct.Struct('!i')
+
+
+def listen(path):
+    '''listen on path for the next process
+
+    :rtype: non-blocking unix socket
+    '''
+
+    try:
+        os.unlink(path)
+    except (OSError, IOError) as e:
+        if tools.errno_from_exception(e) != errno.ENOENT:
+            raise
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    sock.setblocking(False)
+    return sock
+
+
+def send_socket(conn, sock):
+    '''send sock through the accepted unix socket conn
+    '''
+
+    fds = array.array('i', [sock.fileno()])
+    conn.setblocking(True)
+    conn.settimeout(HANDOVER_TIMEOUT)
+    conn.sendmsg([HANDOVER_MSG.pack(sock.family)],
+                 [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+
+
+def receive_socket(path, sock_type):
+    '''receive a socket from the process listening on path
+
+    :rtype: non-blocking socket, None if no process is listening on path
+    '''
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(HANDOVER_TIMEOUT)
+    fds = array.array('i')
+    try:
+        conn.connect(path)
+        msg, anc, flags, addr = conn.recvmsg(
+                                    HANDOVER_MSG.size,
+                                    socket.CMSG_SPACE(fds.itemsize))
+    except (OSError, IOError) as e:
+        if tools.errno_from_exception(e) not in (errno.ENOENT,
+                                                 errno.ECONNREFUSED):
+            logging.warn('[HANDOVER] Cannot receive socket from %s: %s' % (
+                                                                path, e))
+        return None
+    finally:
+        conn.close()
+    for level, type_, data in anc:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    if len(msg) != HANDOVER_MSG.size or not fds:
+        logging.warn('[HANDOVER] Got invalid message from %s' % path)
+        for fd in fds:
+            os.close(fd)
+        return None
+    family = HANDOVER_MSG.unpack(msg)[0]
+    sock = socket.socket(family, sock_type, fileno=fds[0])
+    sock.setblocking(False)
+    return sock
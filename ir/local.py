@@ -1,18 +1,117 @@
 #!/usr/bin/python3.6
 # coding: utf-8
 
+import logging
 
 from ir.server import TCPServer, UDPServer
+from ir.aio import AioTCPServer, AioUDPServer
+from ir.balancer import RemoteBalancer
+from ir.mux import MuxClient
+from ir.pool import ConnectionPool
+from ir.stripe import StripedFlow, STRIPES
+from ir.uring import URingTCPServer
 
 
-__all__ = ['LocalTCPServer', 'LocalUDPServer']
+__all__ = ['LocalTCPServer', 'LocalUDPServer',
+           'LocalAioTCPServer', 'LocalAioUDPServer',
+           'LocalURingTCPServer']
+
+
+# default number of tunnels in tcp_mux mode
+MUX_TUNNELS = 2
 
 
 class LocalTCPServer(TCPServer):
 
     _is_local = True
 
+    _mux = None
+
+    # addresses of the remote that stripes connect to in turn
+    _stripe_afs = None
+
+    def _before_run(self):
+        TCPServer._before_run(self)
+        multi_remote = self._config.get('tcp_multi_remote')
+        if multi_remote and not isinstance(multi_remote, dict):
+            raise Exception('Format of tcp_multi_remote is invalid')
+        if self._config.get('tcp_stripe'):
+            # all stripes of a flow must reach the same remote, here the
+            # addresses of tcp_multi_remote are taken as addresses of one
+            # remote and used in turn
+            self._stripe_afs = (list(multi_remote.items()) if multi_remote
+                                else [(self._config.get('server_addr'),
+                                       self._config.get('server_tcp_port'))])
+            logging.info('[TCP] Striping flows over %d connections' %
+                         (self._config.get('tcp_stripe_count') or STRIPES))
+            return
+        if multi_remote:
+            self._remotes = RemoteBalancer(
+                    list(multi_remote.items()), self._stats,
+                    self._config.get('tcp_connect_timeout') or 10)
+            self._remotes.log_remotes()
+            # the pool and the tunnels only go to server_addr
+            return
+        if self._config.get('tcp_mux'):
+            self._mux = MuxClient(self,
+                                  (self._config.get('server_addr'),
+                                   self._config.get('server_tcp_port')),
+                                  self._config.get('tcp_mux_tunnels') or
+                                  MUX_TUNNELS)
+            self._mux.start()
+        pool_size = self._config.get('tcp_pool_size')
+        if pool_size:
+            self._conn_pool = ConnectionPool(
+                    self,
+                    (self._config.get('server_addr'),
+                     self._config.get('server_tcp_port')),
+                    pool_size,
+                    self._config.get('tcp_pool_max_idle'),
+                    self._config.get('tcp_connect_timeout') or 10)
+            self._conn_pool.start()
+
+    def _collect_stats(self):
+        TCPServer._collect_stats(self)
+        if self._conn_pool:
+            self._stats.set('pool_idle', self._conn_pool.idle_count)
+        if self._remotes:
+            self._remotes.collect_stats()
+
+    def _new_handler(self, conn, src):
+        if self._stripe_afs:
+            return StripedFlow.accept(
+                            self, conn, src, self._stripe_afs,
+                            self._config.get('tcp_stripe_count') or STRIPES)
+        if self._mux:
+            stream = self._mux.new_stream(conn, src)
+            if stream:
+                return stream
+        # no tunnel, connect to the remote directly
+        return TCPServer._new_handler(self, conn, src)
+
+    def _stop_accepting(self):
+        TCPServer._stop_accepting(self)
+        if self._conn_pool:
+            self._conn_pool.close()
+        if self._mux:
+            self._mux.stop()
+
 
 class LocalUDPServer(UDPServer):
 
     _is_local = True
+
+
+class LocalAioTCPServer(AioTCPServer):
+
+    _is_local = True
+
+
+class LocalAioUDPServer(AioUDPServer):
+
+    _is_local = True
+
+
+class LocalURingTCPServer(URingTCPServer):
+
+    _is_local = True
@@ -0,0 +1,706 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import os
+import time
+import errno
+import select
+import socket
+import struct
+import logging
+
+from ir import tools
+from ir.crypto import Cryptor
+from ir.handler import SendQueue, get_orig_dest_af
+from ir.protocol import PacketMaker, PacketParser, MUX_DEST_AF
+
+
+__all__ = ['MuxClient', 'Tunnel', 'MuxStream']
+
+
+'''Carry many TCP connections (streams) over a few long-lived tunnels
+
+A tunnel is a normal connection from the local to the remote whose first
+packet has MUX_DEST_AF as the destination. After the first packet, the
+tunnel transports encrypted frames:
+
+    +--------------------+-----------------------+
+    |       field        |        byte(s)        |
+    +--------------------+-----------------------+
+    |        TYPE        |           1           |
+    +--------------------+-----------------------+
+    |     STREAM.ID      |           4           |
+    +--------------------+-----------------------+
+    |      DATA.LEN      |           2           |
+    +--------------------+-----------------------+
+    |        DATA        |       DATA.LEN        |
+    +--------------------+-----------------------+
+
+    OPEN    local -> remote, DATA is the destination, see
+            PacketMaker.ipv4_af_2_bytes
+    DATA    the data of the stream
+    WINDOW  DATA is a 4 bytes unsigned int, the receiver of the stream
+            has sent this many bytes to its socket, the sender may send
+            this many more bytes
+    CLOSE   the stream is closed
+    GOAWAY  remote -> local, STREAM.ID is 0, the remote is handing its
+            listening socket over to a new process, new streams must go
+            to other tunnels, the local closes this one when its streams
+            are finished
+
+Flow control: a stream never sends more than STREAM_WINDOW bytes that are
+not granted by WINDOW frames, so a stream whose socket is slow only stops
+itself, the tunnel and the other streams keep going. When the write queue
+of a tunnel is long, all its streams stop reading until it drains.
+
+Sockets of tunnels and streams are always level-triggered.
+'''
+
+
+FRAME_HEADER = struct.Struct('!BIH')
+FRAME_OPEN = 1
+FRAME_DATA = 2
+FRAME_WINDOW = 3
+FRAME_CLOSE = 4
+FRAME_GOAWAY = 5
+
+WINDOW_INCREMENT = struct.Struct('!I')
+
+MAX_FRAME_DATA = 65535
+
+# bytes a stream may send before the receiver grants more
+STREAM_WINDOW = 262144
+
+# max bytes read from a stream's socket at a time
+STREAM_RECV_SIZE = 65536
+
+# max bytes read from a tunnel in one event
+TUNNEL_RECV_BUDGET = 1048576
+
+# watermarks of the write queue of a tunnel, in bytes
+TUNNEL_HIGH_WATERMARK = 1048576
+TUNNEL_LOW_WATERMARK = 262144
+
+TUNNEL_CHECK_INTERVAL = 1
+
+# a tunnel or a stream ends when recv() returns b'', EPOLLRDHUP only wakes
+# up the reading, so it's not watched while a stream is paused
+EPOLL_READ = select.EPOLLIN | select.EPOLLRDHUP
+
+
+class Tunnel(object):
+
+    '''one end of a tunnel
+
+    :param initiator: True on the local side, which opens streams
+    '''
+
+    def __init__(self, server, sock, cryptor, initiator, on_closed=None):
+        self._server = server
+        self._sock = sock
+        self._fd = sock.fileno()
+        self._cryptor = cryptor
+        self._initiator = initiator
+        self._on_closed = on_closed
+        self._out = SendQueue()
+        # decrypted data that is not a complete frame yet
+        self._in = bytearray()
+        self._streams = {}
+        # streams that stopped reading because the tunnel is congested
+        self._waiters = set()
+        self._next_stream_id = 1
+        self._connected = not initiator
+        self._created_at = time.time()
+        # no more streams are opened on it, see FRAME_GOAWAY
+        self._going_away = False
+        self._closed = False
+        self._events = EPOLL_READ | select.EPOLLOUT | select.EPOLLERR
+        self._sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        self._sock.setblocking(False)
+        self._server._epoll.register(self._fd, self._events)
+        self._server._add_handler(self._fd, self)
+        self._server._stats.incr('mux_tunnels')
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def connected(self):
+        return self._connected
+
+    @property
+    def created_at(self):
+        return self._created_at
+
+    @property
+    def going_away(self):
+        return self._going_away
+
+    @property
+    def stream_count(self):
+        return len(self._streams)
+
+    @property
+    def congested(self):
+        return self._out.size >= TUNNEL_HIGH_WATERMARK
+
+    def _update_events(self):
+        events = EPOLL_READ | select.EPOLLERR
+        if self._out or not self._connected:
+            events |= select.EPOLLOUT
+        if events != self._events:
+            self._server._epoll.modify(self._fd, events)
+            self._events = events
+
+    def _queue(self, data):
+        self._out.append(data)
+        self._server._buffered_bytes += len(data)
+
+    def send_raw(self, data):
+        '''send data that is encrypted already, such as the first packet
+        '''
+
+        self._queue(data)
+        self._update_events()
+
+    def send_frame(self, type_, stream_id, data=b''):
+        # The header and data are encrypted separately, it's the same as
+        # encrypting them together with a stream cipher, and they are not
+        # copied into one buffer. Frames are sent in the next EPOLLOUT, so
+        # the frames made in one event loop iteration go in one sendmsg.
+        offset = 0
+        while True:
+            chunk = data[offset:offset + MAX_FRAME_DATA]
+            header = FRAME_HEADER.pack(type_, stream_id, len(chunk))
+            self._queue(self._cryptor.encrypt(header))
+            if chunk:
+                self._queue(self._cryptor.encrypt(chunk))
+            offset += MAX_FRAME_DATA
+            if offset >= len(data):
+                break
+        self._update_events()
+
+    def open_stream(self, stream, dest_af):
+        stream_id = self._next_stream_id
+        self._next_stream_id += 1
+        self._streams[stream_id] = stream
+        self.send_frame(FRAME_OPEN, stream_id,
+                        PacketMaker.ipv4_af_2_bytes(dest_af))
+        return stream_id
+
+    def remove_stream(self, stream_id):
+        stream = self._streams.pop(stream_id, None)
+        self._waiters.discard(stream)
+        if self._going_away and self._initiator and not self._streams:
+            logging.info('[MUX] Tunnel went away, do close')
+            self.close()
+
+    def go_away(self):
+        '''tell the local side not to open streams on this tunnel any more,
+        the streams on it go on until they are finished
+        '''
+
+        if self._going_away or self._closed:
+            return
+        self._going_away = True
+        self.send_frame(FRAME_GOAWAY, 0)
+
+    def wait_for_drain(self, stream):
+        self._waiters.add(stream)
+
+    def start(self, data=b''):
+        '''start with the decrypted data that came with the first packet
+        '''
+
+        if data:
+            self._in += data
+            self._handle_frames()
+
+    def _handle_frames(self):
+        buf = self._in
+        i = 0
+        while len(buf) - i >= FRAME_HEADER.size and not self._closed:
+            type_, stream_id, length = FRAME_HEADER.unpack_from(buf, i)
+            start = i + FRAME_HEADER.size
+            if len(buf) - start < length:
+                break
+            data = buf[start:start + length]
+            i = start + length
+            self._handle_frame(type_, stream_id, data)
+        del buf[:i]
+
+    def _handle_frame(self, type_, stream_id, data):
+        stream = self._streams.get(stream_id)
+        if type_ == FRAME_DATA:
+            if stream:
+                stream.on_data(data)
+        elif type_ == FRAME_WINDOW:
+            if stream:
+                stream.on_window(WINDOW_INCREMENT.unpack(data)[0])
+        elif type_ == FRAME_CLOSE:
+            if stream:
+                stream.on_close()
+        elif type_ == FRAME_GOAWAY and self._initiator:
+            self._going_away = True
+            if not self._streams:
+                logging.info('[MUX] Tunnel went away, do close')
+                self.close()
+        elif type_ == FRAME_OPEN and not self._initiator and not stream:
+            dest_af = PacketParser.bytes_2_ipv4_af(data)
+            if not dest_af or self._going_away:
+                # the local opened it before it got our GOAWAY
+                self.send_frame(FRAME_CLOSE, stream_id)
+                return
+            # every stream is a new connection to a destination, it's
+            # limited just like the accepted ones
+            reason = self._server._admit()
+            if reason:
+                logging.info('[MUX] Refused stream to %s:%d, reason: %s' % (
+                                                            *dest_af, reason))
+                self._server._shed(reason)
+                self.send_frame(FRAME_CLOSE, stream_id)
+                return
+            stream = MuxStream.connect(self._server, self, stream_id,
+                                       dest_af)
+            if stream:
+                self._streams[stream_id] = stream
+            else:
+                self.send_frame(FRAME_CLOSE, stream_id)
+        else:
+            logging.warn('[MUX] Got invalid frame, type: %d, do close' %
+                                                                    type_)
+            self.close()
+
+    def _on_read(self):
+        received = 0
+        while not self._closed and received < TUNNEL_RECV_BUDGET:
+            try:
+                data = self._server._recv_arena.recv(
+                                    self._sock, self._server._recv_arena.size)
+            except (OSError, IOError) as e:
+                if tools.errno_from_exception(e) in (errno.EAGAIN,
+                                                     errno.EWOULDBLOCK):
+                    break
+                logging.warn('[MUX] Got error from tunnel: %s, do close' % e)
+                self.close()
+                break
+            if not data:
+                logging.info('[MUX] Tunnel closed by peer')
+                self.close()
+                break
+            received += len(data)
+            self._in += self._cryptor.decrypt(data)
+            self._handle_frames()
+            if len(data) < self._server._recv_arena.size:
+                break
+        return received
+
+    def _on_write(self):
+        if not self._connected:
+            self._connected = True
+            logging.info('[MUX] Tunnel to %s:%d connected' %
+                                                self._sock.getpeername())
+        try:
+            while self._out:
+                sent, complete = self._out.send(self._sock)
+                self._server._stats.incr('bytes_sent', sent)
+                self._server._release_buffer(sent)
+                if not complete:
+                    break
+        except (OSError, IOError) as e:
+            if tools.errno_from_exception(e) not in (errno.EAGAIN,
+                                                     errno.EWOULDBLOCK):
+                logging.warn('[MUX] Got error from tunnel: %s, do close' % e)
+                self.close()
+                return
+        self._update_events()
+        if self._waiters and self._out.size <= TUNNEL_LOW_WATERMARK:
+            waiters = self._waiters
+            self._waiters = set()
+            for stream in waiters:
+                stream.resume_reading()
+
+    def handle_event(self, fd, evt):
+        '''
+        :rtype: int, bytes received while handling the events
+        '''
+
+        if self._closed:
+            return 0
+        if evt & select.EPOLLERR:
+            logging.warn('[MUX] Tunnel got EPOLLERR, do close')
+            self.close()
+            return 0
+        received = 0
+        if evt & EPOLL_READ:
+            received = self._on_read()
+        if evt & select.EPOLLOUT and not self._closed:
+            self._on_write()
+        self._server._stats.incr('bytes_received', received)
+        return received
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._server._stats.incr('mux_tunnels', -1)
+        for stream in list(self._streams.values()):
+            stream.close(notify=False)
+        self._streams = {}
+        self._waiters = set()
+        self._server._release_buffer(self._out.size)
+        self._out.clear()
+        self._server._remove_handler(self._fd)
+        self._server._epoll.unregister(self._fd)
+        if self._server._tunnel_profile:
+            self._server._tunnel_profile.record(self._sock)
+        self._sock.close()
+        self._sock = None
+        if self._on_closed:
+            self._on_closed(self)
+
+
+class MuxStream(object):
+
+    '''a TCP connection carried by a tunnel
+
+    On the local side, sock is the accepted connection, on the remote side,
+    sock is the connection to the destination.
+    '''
+
+    def __init__(self, server, tunnel, sock, connecting=False):
+        self._server = server
+        self._tunnel = tunnel
+        self._sock = sock
+        self._fd = sock.fileno()
+        self._stream_id = None
+        self._connecting = connecting
+        # bytes we may send to the peer before it grants more
+        self._send_window = STREAM_WINDOW
+        # bytes sent to our socket and not granted to the peer yet
+        self._consumed = 0
+        self._out = SendQueue()
+        self._paused = False
+        # the peer closed the stream, close after self._out is sent
+        self._closing = False
+        self._closed = False
+        self._connect_timer = None
+        # source address of sock on the remote side, see ir.egress
+        self._egress_addr = None
+        self._idle_timer = None
+        self._idle_timeout = self._server._config.get('tcp_idle_timeout')
+        if self._idle_timeout:
+            self._idle_timer = self._server._timers.call_later(
+                                        self._idle_timeout, self._on_timeout)
+        self._sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        self._sock.setblocking(False)
+        self._events = self._wanted_events()
+        self._server._epoll.register(self._fd, self._events)
+        self._server._add_handler(self._fd, self)
+        self._server._stats.incr('connections')
+        self._server._stats.incr('mux_streams')
+
+    @classmethod
+    def accept(cls, server, tunnel, sock, src):
+        '''carry an accepted connection of the local side over tunnel
+        '''
+
+        dest_af = get_orig_dest_af(sock)
+        stream = cls(server, tunnel, sock)
+        stream._stream_id = tunnel.open_stream(stream, dest_af)
+        logging.info('[MUX] Stream %d from %s:%d to %s:%d' % (
+                                        stream._stream_id, *src, *dest_af))
+        return stream
+
+    @classmethod
+    def _new_sock(cls, server):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if server._dest_profile:
+            server._dest_profile.apply(sock)
+        sock.setblocking(False)
+        return sock
+
+    @classmethod
+    def connect(cls, server, tunnel, stream_id, dest_af):
+        '''connect to the destination of a stream opened by the local side
+
+        :rtype: MuxStream, None if failed
+        '''
+
+        egress_addr = None
+        try:
+            if server._egress:
+                # the next source address is tried if one is out of ports
+                sock, egress_addr = server._egress.connect(
+                                    lambda: cls._new_sock(server), dest_af)
+            else:
+                sock = cls._new_sock(server)
+                try:
+                    sock.connect(dest_af)
+                except (OSError, IOError) as e:
+                    if tools.errno_from_exception(e) != errno.EINPROGRESS:
+                        sock.close()
+                        raise
+        except (OSError, IOError) as e:
+            logging.warn('[MUX] Cannot connect to %s:%d: %s' % (
+                                                        dest_af + (e,)))
+            return None
+        stream = cls(server, tunnel, sock, connecting=True)
+        stream._stream_id = stream_id
+        stream._egress_addr = egress_addr
+        connect_timeout = server._config.get('tcp_connect_timeout') or 10
+        stream._connect_timer = server._timers.call_later(
+                                    connect_timeout, stream._on_timeout)
+        logging.info('[MUX] Stream %d connecting to %s:%d' % (stream_id,
+                                                              *dest_af))
+        return stream
+
+    def _wanted_events(self):
+        events = select.EPOLLERR
+        if not (self._paused or self._connecting):
+            events |= EPOLL_READ
+        if self._out or self._connecting:
+            events |= select.EPOLLOUT
+        return events
+
+    def _update_events(self):
+        events = self._wanted_events()
+        if events != self._events:
+            self._server._epoll.modify(self._fd, events)
+            self._events = events
+
+    def _on_timeout(self):
+        logging.info('[MUX] Stream %d timeout, do close' % self._stream_id)
+        self.close()
+
+    def _pause_reading(self):
+        self._paused = True
+        self._update_events()
+
+    def resume_reading(self):
+        '''called by the tunnel when it's drained
+        '''
+
+        if self._closed or self._send_window <= 0:
+            return
+        self._paused = False
+        self._update_events()
+
+    def _on_read(self):
+        received = 0
+        while not (self._closed or self._paused):
+            if self._send_window <= 0:
+                self._server._stats.incr('mux_window_stalls')
+                self._pause_reading()
+                break
+            if self._tunnel.congested:
+                self._tunnel.wait_for_drain(self)
+                self._pause_reading()
+                break
+            size = min(self._send_window, STREAM_RECV_SIZE)
+            try:
+                data = self._server._recv_arena.recv(self._sock, size)
+            except (OSError, IOError) as e:
+                if tools.errno_from_exception(e) in (errno.EAGAIN,
+                                                     errno.EWOULDBLOCK):
+                    break
+                self.close()
+                break
+            if not data:
+                self.close()
+                break
+            received += len(data)
+            self._send_window -= len(data)
+            self._tunnel.send_frame(FRAME_DATA, self._stream_id, data)
+            if self._idle_timer:
+                self._idle_timer.rearm(self._idle_timeout)
+            if len(data) < size:
+                break
+        return received
+
+    def _on_write(self):
+        if self._connecting:
+            self._connecting = False
+            if self._connect_timer:
+                self._connect_timer.cancel()
+                self._connect_timer = None
+        sent_total = 0
+        try:
+            while self._out:
+                sent, complete = self._out.send(self._sock)
+                sent_total += sent
+                if not complete:
+                    break
+        except (OSError, IOError) as e:
+            if tools.errno_from_exception(e) not in (errno.EAGAIN,
+                                                     errno.EWOULDBLOCK):
+                self.close()
+                return
+        finally:
+            self._server._stats.incr('bytes_sent', sent_total)
+            self._server._release_buffer(sent_total)
+        if self._closing and not self._out:
+            self.close(notify=False)
+            return
+        self._consumed += sent_total
+        if self._consumed >= STREAM_WINDOW // 2:
+            self._tunnel.send_frame(FRAME_WINDOW, self._stream_id,
+                                    WINDOW_INCREMENT.pack(self._consumed))
+            self._consumed = 0
+        self._update_events()
+
+    def on_data(self, data):
+        self._out.append(data)
+        self._server._buffered_bytes += len(data)
+        if self._idle_timer:
+            self._idle_timer.rearm(self._idle_timeout)
+        if not self._connecting:
+            self._on_write()
+
+    def on_window(self, increment):
+        self._send_window += increment
+        if self._paused:
+            # it will wait for the tunnel if the tunnel is congested
+            self.resume_reading()
+
+    def on_close(self):
+        self._closing = True
+        if not self._out:
+            self.close(notify=False)
+
+    def handle_event(self, fd, evt):
+        '''
+        :rtype: int, bytes received while handling the events
+        '''
+
+        if self._closed:
+            return 0
+        if evt & select.EPOLLERR:
+            self.close()
+            return 0
+        received = 0
+        if evt & select.EPOLLOUT:
+            self._on_write()
+        if evt & EPOLL_READ and not self._closed:
+            received = self._on_read()
+        self._server._stats.incr('bytes_received', received)
+        return received
+
+    def close(self, notify=True):
+        '''
+        :param notify: send a CLOSE frame to the peer
+        '''
+
+        if self._closed:
+            return
+        self._closed = True
+        if notify and not self._tunnel.closed:
+            self._tunnel.send_frame(FRAME_CLOSE, self._stream_id)
+        self._tunnel.remove_stream(self._stream_id)
+        self._server._stats.incr('connections', -1)
+        self._server._release_buffer(self._out.size)
+        self._out.clear()
+        if self._idle_timer:
+            self._idle_timer.cancel()
+        if self._connect_timer:
+            self._connect_timer.cancel()
+        if self._egress_addr:
+            self._server._egress.release(self._egress_addr)
+            self._egress_addr = None
+        self._server._remove_handler(self._fd)
+        self._server._epoll.unregister(self._fd)
+        if self._server._dest_profile:
+            self._server._dest_profile.record(self._sock)
+        self._sock.close()
+        self._sock = None
+        logging.debug('[MUX] Stream %s closed' % self._stream_id)
+
+
+class MuxClient(object):
+
+    '''keep the tunnels of the local side, and put new connections on them
+    '''
+
+    def __init__(self, server, af, tunnels):
+        self._server = server
+        self._config = server._config
+        self._af = af
+        self._size = tunnels
+        self._tunnels = []
+        self._check_timer = None
+
+    def start(self):
+        self._fill()
+        self._check_timer = self._server._timers.call_later(
+                                        TUNNEL_CHECK_INTERVAL, self._check)
+        logging.info('[MUX] Keeping %d tunnels to %s:%d' % (self._size,
+                                                           *self._af))
+
+    def stop(self):
+        if self._check_timer:
+            self._check_timer.cancel()
+            self._check_timer = None
+
+    def _open_tunnel(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self._server._tunnel_profile:
+            self._server._tunnel_profile.apply(sock)
+        sock.setblocking(False)
+        try:
+            sock.connect(self._af)
+        except (OSError, IOError) as e:
+            if tools.errno_from_exception(e) != errno.EINPROGRESS:
+                logging.warn('[MUX] Cannot connect to %s:%d: %s' % (
+                                                            *self._af, e))
+                sock.close()
+                return False
+        iv = os.urandom(self._config.get('iv_len') or 32)
+        cryptor = Cryptor(self._config.get('cipher_name'),
+                          self._config.get('passwd'),
+                          self._config.get('crypto_libpath'),
+                          iv)
+        tunnel = Tunnel(self._server, sock, cryptor, True,
+                        self._on_tunnel_closed)
+        tunnel.send_raw(PacketMaker.make_tcp_fpacket(
+                                            b'', MUX_DEST_AF, iv, cryptor,
+                                            self._server._iv_cryptor))
+        self._tunnels.append(tunnel)
+        return True
+
+    def _fill(self):
+        # a tunnel that is going away is replaced at once, the new one
+        # connects to the process that took over the remote's socket
+        while (len([t for t in self._tunnels if not t.going_away]) <
+                self._size):
+            if not self._open_tunnel():
+                break
+
+    def _on_tunnel_closed(self, tunnel):
+        if tunnel in self._tunnels:
+            self._tunnels.remove(tunnel)
+
+    def _check(self):
+        connect_timeout = self._config.get('tcp_connect_timeout') or 10
+        now = time.time()
+        for tunnel in list(self._tunnels):
+            if (not tunnel.connected and
+                    now - tunnel.created_at >= connect_timeout):
+                logging.warn('[MUX] Connecting tunnel timeout, do close')
+                tunnel.close()
+        self._fill()
+        self._check_timer = self._server._timers.call_later(
+                                        TUNNEL_CHECK_INTERVAL, self._check)
+
+    def new_stream(self, sock, src):
+        '''carry sock over the tunnel with the fewest streams
+
+        :rtype: MuxStream, None if there is no tunnel
+        '''
+
+        tunnels = [t for t in self._tunnels if not t.going_away]
+        tunnels = [t for t in tunnels if t.connected] or tunnels
+        if not tunnels:
+            return None
+        tunnel = min(tunnels, key=lambda t: t.stream_count)
+        return MuxStream.accept(self._server, tunnel, sock, src)
@@ -0,0 +1,183 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import time
+import errno
+import select
+import socket
+import logging
+from collections import OrderedDict
+
+from ir import tools
+
+
+__all__ = ['ConnectionPool']
+
+
+'''Keep some connections to the remote established in advance
+
+A new TCPHandler on the local side takes a connection from the pool
+instead of connecting to the remote, so it doesn't wait for a handshake.
+The pool is refilled in the background.
+
+The remote never speaks first, so an idle connection that becomes
+readable has been closed (or broken) by the remote, it's dropped at once.
+Idle connections are also dropped when they are older than max_idle,
+before the remote or a middlebox times them out.
+'''
+
+
+POOL_CHECK_INTERVAL = 1
+
+# max seconds a connection stays in the pool
+POOL_MAX_IDLE = 30
+
+EPOLL_CONNECTING = select.EPOLLOUT | select.EPOLLERR | select.EPOLLRDHUP
+EPOLL_IDLE = select.EPOLLIN | select.EPOLLERR | select.EPOLLRDHUP
+
+
+def _healthy(sock):
+    '''check if a idle connection is still usable, without blocking
+    '''
+
+    try:
+        # a usable connection has nothing to read
+        sock.recv(1, socket.MSG_PEEK)
+        return False
+    except (OSError, IOError) as e:
+        if tools.errno_from_exception(e) not in (errno.EAGAIN,
+                                                 errno.EWOULDBLOCK):
+            return False
+    return not sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+
+class ConnectionPool(object):
+
+    '''a pool of connected sockets to af, driven by the server's epoll
+    and timers
+
+    The pool registers its sockets as a handler of the server, so the
+    events of them come back to ConnectionPool.handle_event.
+    '''
+
+    def __init__(self, server, af, size, max_idle=None, connect_timeout=10):
+        self._server = server
+        self._af = af
+        self._size = size
+        self._max_idle = max_idle or POOL_MAX_IDLE
+        self._connect_timeout = connect_timeout
+        self._stats = server._stats
+        # {fd: (sock, time the connect started)}
+        self._connecting = {}
+        # {fd: (sock, time the connection established)}, oldest first
+        self._idle = OrderedDict()
+        self._check_timer = None
+
+    @property
+    def idle_count(self):
+        return len(self._idle)
+
+    def start(self):
+        self._fill()
+        self._check_timer = self._server._timers.call_later(
+                                        POOL_CHECK_INTERVAL, self._check)
+        logging.info('[POOL] Keeping %d connections to %s:%d' % (
+                                                    self._size, *self._af))
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        if self._server._tunnel_profile:
+            self._server._tunnel_profile.apply(sock)
+        sock.setblocking(False)
+        try:
+            sock.connect(self._af)
+        except (OSError, IOError) as e:
+            if tools.errno_from_exception(e) != errno.EINPROGRESS:
+                logging.warn('[POOL] Cannot connect to %s:%d: %s' % (
+                                                            *self._af, e))
+                sock.close()
+                return False
+        fd = sock.fileno()
+        self._connecting[fd] = (sock, time.time())
+        self._server._epoll.register(fd, EPOLL_CONNECTING)
+        self._server._add_handler(fd, self)
+        return True
+
+    def _fill(self):
+        while len(self._connecting) + len(self._idle) < self._size:
+            if not self._connect():
+                break
+
+    def _remove(self, fd):
+        if fd in self._connecting:
+            sock, _ = self._connecting.pop(fd)
+        else:
+            sock, _ = self._idle.pop(fd)
+        self._server._remove_handler(fd)
+        self._server._epoll.unregister(fd)
+        return sock
+
+    def _check(self):
+        now = time.time()
+        for fd, (sock, started_at) in list(self._connecting.items()):
+            if now - started_at >= self._connect_timeout:
+                self._remove(fd).close()
+                self._stats.incr('pool_connect_failed')
+        for fd, (sock, established_at) in list(self._idle.items()):
+            if now - established_at < self._max_idle:
+                # the others are newer
+                break
+            self._remove(fd).close()
+            self._stats.incr('pool_expired')
+        self._fill()
+        self._check_timer = self._server._timers.call_later(
+                                        POOL_CHECK_INTERVAL, self._check)
+
+    def handle_event(self, fd, evt):
+        '''
+        :rtype: int, bytes received, always 0
+        '''
+
+        if fd in self._connecting:
+            if evt & (select.EPOLLERR | select.EPOLLHUP | select.EPOLLRDHUP):
+                # try again in the next check, not in a tight loop
+                self._remove(fd).close()
+                self._stats.incr('pool_connect_failed')
+                return 0
+            sock, _ = self._connecting.pop(fd)
+            self._idle[fd] = (sock, time.time())
+            self._server._epoll.modify(fd, EPOLL_IDLE)
+        elif fd in self._idle:
+            self._remove(fd).close()
+            self._stats.incr('pool_dropped')
+            self._fill()
+        return 0
+
+    def take(self):
+        '''take a connected socket out of the pool, the caller registers it
+        in epoll by itself
+
+        :rtype: socket, None if there is no usable one
+        '''
+
+        sock = None
+        while self._idle:
+            fd = next(iter(self._idle))
+            sock = self._remove(fd)
+            if _healthy(sock):
+                break
+            sock.close()
+            sock = None
+            self._stats.incr('pool_dropped')
+        self._stats.incr('pool_hits' if sock else 'pool_misses')
+        self._fill()
+        return sock
+
+    def close(self):
+        self._size = 0
+        if self._check_timer:
+            self._check_timer.cancel()
+            self._check_timer = None
+        for fd in list(self._connecting) + list(self._idle):
+            self._remove(fd).close()
@@ -9,7 +9,8 @@ from ir.crypto import Cryptor
 from ir.tools import HashTools
 
 
-__all__ = ['PacketMaker', 'PacketParser', 'IVManager']
+__all__ = ['PacketMaker', 'PacketParser', 'IVManager',
+           'MUX_DEST_AF', 'STRIPE_DEST_AF']
 
 
 '''Protocol of IR
@@ -69,6 +70,14 @@ TCP Comment:
         If the mac from calculation is not equal to the mac from PAYLOAD.
         Remote server should close the connection and destroy this TCPHandler.
 
+    Multiplexing:
+        If DEST.AF of the first packet is MUX_DEST_AF, the connection is a
+        tunnel that carries multiple streams, see ir.mux.
+
+    Striping:
+        If DEST.AF of the first packet is STRIPE_DEST_AF, the connection is
+        one of several that carry a single stream together, see ir.stripe.
+
 
 UDP Packet Format (before encrypt):
     +--------------------+-----------------------+
@@ -317,6 +326,13 @@ Field Description:
 '''
 
 
+# destination of the first packet of a mux tunnel
+MUX_DEST_AF = ('0.0.0.0', 0)
+
+# destination of the first packet of a stripe
+STRIPE_DEST_AF = ('0.0.0.0', 1)
+
+
 class PacketMaker(object):
 
     @classmethod
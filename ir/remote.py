@@ -3,9 +3,13 @@
 
 
 from ir.server import TCPServer, UDPServer
+from ir.aio import AioTCPServer, AioUDPServer
+from ir.uring import URingTCPServer
 
 
-__all__ = ['RemoteTCPServer', 'RemoteUDPServer']
+__all__ = ['RemoteTCPServer', 'RemoteUDPServer',
+           'RemoteAioTCPServer', 'RemoteAioUDPServer',
+           'RemoteURingTCPServer']
 
 
 class RemoteTCPServer(TCPServer):
@@ -16,3 +20,18 @@ class RemoteTCPServer(TCPServer):
 class RemoteUDPServer(UDPServer):
 
     _is_local = False
+
+
+class RemoteAioTCPServer(AioTCPServer):
+
+    _is_local = False
+
+
+class RemoteAioUDPServer(AioUDPServer):
+
+    _is_local = False
+
+
+class RemoteURingTCPServer(URingTCPServer):
+
+    _is_local = False
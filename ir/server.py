@@ -2,22 +2,30 @@
 # coding: utf-8
 
 import sys
+import time
 import errno
 import logging
 import select
 import socket
-import time
-from threading import Thread
-
-from ir import tools
-from ir.handler import TCPHandler, UDPHandler, UDPMultiTransmitHandler
+import struct
+from collections import OrderedDict
+
+from ir import tools, handover
+from ir.handler import (TCPHandler, UDPHandler, UDPMultiTransmitHandler,
+                        RECV_SIZE_MAX)
+from ir.mux import Tunnel
+from ir.stripe import StripedFlow
 from ir.crypto import Cryptor, preload_crypto_lib
+from ir.egress import EgressPool
+from ir.tuning import load_profiles
+from ir.gcmanager import GCManager
 from ir.protocol import IVManager, PacketParser
+from ir.stats import Stats
+from ir.timer import TimerWheel
 
 
 __all__ = ['TCPServer',
            'UDPServer',
-           'ExpiredUDPSocketCleaner',
            'SrcExclusiveItems']
  
 
@@ -25,18 +33,67 @@ POLL_TIMEOUT = 4
 
 IP_TRANSPARENT = 19
 IP_RECVORIGDSTADDR = 20
+TCP_FASTOPEN = 23
+
+# max pending fast open requests that have not finished the handshake
+FAST_OPEN_QUEUE_LEN = 1024
 
 UDP_BUFFER_SIZE = 65536
 
+# size of the buffer that all the sockets of a server receive into,
+# no less than any buf_size passed to recv
+RECV_ARENA_SIZE = max(RECV_SIZE_MAX, UDP_BUFFER_SIZE)
+
+TCP_INFO_SIZE = 104
+
+# default budgets of one event loop iteration, in bytes and seconds
+SCHED_BYTE_BUDGET = 1048576
+SCHED_TIME_BUDGET = 0.02
+
+# events that handled less bytes are counted as interactive
+INTERACTIVE_BYTES = 4096
+
+# bounds of the dispatch delay histograms, in milliseconds
+DISPATCH_DELAY_BOUNDS = (1, 5, 20, 100, 500)
+
+# interval of copying counters to the shared memory of the supervisor
+SHARED_STATS_INTERVAL = 1
+
+# fds kept for listening sockets, epoll, logs and so on
+FD_RESERVE = 64
+
+HANDOVER_CHECK_INTERVAL = 0.5
+DRAIN_CHECK_INTERVAL = 1
+DRAIN_TIMEOUT = 60
+
 
 class ServerMixin(object):
 
     # mark the server type
     _is_local = False
 
-    def __init__(self, config_path):
+    def __init__(self, config_path, worker_id=0):
         self._config = self._read_config(config_path)
-        self._local_sock = self._init_socket()
+        self._worker_id = worker_id
+        self._stats = Stats('%s worker %d' % (self.__class__.__name__,
+                                              worker_id))
+        # timers of handlers, such as idle timeouts and connect timeouts
+        self._timers = TimerWheel()
+        # ready events that are not handled yet, {fd: [events, ready_time]}
+        self._pending_events = OrderedDict()
+        self._shared_stats = None
+        self._shared_stats_slot = None
+        self._handover_sock = None
+        self._fd_limit = tools.set_nofile_limit(
+                                    self._config.get('max_open_files'))
+        # total size of data stored in handlers, waiting for sending
+        self._buffered_bytes = 0
+        self._recv_arena = tools.RecvArena(RECV_ARENA_SIZE)
+        # source addresses of outbound sockets, remote side only
+        self._egress = self._init_egress()
+        # ir.tuning.TuningProfile of tunnel and destination sockets
+        self._tunnel_profile, self._dest_profile = self._init_tuning()
+        self._local_sock = self._take_over_socket() or self._init_socket()
         self._local_sock_fd = self._local_sock.fileno()
         self._epoll = select.epoll()
         self._epoll.register(self._local_sock_fd, self._poll_mode)
@@ -44,6 +101,22 @@ class ServerMixin(object):
     def _read_config(self, config_path):
         return tools.Initer.init_from_config_file(config_path)
 
+    def _init_egress(self):
+        addrs = self._config.get('egress_addrs')
+        if self._is_local or not addrs:
+            return None
+        if not isinstance(addrs, list):
+            raise Exception('Format of egress_addrs is invalid')
+        logging.info('[EGRESS] Binding outbound sockets to %s' %
+                                                        ', '.join(addrs))
+        return EgressPool(addrs, self._config.get('egress_policy'),
+                          self._stats)
+
+    def _init_tuning(self):
+        if self._sock_type != socket.SOCK_STREAM:
+            return None, None
+        return load_profiles(self._config, self._stats)
+
     def _add_handler(self, fd, handler):
         # in tcp mode, a handler will have multiple fd
         # in udp mode, handlers only have the client_socket's fd
@@ -51,6 +124,8 @@ class ServerMixin(object):
 
     def _remove_handler(self, fd):
         del self._fd_2_handler[fd]
+        # the fd may be reused by another handler
+        self._pending_events.pop(fd, None)
 
     def _before_run(self):
         pass
@@ -58,17 +133,192 @@ class ServerMixin(object):
     def _after_run(self):
         pass
 
+    def _collect_stats(self):
+        # update the counters that are not maintained in the event loop
+        self._stats.set('buffered_bytes', self._buffered_bytes)
+        if self._egress:
+            self._egress.collect_stats()
+
+    def _admit(self):
+        '''check if the server can take a new connection or a new flow
+
+        :rtype: str, the reason of refusing, None if it's admitted
+        '''
+
+        raise NotImplementedError()
+
+    def _shed(self, reason):
+        self._stats.incr('shed')
+        self._stats.incr('shed_%s' % reason)
+
+    def _log_stats(self, interval):
+        self._collect_stats()
+        self._stats.log()
+        self._timers.call_later(interval, self._log_stats, interval)
+
+    def _publish_stats(self):
+        self._collect_stats()
+        self._shared_stats.publish(self._shared_stats_slot, self._stats)
+        self._timers.call_later(SHARED_STATS_INTERVAL, self._publish_stats)
+
+    def share_stats(self, shared_stats, slot):
+        '''copy counters to slot of a ir.supervisor.SharedStats periodically
+        '''
+
+        self._shared_stats = shared_stats
+        self._shared_stats_slot = slot
+
+    def _start_stats_logging(self):
+        interval = self._config.get('stats_log_interval')
+        if interval:
+            self._timers.call_later(interval, self._log_stats, interval)
+        if self._shared_stats:
+            self._timers.call_later(SHARED_STATS_INTERVAL,
+                                    self._publish_stats)
+
+    def _handover_path(self):
+        path = self._config.get('handover_path')
+        if path:
+            return '%s.%s.%d' % (path, self._proto, self._worker_id)
+        return None
+
+    def _take_over_socket(self):
+        '''receive the listening socket from the process we are replacing
+
+        :rtype: socket, None if there is no such process
+        '''
+
+        path = self._handover_path()
+        if not path:
+            return None
+        sock = handover.receive_socket(path, self._sock_type)
+        if sock:
+            logging.info('[HANDOVER] Took over the %s listening socket' %\
+                                                                self._proto)
+        return sock
+
+    def _listen_handover(self):
+        path = self._handover_path()
+        if path:
+            self._handover_sock = handover.listen(path)
+            self._timers.call_later(HANDOVER_CHECK_INTERVAL,
+                                    self._check_handover)
+
+    def _check_handover(self):
+        # A non-blocking accept every HANDOVER_CHECK_INTERVAL is cheaper
+        # than watching the socket in every kind of event loop.
+        try:
+            conn, _ = self._handover_sock.accept()
+        except (OSError, IOError):
+            self._timers.call_later(HANDOVER_CHECK_INTERVAL,
+                                    self._check_handover)
+            return
+        try:
+            handover.send_socket(conn, self._local_sock)
+        except (OSError, IOError) as e:
+            logging.warn('[HANDOVER] Failed to send the socket: %s' % e)
+            self._timers.call_later(HANDOVER_CHECK_INTERVAL,
+                                    self._check_handover)
+            return
+        finally:
+            conn.close()
+        # the path belongs to the new process now, don't unlink it
+        self._handover_sock.close()
+        self._handover_sock = None
+        self._stop_accepting()
+        drain_timeout = self._config.get('handover_drain_timeout')
+        if drain_timeout is None:
+            drain_timeout = DRAIN_TIMEOUT
+        logging.info('[HANDOVER] Listening socket handed over, draining')
+        self._check_drained(time.time() + drain_timeout)
+
+    def _stop_accepting(self):
+        self._epoll.unregister(self._local_sock_fd)
+        self._pending_events.pop(self._local_sock_fd, None)
+
+    def _busy(self):
+        raise NotImplementedError()
+
+    def _check_drained(self, deadline):
+        if not self._busy():
+            logging.info('[HANDOVER] All handlers finished, exit')
+            self.shutdown()
+        elif time.time() >= deadline:
+            logging.warn('[HANDOVER] Drain timeout, exit')
+            self.shutdown()
+        else:
+            self._timers.call_later(DRAIN_CHECK_INTERVAL,
+                                    self._check_drained, deadline)
+
+    def reschedule(self, fd, evt, ready_time=None):
+        '''queue an event of fd to be handled in the event loop
+
+        Handlers call it when they stopped working on a socket before it's
+        drained, because they have used up their share of the iteration.
+        '''
+
+        pending = self._pending_events.get(fd)
+        if pending:
+            pending[0] |= evt
+        else:
+            self._pending_events[fd] = [evt, ready_time or time.time()]
+
+    def _dispatch_events(self):
+        # Serve the ready fds in FIFO order until the budgets are used up,
+        # the rest are left for the next iteration. Handlers that have more
+        # work to do are queued again behind the others, so a bulk transfer
+        # cannot hold up the interactive connections for long.
+        if self._sched_time_budget:
+            deadline = time.time() + self._sched_time_budget
+        handled_bytes = 0
+        while self._pending_events:
+            fd, (evt, ready_time) = self._pending_events.popitem(last=False)
+            start = time.time()
+            n = self.handle_event(fd, evt) or 0
+            handled_bytes += n
+            delay = int((start - ready_time) * 1000)
+            if n < INTERACTIVE_BYTES:
+                self._stats.observe('dispatch_delay_ms_interactive', delay,
+                                    DISPATCH_DELAY_BOUNDS)
+            else:
+                self._stats.observe('dispatch_delay_ms_bulk', delay,
+                                    DISPATCH_DELAY_BOUNDS)
+            if not self._pending_events:
+                break
+            if ((self._sched_byte_budget and
+                        handled_bytes >= self._sched_byte_budget) or
+                    (self._sched_time_budget and time.time() >= deadline)):
+                self._stats.incr('sched_budget_exhausted')
+                self._stats.incr('sched_deferred_events',
+                                 len(self._pending_events))
+                break
+
     def run(self):
         preload_crypto_lib(self._config.get('cipher_name'),
                            self._config.get('crypto_libpath'))
         self._before_run()
+        self._start_stats_logging()
+        self._listen_handover()
+        GCManager(self._config, self._stats, self._timers).start()
+        self._sched_byte_budget = self._config.get('sched_byte_budget',
+                                                   SCHED_BYTE_BUDGET)
+        self._sched_time_budget = self._config.get('sched_time_budget',
+                                                   SCHED_TIME_BUDGET)
         self.__running = True
         try:
             while self.__running:
-                events = self._epoll.poll(POLL_TIMEOUT)
+                if self._pending_events:
+                    # don't wait, there is work left from last iteration
+                    timeout = 0
+                else:
+                    timeout = self._timers.next_timeout(POLL_TIMEOUT)
+                events = self._epoll.poll(timeout)
                 logging.debug('[EVT] Events from epoll: %s' % str(events))
+                now = time.time()
                 for fd, evt in events:
-                    self.handle_event(fd, evt)
+                    self.reschedule(fd, evt, now)
+                self._dispatch_events()
+                self._timers.advance()
         except KeyboardInterrupt:
             self.shutdown()
         self._after_run()
@@ -79,11 +329,19 @@ class ServerMixin(object):
 
 class TCPServer(ServerMixin):
 
+    _proto = 'tcp'
+    _sock_type = socket.SOCK_STREAM
     _poll_mode = select.EPOLLIN | select.EPOLLRDHUP | select.EPOLLERR
 
     # store tcp connection handlers, {fd: handler}
     _fd_2_handler = {}
 
+    # ir.pool.ConnectionPool of connections to the remote, local side only
+    _conn_pool = None
+
+    # ir.balancer.RemoteBalancer of tcp_multi_remote, local side only
+    _remotes = None
+
     def _before_run(self):
         # initialize a iv_cryptor with default iv
         self._iv_cryptor = Cryptor(self._config.get('cipher_name'),
@@ -92,6 +350,111 @@ class TCPServer(ServerMixin):
                                    reset_mode=True)
         logging.info('[TCP] Initialized cipher with method: %s'\
                                     % self._config.get('cipher_name'))
+        # max number of connections accepted in one EPOLLIN event
+        self._accept_budget = self._config.get('tcp_accept_budget') or 64
+        self._max_connections = self._config.get('tcp_max_connections')
+        self._max_buffered_bytes = self._config.get('max_buffered_bytes')
+        # handlers stopped reading because of max_buffered_bytes
+        self._buffer_budget_waiters = set()
+        # set by the first handler that finds TCP fast open disabled by
+        # the kernel, the others don't try it again
+        self._fast_open_disabled = False
+        # the same for MSG_ZEROCOPY
+        self._zerocopy_disabled = False
+        # ir.stripe.StripedFlow of the remote side, {flow id: flow}
+        self._stripe_flows = {}
+        # ir.mux.Tunnel accepted by the remote
+        self._mux_tunnels = set()
+        # ids of the flows that have ended, {flow id: time it ended}, so
+        # their late stripes won't start them again
+        self._ended_stripe_flows = OrderedDict()
+        if (self._config.get('tcp_stripe') and not self._is_local and
+                (self._config.get('tcp_workers') or 1) > 1):
+            logging.warn('[TCP] The stripes of a flow may be accepted by '
+                         'different workers, set tcp_workers to 1')
+        self._listen_overflows_base = tools.read_netstat_counter(
+                                            'TcpExt', 'ListenOverflows')
+
+    def _stop_accepting(self):
+        ServerMixin._stop_accepting(self)
+        # the new process has its own reference of the socket
+        self._local_sock.close()
+        # the local would keep opening streams on our tunnels
+        for tunnel in list(self._mux_tunnels):
+            tunnel.go_away()
+
+    def _busy(self):
+        return self._stats.get('connections') > 0
+
+    @property
+    def _accepted_profile(self):
+        # accepted connections come from the clients on the local side,
+        # from the local side on the remote
+        return self._dest_profile if self._is_local else self._tunnel_profile
+
+    @property
+    def _connected_profile(self):
+        return self._tunnel_profile if self._is_local else self._dest_profile
+
+    def _new_handler(self, conn, src):
+        return TCPHandler(self, conn, src, self._epoll,
+                          self._config, self._is_local)
+
+    def _accept_tunnel(self, sock, cryptor, data):
+        '''take over a connection that turned out to be a mux tunnel
+        '''
+
+        logging.info('[MUX] Accepted tunnel from %s:%d' % sock.getpeername())
+        tunnel = Tunnel(self, sock, cryptor, False, self._mux_tunnels.discard)
+        self._mux_tunnels.add(tunnel)
+        tunnel.start(data)
+
+    def _accept_stripe(self, sock, cryptor, data):
+        '''take over a connection that turned out to be a stripe
+        '''
+
+        StripedFlow.join(self, sock, cryptor, data)
+
+    def _over_buffer_budget(self):
+        return bool(self._max_buffered_bytes and
+                    self._buffered_bytes >= self._max_buffered_bytes)
+
+    def _wait_for_buffer_budget(self, handler):
+        self._buffer_budget_waiters.add(handler)
+
+    def _release_buffer(self, n):
+        '''called by handlers when n bytes of their stored data are taken
+        '''
+
+        self._buffered_bytes -= n
+        # resume the waiters when the total is below 3/4 of the budget,
+        # so they won't be paused again at once
+        if (self._buffer_budget_waiters and self._buffered_bytes <=
+                self._max_buffered_bytes - self._max_buffered_bytes // 4):
+            waiters = self._buffer_budget_waiters
+            self._buffer_budget_waiters = set()
+            for handler in waiters:
+                handler.resume_reading()
+
+    def _admit(self):
+        connections = self._stats.get('connections')
+        if self._max_connections and connections >= self._max_connections:
+            return 'connections'
+        if (self._max_buffered_bytes and
+                self._buffered_bytes >= self._max_buffered_bytes):
+            return 'buffered_bytes'
+        # every connection has 2 sockets
+        if connections * 2 + FD_RESERVE >= self._fd_limit:
+            return 'fds'
+        return None
+
+    def _collect_stats(self):
+        ServerMixin._collect_stats(self)
+        overflows = tools.read_netstat_counter('TcpExt', 'ListenOverflows')
+        if overflows is not None and self._listen_overflows_base is not None:
+            # this counter comes from the kernel and it's system-wide
+            self._stats.set('listen_overflows',
+                            overflows - self._listen_overflows_base)
 
     def _init_socket(self, listen_addr=None, listen_port=None, so_backlog=1024):
         listen_addr = listen_addr or self._config['listen_addr']
@@ -104,7 +467,21 @@ class TCPServer(ServerMixin):
         af, stype, proto, canname, sa = addr_info[0]
         sock = socket.socket(af, stype, proto)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if (self._config.get('tcp_workers') or 1) > 1:
+            # every worker process binds its own listening socket,
+            # the kernel spreads new connections among them
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        if self._config.get('tcp_fast_open') and not self._is_local:
+            # accept the data in the SYNs from the local side,
+            # net.ipv4.tcp_fastopen must have the server bit (2) set
+            sock.setsockopt(socket.SOL_TCP, TCP_FASTOPEN,
+                            FAST_OPEN_QUEUE_LEN)
+        # accepted sockets inherit the buffers and the congestion control,
+        # the window scale in the SYN-ACK is chosen by the buffers here
+        profile = self._accepted_profile
+        if profile:
+            profile.apply(sock)
         sock.setblocking(False)
         sock.bind(sa)
         sock.listen(so_backlog)
@@ -113,30 +490,63 @@ class TCPServer(ServerMixin):
                                     self._config['listen_tcp_port']))
         return sock
 
+    def _listen_queue_len(self):
+        # for a listening socket, tcpi_unacked is the length of accept queue
+        info = self._local_sock.getsockopt(socket.SOL_TCP, socket.TCP_INFO,
+                                           TCP_INFO_SIZE)
+        return struct.unpack_from('I', info, 24)[0]
+
+    def _accept_connections(self):
+        conns = []
+        while len(conns) < self._accept_budget:
+            try:
+                conns.append(self._local_sock.accept())
+            except (OSError, IOError) as e:
+                error_no = tools.errno_from_exception(e)
+                if error_no not in (errno.EAGAIN, errno.EINPROGRESS,
+                                    errno.EWOULDBLOCK):
+                    logging.warn('[TCP] Failed to accept connection: %s' % e)
+                break
+        return conns
+
     def handle_event(self, fd, evt):
         handler = self._fd_2_handler.get(fd)
         if fd == self._local_sock_fd and not handler:
-            try:
-                conn, src = self._local_sock.accept()
+            conns = self._accept_connections()
+            self._stats.incr('accept_wakeups')
+            self._stats.incr('accepted', len(conns))
+            self._stats.max('accept_max_batch', len(conns))
+            if len(conns) >= self._accept_budget:
+                # the backlog is not drained, the rest will be accepted in
+                # next iteration of the event loop
+                self._stats.incr('accept_budget_exhausted')
+                self._stats.max('accept_max_queue_len',
+                                self._listen_queue_len())
+            for conn, src in conns:
+                reason = self._admit()
+                if reason:
+                    # refuse it quickly instead of letting it wait for
+                    # a response that will never come
+                    logging.info('[TCP] Refused connection from %s:%d, '
+                                 'reason: %s' % (*src, reason))
+                    self._shed(reason)
+                    tools.reset_connection(conn)
+                    continue
                 logging.info('[TCP] Accepted connection from %s:%d, fd: %d' %\
                                                         (*src, conn.fileno()))
-                TCPHandler(self, conn, src, self._epoll,
-                           self._config, self._is_local)
-            except (OSError, IOError) as e:
-                error_no = tools.errno_from_exception(e)
-                if error_no in (errno.EAGAIN, errno.EINPROGRESS,
-                                errno.EWOULDBLOCK):
-                    return
+                self._new_handler(conn, src)
         else:
             handler = self._fd_2_handler.get(fd)
             if handler:
-                handler.handle_event(fd, evt)
+                return handler.handle_event(fd, evt)
             else:
                 logging.warn('[TCP] fd removed')
 
 
 class UDPServer(ServerMixin):
 
+    _proto = 'udp'
+    _sock_type = socket.SOCK_DGRAM
     _poll_mode = select.EPOLLIN | select.EPOLLERR
 
     # store udp relay handlers, {fd: handler}
@@ -158,6 +568,8 @@ class UDPServer(ServerMixin):
             del self._fd_2_handler[fd]
         if key in self._key_2_handler:
             del self._key_2_handler[key]
+        if fd is not None:
+            self._pending_events.pop(fd, None)
         if (hasattr(self, '_src_port_2_handler') and
                 src_port in self._src_port_2_handler):
             del self._src_port_2_handler[src_port]
@@ -165,6 +577,12 @@ class UDPServer(ServerMixin):
     def _init_socket(self, listen_addr=None, listen_port=None):
         listen_addr = listen_addr or self._config['listen_addr']
         listen_port = listen_port or self._config['listen_udp_port']
+        workers = self._config.get('udp_workers') or 1
+        if not self._is_local:
+            # Every remote worker has its own port, local worker N always
+            # talks to remote worker N. So, the iv management of a pair of
+            # workers won't be disturbed by any other worker.
+            listen_port += self._worker_id
         addr_info = socket.getaddrinfo(listen_addr, listen_port, 0,
                                        socket.SOCK_DGRAM, socket.SOL_UDP)
         if len(addr_info) == 0:
@@ -176,11 +594,14 @@ class UDPServer(ServerMixin):
         if self._is_local:
             sock.setsockopt(socket.SOL_IP, IP_RECVORIGDSTADDR, 1)
             sock.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
+            if workers > 1:
+                # the kernel hashes the source of datagrams, so packets
+                # from one client always reach the same worker
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.setblocking(False)
         sock.bind(sa)
         logging.info('[UDP] Server is listening at %s:%d' % (
-                                    self._config['listen_addr'],
-                                    self._config['listen_udp_port']))
+                                    self._config['listen_addr'], listen_port))
         return sock
 
     def _before_run(self):
@@ -194,7 +615,8 @@ class UDPServer(ServerMixin):
 
         if (self._config.get('udp_multi_remote') or
                 self._config.get('udp_multi_source')):
-            self._mth = UDPMultiTransmitHandler(self._config, self._is_local)
+            self._mth = UDPMultiTransmitHandler(self._config, self._is_local,
+                                                self._worker_id)
             self._multi_transmit = True
             if not self._is_local:
                 self._src_port_2_handler = {}
@@ -202,10 +624,25 @@ class UDPServer(ServerMixin):
             logging.info('[UDP] Multi-transmit on')
         else:
             self._multi_transmit = False
-
-        max_idle_time = self._config.get('udp_socket_max_idle_time') or 60
-        cleaner = ExpiredUDPSocketCleaner(self, max_idle_time)
-        cleaner.start()
+        self._max_flows = self._config.get('udp_max_flows')
+
+    def _admit(self):
+        flows = len(self._fd_2_handler)
+        if self._max_flows and flows >= self._max_flows:
+            return 'udp_flows'
+        # handlers of local have 2 sockets
+        if flows * 2 + FD_RESERVE >= self._fd_limit:
+            return 'fds'
+        return None
+
+    def _busy(self):
+        # The server socket is kept open after it was handed over, remote
+        # handlers send responses through it.
+        return bool(self._fd_2_handler)
+
+    def _new_handler(self, src, dest, key=None):
+        return UDPHandler(src, dest, self, self._local_sock, self._epoll,
+                          self._config, self._is_local, key)
 
     def _gen_handler_key(self, source, dest):
         return '%s:%d@%s:%d' % (source[0], source[1], dest[0], dest[1])
@@ -268,45 +705,87 @@ class UDPServer(ServerMixin):
 
     def _server_socket_recv(self):
         if self._is_local:
-            data, anc, f, src = self._local_sock.recvmsg(UDP_BUFFER_SIZE,
-                                                         socket.CMSG_SPACE(24))
+            data, anc, f, src = self._recv_arena.recvmsg(
+                                                    self._local_sock,
+                                                    UDP_BUFFER_SIZE,
+                                                    socket.CMSG_SPACE(24))
             sock_opt = tools.unpack_sockopt(anc[0][2])
             dest = ('.'.join([str(u) for u in sock_opt[2:]]), sock_opt[1])
             return data, src, dest
         else:
-            data, src = self._local_sock.recvfrom(UDP_BUFFER_SIZE)
-            cryptor = self._excl.current_cryptor
+            data, src = self._recv_arena.recvfrom(self._local_sock,
+                                                  UDP_BUFFER_SIZE)
+            return self._parse_remote_packet(data, src)
+
+    def _parse_remote_packet(self, data, src):
+        cryptor = self._excl.current_cryptor
+        res = PacketParser.parse_udp_packet(cryptor, data)
+        if not res['valid']:
+            err_msg = '[UDP] Got invalid packet from %s:%d' % src
+            if not (self._excl.old_cryptor and cryptor != self._excl.old_cryptor):
+                logging.info(err_msg)
+                self._stats.incr('packets_dropped')
+                return None, None, None
+            cryptor = self._excl.old_cryptor
             res = PacketParser.parse_udp_packet(cryptor, data)
             if not res['valid']:
-                err_msg = '[UDP] Got invalid packet from %s:%d' % src
-                if not (self._excl.old_cryptor and cryptor != self._excl.old_cryptor):
-                    logging.info(err_msg)
-                    return None, None, None
-                cryptor = self._excl.old_cryptor
+                cryptor = self._excl._default_cryptor
                 res = PacketParser.parse_udp_packet(cryptor, data)
                 if not res['valid']:
-                    cryptor = self._excl._default_cryptor
-                    res = PacketParser.parse_udp_packet(cryptor, data)
-                    if not res['valid']:
-                        logging.info(err_msg)
-                        return None, None, None
-
-            if self._multi_transmit:
-                res, is_duplicate = self._mth.handle_recv(res)
-                if is_duplicate:
-                    logging.debug('[UDP_MT] Dropped duplicate packet')
-                    return None, src, res['dest_af']
-
-            # local lost the iv
-            if (res['iv'] and cryptor == self._excl._default_cryptor and
-                self._excl.current_cryptor != self._excl._default_cryptor and
-                self._excl.old_cryptor != self._excl._default_cryptor):
-                self._excl.reset()
-
-            decrypted_by_nc = cryptor == self._excl.nc_in_progress
-            self._remote_manage_iv(src, res['iv'], decrypted_by_nc)
-            return res['data'], src, res['dest_af']
-        return None, None, None
+                    logging.info(err_msg)
+                    self._stats.incr('packets_dropped')
+                    return None, None, None
+
+        if self._multi_transmit:
+            res, is_duplicate = self._mth.handle_recv(res)
+            if is_duplicate:
+                logging.debug('[UDP_MT] Dropped duplicate packet')
+                self._stats.incr('packets_dropped')
+                return None, src, res['dest_af']
+
+        # local lost the iv
+        if (res['iv'] and cryptor == self._excl._default_cryptor and
+            self._excl.current_cryptor != self._excl._default_cryptor and
+            self._excl.old_cryptor != self._excl._default_cryptor):
+            self._excl.reset()
+
+        decrypted_by_nc = cryptor == self._excl.nc_in_progress
+        self._remote_manage_iv(src, res['iv'], decrypted_by_nc)
+        return res['data'], src, res['dest_af']
+
+    def _dispatch_local_packet(self, data, src, dest):
+        self._stats.incr('packets_received')
+        if not dest:
+            return
+
+        if self._multi_transmit and not self._is_local:
+            if src[0] not in self._available_saddrs:
+                logging.info('[UDP] Got request from unavailable source')
+                self._stats.incr('packets_dropped')
+                return
+
+            handler = self._src_port_2_handler.get(src[1])
+            if not (handler and handler.update_last_call_time()):
+                reason = self._admit()
+                if reason:
+                    self._shed(reason)
+                    return
+                handler = self._new_handler(src, dest)
+            if data:
+                handler.handle_local_recv(data)
+            else:
+                handler.one_more_src(src)
+        else:
+            key = self._gen_handler_key(src, dest)
+            handler = self._key_2_handler.get(key)
+            if not (handler and handler.update_last_call_time()):
+                reason = self._admit()
+                if reason:
+                    self._shed(reason)
+                    return
+                handler = self._new_handler(src, dest, key)
+                self._key_2_handler[key] = handler
+            handler.handle_local_recv(data)
 
     def handle_event(self, fd, evt):
         if fd == self._local_sock_fd:
@@ -314,33 +793,7 @@ class UDPServer(ServerMixin):
                 logging.warn('[UDP] Server socket got EPOLLERR')
             elif evt & select.EPOLLIN:
                 data, src, dest = self._server_socket_recv()
-                if not dest:
-                    return
-
-                if self._multi_transmit and not self._is_local:
-                    if src[0] not in self._available_saddrs:
-                        logging.info(
-                                '[UDP] Got request from unavailable source')
-                        return
-
-                    handler = self._src_port_2_handler.get(src[1])
-                    if not (handler and handler.update_last_call_time()):
-                        handler = UDPHandler(src, dest, self, self._local_sock,
-                                             self._epoll, self._config,
-                                             self._is_local)
-                    if data:
-                        handler.handle_local_recv(data)
-                    else:
-                        handler.one_more_src(src)
-                else:
-                    key = self._gen_handler_key(src, dest)
-                    handler = self._key_2_handler.get(key)
-                    if not (handler and handler.update_last_call_time()):
-                        handler = UDPHandler(src, dest, self, self._local_sock,
-                                             self._epoll, self._config,
-                                             self._is_local, key)
-                        self._key_2_handler[key] = handler
-                    handler.handle_local_recv(data)
+                self._dispatch_local_packet(data, src, dest)
         else:
             if evt & select.EPOLLERR:
                 logging.warn('[UDP] Client socket got EPOLLERR')
@@ -354,37 +807,13 @@ class UDPServer(ServerMixin):
                     if not handler.update_last_call_time():
                         logging.info(
                                 '[UDP] Response timeout, handler destroyed')
+                        self._stats.incr('packets_dropped')
                         return
                     handler.handle_remote_resp()
                 else:
                     logging.warn('[UDP] fd removed')
 
 
-class ExpiredUDPSocketCleaner(Thread):
-
-    def __init__(self, server, max_idle_time, poll_time=3):
-        Thread.__init__(self, daemon=True)
-        self._server = server
-        self.max_idle_time = max_idle_time
-        self.poll_time = poll_time
-
-    def check_and_clean(self):
-        now = time.time()
-        fds = list(self._server._fd_2_handler.keys())
-        handlers = list(self._server._fd_2_handler.values())
-        for fd, handler in zip(fds, handlers):
-            if now - handler.last_call_time > self.max_idle_time:
-                if handler.destroyed:
-                    self._server._remove_handler(fd)
-                else:
-                    handler.destroy()
-
-    def run(self):
-        while True:
-            self.check_and_clean()
-            time.sleep(self.poll_time)
-
-
 class SrcExclusiveItems():
 
     def __init__(self, is_local, default_cryptor=None):
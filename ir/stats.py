@@ -0,0 +1,56 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import logging
+
+
+__all__ = ['Stats']
+
+
+class Stats(object):
+
+    '''Counters of a server process
+
+    All counters are plain integers stored in a dict, the server
+    writes them in its event loop and logs them periodically.
+    '''
+
+    def __init__(self, name):
+        self._name = name
+        self._counters = {}
+
+    def incr(self, key, n=1):
+        self._counters[key] = self._counters.get(key, 0) + n
+
+    def set(self, key, value):
+        self._counters[key] = value
+
+    def max(self, key, value):
+        if value > self._counters.get(key, 0):
+            self._counters[key] = value
+
+    def observe(self, key, value, bounds):
+        '''count value into a histogram
+
+        Counts are stored as "key_le_BOUND" for the first bound that is not
+        less than value, or "key_gt_LASTBOUND", the max value is stored
+        as "key_max".
+        '''
+
+        for bound in bounds:
+            if value <= bound:
+                self.incr('%s_le_%s' % (key, bound))
+                break
+        else:
+            self.incr('%s_gt_%s' % (key, bounds[-1]))
+        self.max('%s_max' % key, value)
+
+    def get(self, key, default=0):
+        return self._counters.get(key, default)
+
+    def snapshot(self):
+        return dict(self._counters)
+
+    def log(self):
+        items = ['%s=%s' % (k, v) for k, v in sorted(self._counters.items())]
+        logging.info('[STATS] %s: %s' % (self._name, ', '.join(items)))
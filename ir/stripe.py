@@ -0,0 +1,708 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import os
+import time
+import errno
+import select
+import socket
+import struct
+import logging
+
+from ir import tools
+from ir.crypto import Cryptor
+from ir.handler import SendQueue, get_orig_dest_af
+from ir.protocol import PacketMaker, PacketParser, STRIPE_DEST_AF
+
+
+__all__ = ['StripedFlow', 'Stripe']
+
+
+'''Carry one TCP connection over several connections (stripes)
+
+A single connection is limited by the congestion window of one path. In
+striping mode, the local opens several stripes for every accepted
+connection, possibly to different addresses of the remote, and both sides
+spread the data of the connection over the stripes in sequenced chunks.
+The other side puts the chunks back in order.
+
+Every stripe is a normal connection from the local to the remote whose
+first packet has STRIPE_DEST_AF as the destination, and the HELLO as data:
+
+    +--------------------+-----------------------+
+    |       field        |        byte(s)        |
+    +--------------------+-----------------------+
+    |      FLOW.ID       |           8           |
+    +--------------------+-----------------------+
+    |       INDEX        |           1           |
+    +--------------------+-----------------------+
+    |      DEST.AF       |           6           |
+    +--------------------+-----------------------+
+
+The remote puts the stripes with the same FLOW.ID together, and connects
+to DEST.AF when the first of them arrives, so all stripes of a flow must
+reach the same process: the remote has to run one TCP worker. After the
+first packet, a stripe transports encrypted chunks:
+
+    +--------------------+-----------------------+
+    |       field        |        byte(s)        |
+    +--------------------+-----------------------+
+    |        SEQ         |           4           |
+    +--------------------+-----------------------+
+    |      DATA.LEN      |           4           |
+    +--------------------+-----------------------+
+    |        DATA        |       DATA.LEN        |
+    +--------------------+-----------------------+
+
+SEQ counts the chunks of one direction of the flow. A chunk without data
+ends the flow, it's sent on every stripe, and SEQ is the number of chunks
+that were sent before it.
+
+A chunk is sent on the stripe with the shortest write queue. Chunks that
+arrive ahead of a missing one are kept until it arrives; when too many of
+them are kept, the stripes they came from stop reading. The stripe that
+carries the missing chunk never stops, TCP keeps the chunks of a stripe in
+order, so all chunks it received before are delivered already.
+
+Sockets of flows and stripes are always level-triggered.
+'''
+
+
+HELLO = struct.Struct('!8sB')
+HELLO_SIZE = HELLO.size + 6
+
+CHUNK_HEADER = struct.Struct('!II')
+
+# max bytes read from the socket of a flow at a time
+CHUNK_SIZE = 65536
+
+# max bytes read from a stripe in one event
+STRIPE_RECV_BUDGET = 1048576
+
+# watermarks of the write queue of a stripe, and of a flow, in bytes
+STRIPE_HIGH_WATERMARK = 1048576
+STRIPE_LOW_WATERMARK = 262144
+
+# bytes of chunks kept for a missing one before the stripes stop reading
+MAX_PENDING_BYTES = 4194304
+
+# default number of stripes of a flow
+STRIPES = 2
+
+# seconds the id of an ended flow is remembered, the stripes of it that
+# arrive later are closed
+ENDED_FLOW_TTL = 60
+
+# EPOLLRDHUP is only watched while reading, the data before the EOF must
+# not be dropped
+EPOLL_READ = select.EPOLLIN | select.EPOLLRDHUP
+
+
+def _remember_ended(server, flow_id):
+    ended = server._ended_stripe_flows
+    now = time.time()
+    while ended and now - next(iter(ended.values())) >= ENDED_FLOW_TTL:
+        ended.popitem(last=False)
+    ended[flow_id] = now
+
+
+class Stripe(object):
+
+    '''one of the connections that carry a StripedFlow
+    '''
+
+    def __init__(self, flow, sock, cryptor, connected):
+        self._flow = flow
+        self._server = flow._server
+        self._sock = sock
+        self._fd = sock.fileno()
+        self._cryptor = cryptor
+        self._connected = connected
+        self._out = SendQueue()
+        # decrypted data that is not a complete chunk yet
+        self._in = bytearray()
+        self._reading = True
+        # we sent the last chunk, close after self._out is sent
+        self._ending = False
+        # the peer sent the last chunk
+        self._peer_ended = False
+        self._closed = False
+        self._events = EPOLL_READ | select.EPOLLOUT | select.EPOLLERR
+        self._sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        self._sock.setblocking(False)
+        self._server._epoll.register(self._fd, self._events)
+        self._server._add_handler(self._fd, self)
+
+    @property
+    def connected(self):
+        return self._connected
+
+    @property
+    def ending(self):
+        return self._ending
+
+    @property
+    def peer_ended(self):
+        return self._peer_ended
+
+    @property
+    def queued(self):
+        return self._out.size
+
+    def _update_events(self):
+        events = select.EPOLLERR
+        if self._reading:
+            events |= EPOLL_READ
+        if self._out or not self._connected:
+            events |= select.EPOLLOUT
+        if events != self._events:
+            self._server._epoll.modify(self._fd, events)
+            self._events = events
+
+    def _queue(self, data):
+        self._out.append(data)
+        self._server._buffered_bytes += len(data)
+
+    def send_raw(self, data):
+        '''send data that is encrypted already, such as the first packet
+        '''
+
+        self._queue(data)
+        self._update_events()
+
+    def send_chunk(self, seq, data):
+        # header and data are encrypted separately, see ir.mux.Tunnel
+        self._queue(self._cryptor.encrypt(CHUNK_HEADER.pack(seq, len(data))))
+        if data:
+            self._queue(self._cryptor.encrypt(data))
+        if self._connected:
+            self._on_write()
+
+    def end(self, seq):
+        '''send the last chunk, and close when everything is sent
+        '''
+
+        self._ending = True
+        self.send_chunk(seq, b'')
+
+    def set_reading(self, reading):
+        if self._closed or self._reading == reading:
+            return
+        self._reading = reading
+        self._update_events()
+
+    def feed(self, data):
+        '''handle the decrypted data of the first packet after HELLO
+        '''
+
+        if data:
+            self._in += data
+            self._handle_chunks()
+
+    def _handle_chunks(self):
+        buf = self._in
+        i = 0
+        while len(buf) - i >= CHUNK_HEADER.size and not self._closed:
+            seq, length = CHUNK_HEADER.unpack_from(buf, i)
+            start = i + CHUNK_HEADER.size
+            if len(buf) - start < length:
+                break
+            i = start + length
+            if not length:
+                self._peer_ended = True
+            self._flow.on_chunk(self, seq, buf[start:i])
+        del buf[:i]
+
+    def _on_read(self):
+        received = 0
+        arena = self._server._recv_arena
+        while (self._reading and not self._closed and
+               received < STRIPE_RECV_BUDGET):
+            try:
+                data = arena.recv(self._sock, arena.size)
+            except (OSError, IOError) as e:
+                if tools.errno_from_exception(e) in (errno.EAGAIN,
+                                                     errno.EWOULDBLOCK):
+                    break
+                logging.warn('[STRIPE] Got error from stripe: %s' % e)
+                self.close()
+                break
+            if not data:
+                self.close()
+                break
+            received += len(data)
+            self._in += self._cryptor.decrypt(data)
+            self._handle_chunks()
+            if len(data) < arena.size:
+                break
+        return received
+
+    def _on_write(self):
+        if not self._connected:
+            self._connected = True
+            self._flow.on_stripe_connected(self)
+        try:
+            while self._out:
+                sent, complete = self._out.send(self._sock)
+                self._server._stats.incr('bytes_sent', sent)
+                self._server._release_buffer(sent)
+                if not complete:
+                    break
+        except (OSError, IOError) as e:
+            if tools.errno_from_exception(e) not in (errno.EAGAIN,
+                                                     errno.EWOULDBLOCK):
+                logging.warn('[STRIPE] Got error from stripe: %s' % e)
+                self.close()
+                return
+        if self._ending and not self._out:
+            self.close()
+            return
+        self._update_events()
+        if self._out.size <= STRIPE_LOW_WATERMARK:
+            self._flow.on_stripe_drained(self)
+
+    def handle_event(self, fd, evt):
+        '''
+        :rtype: int, bytes received while handling the events
+        '''
+
+        if self._closed:
+            return 0
+        if evt & select.EPOLLERR:
+            self.close()
+            return 0
+        received = 0
+        if evt & select.EPOLLOUT:
+            self._on_write()
+        if evt & EPOLL_READ and not self._closed:
+            received = self._on_read()
+        self._server._stats.incr('bytes_received', received)
+        return received
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._server._release_buffer(self._out.size)
+        self._out.clear()
+        self._server._remove_handler(self._fd)
+        self._server._epoll.unregister(self._fd)
+        if self._server._tunnel_profile:
+            self._server._tunnel_profile.record(self._sock)
+        self._sock.close()
+        self._sock = None
+        self._flow.on_stripe_closed(self)
+
+
+class StripedFlow(object):
+
+    '''a TCP connection carried by stripes
+
+    On the local side, sock is the accepted connection, on the remote side,
+    sock is the connection to the destination.
+    '''
+
+    def __init__(self, server, sock, flow_id, connecting=False):
+        self._server = server
+        self._sock = sock
+        self._fd = sock.fileno()
+        self._flow_id = flow_id
+        self._stripes = []
+        self._next_send_seq = 0
+        self._next_recv_seq = 0
+        # chunks that arrived before the ones ahead of them, {seq: data}
+        self._pending = {}
+        self._pending_bytes = 0
+        # stripes that stopped reading because of self._pending
+        self._ahead = set()
+        # seq of the last chunk of the peer
+        self._end_seq = None
+        self._out = SendQueue()
+        self._out_congested = False
+        # our socket waits for a stripe to be connected or drained
+        self._paused = True
+        self._connecting = connecting
+        self._closed = False
+        self._connect_timer = None
+        # source address of sock on the remote side, see ir.egress
+        self._egress_addr = None
+        self._idle_timer = None
+        self._idle_timeout = server._config.get('tcp_idle_timeout')
+        if self._idle_timeout:
+            self._idle_timer = server._timers.call_later(
+                                        self._idle_timeout, self._on_timeout)
+        self._sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        self._sock.setblocking(False)
+        self._events = self._wanted_events()
+        server._epoll.register(self._fd, self._events)
+        server._add_handler(self._fd, self)
+        server._stats.incr('connections')
+        server._stats.incr('stripe_flows')
+
+    @classmethod
+    def accept(cls, server, sock, src, afs, count):
+        '''carry an accepted connection of the local side over count
+        stripes, which connect to afs in turn
+        '''
+
+        dest_af = get_orig_dest_af(sock)
+        flow = cls(server, sock, os.urandom(8))
+        config = server._config
+        for i in range(count):
+            af = afs[i % len(afs)]
+            try:
+                stripe_sock = socket.socket(socket.AF_INET,
+                                            socket.SOCK_STREAM)
+            except (OSError, IOError) as e:
+                logging.warn('[STRIPE] Cannot create socket: %s' % e)
+                break
+            if server._tunnel_profile:
+                server._tunnel_profile.apply(stripe_sock)
+            stripe_sock.setblocking(False)
+            try:
+                stripe_sock.connect(af)
+            except (OSError, IOError) as e:
+                if tools.errno_from_exception(e) != errno.EINPROGRESS:
+                    logging.warn('[STRIPE] Cannot connect to %s:%d: %s' % (
+                                                                    *af, e))
+                    stripe_sock.close()
+                    continue
+            iv = os.urandom(config.get('iv_len') or 32)
+            cryptor = Cryptor(config.get('cipher_name'),
+                              config.get('passwd'),
+                              config.get('crypto_libpath'),
+                              iv)
+            stripe = Stripe(flow, stripe_sock, cryptor, False)
+            hello = (HELLO.pack(flow._flow_id, i) +
+                     PacketMaker.ipv4_af_2_bytes(dest_af))
+            stripe.send_raw(PacketMaker.make_tcp_fpacket(
+                                            hello, STRIPE_DEST_AF, iv,
+                                            cryptor, server._iv_cryptor))
+            flow._stripes.append(stripe)
+        if not flow._stripes:
+            flow.close()
+            return flow
+        connect_timeout = config.get('tcp_connect_timeout') or 10
+        flow._connect_timer = server._timers.call_later(
+                                    connect_timeout, flow._on_timeout)
+        logging.info('[STRIPE] Flow from %s:%d to %s:%d over %d stripes' % (
+                                        *src, *dest_af, len(flow._stripes)))
+        return flow
+
+    @classmethod
+    def join(cls, server, sock, cryptor, data):
+        '''put a stripe accepted by the remote into its flow, the flow is
+        created and connects to the destination for the first stripe
+
+        :param data: the decrypted data of the first packet
+        '''
+
+        if len(data) < HELLO_SIZE:
+            logging.info('[STRIPE] Got invalid hello, do close')
+            sock.close()
+            return
+        flow_id, index = HELLO.unpack_from(data)
+        dest_af = PacketParser.bytes_2_ipv4_af(data[HELLO.size:HELLO_SIZE])
+        if flow_id in server._ended_stripe_flows:
+            logging.info('[STRIPE] Got stripe of ended flow, do close')
+            server._stats.incr('stripe_late')
+            sock.close()
+            return
+        flow = server._stripe_flows.get(flow_id)
+        if not flow:
+            # the connection to the destination is a new one, it's limited
+            # just like the accepted ones
+            reason = server._admit()
+            if reason:
+                logging.info('[STRIPE] Refused flow, reason: %s' % reason)
+                server._shed(reason)
+                # the other stripes of it are closed too
+                _remember_ended(server, flow_id)
+                sock.close()
+                return
+            flow = cls._connect(server, flow_id, dest_af)
+            if not flow:
+                _remember_ended(server, flow_id)
+                sock.close()
+                return
+            server._stripe_flows[flow_id] = flow
+        stripe = Stripe(flow, sock, cryptor, True)
+        flow._stripes.append(stripe)
+        logging.debug('[STRIPE] Stripe %d of flow to %s:%d' % (index,
+                                                               *dest_af))
+        stripe.feed(data[HELLO_SIZE:])
+
+    @classmethod
+    def _new_sock(cls, server):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if server._dest_profile:
+            server._dest_profile.apply(sock)
+        sock.setblocking(False)
+        return sock
+
+    @classmethod
+    def _connect(cls, server, flow_id, dest_af):
+        if not dest_af:
+            return None
+        egress_addr = None
+        try:
+            if server._egress:
+                # the next source address is tried if one is out of ports
+                sock, egress_addr = server._egress.connect(
+                                    lambda: cls._new_sock(server), dest_af)
+            else:
+                sock = cls._new_sock(server)
+                try:
+                    sock.connect(dest_af)
+                except (OSError, IOError) as e:
+                    if tools.errno_from_exception(e) != errno.EINPROGRESS:
+                        sock.close()
+                        raise
+        except (OSError, IOError) as e:
+            logging.warn('[STRIPE] Cannot connect to %s:%d: %s' % (
+                                                        dest_af + (e,)))
+            return None
+        flow = cls(server, sock, flow_id, connecting=True)
+        flow._egress_addr = egress_addr
+        connect_timeout = server._config.get('tcp_connect_timeout') or 10
+        flow._connect_timer = server._timers.call_later(
+                                    connect_timeout, flow._on_timeout)
+        logging.info('[STRIPE] Flow connecting to %s:%d' % dest_af)
+        return flow
+
+    def _wanted_events(self):
+        events = select.EPOLLERR
+        if not (self._paused or self._connecting):
+            events |= EPOLL_READ
+        if self._out or self._connecting:
+            events |= select.EPOLLOUT
+        return events
+
+    def _update_events(self):
+        if not self._sock:
+            return
+        events = self._wanted_events()
+        if events != self._events:
+            self._server._epoll.modify(self._fd, events)
+            self._events = events
+
+    def _update_stripe_reading(self):
+        for stripe in self._stripes:
+            stripe.set_reading(not self._out_congested and
+                               stripe not in self._ahead)
+
+    def _on_timeout(self):
+        logging.info('[STRIPE] Flow timeout, do close')
+        self.close()
+
+    def _pick_stripe(self):
+        stripes = [s for s in self._stripes if s.connected and not s.ending]
+        if not stripes:
+            return None
+        return min(stripes, key=lambda s: s.queued)
+
+    def on_stripe_connected(self, stripe):
+        if self._connect_timer:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+        self.on_stripe_drained(stripe)
+
+    def on_stripe_drained(self, stripe):
+        if self._paused and self._sock:
+            self._paused = False
+            self._update_events()
+
+    def on_stripe_closed(self, stripe):
+        if self._closed:
+            return
+        self._stripes.remove(stripe)
+        self._ahead.discard(stripe)
+        if not self._sock:
+            # we have sent the last chunk, this is how the flow ends
+            if not self._stripes:
+                self._release()
+        elif not self._stripes:
+            if (self._end_seq is not None and self._out and
+                    self._next_recv_seq >= self._end_seq):
+                # the peer has finished, _on_write closes the flow when
+                # everything is delivered
+                return
+            logging.info('[STRIPE] All stripes closed, do close')
+            self.close()
+        elif stripe.peer_ended:
+            pass
+        elif not stripe.connected and self._stripes:
+            # no chunk has been sent on it, go on with the others
+            self._server._stats.incr('stripe_connect_failed')
+        else:
+            logging.info('[STRIPE] Stripe closed, do close')
+            self.close()
+
+    def on_chunk(self, stripe, seq, data):
+        if self._closed or not self._sock:
+            return
+        if self._idle_timer:
+            self._idle_timer.rearm(self._idle_timeout)
+        if not data:
+            self._end_seq = seq
+        elif seq == self._next_recv_seq:
+            self._deliver(data)
+            while self._next_recv_seq in self._pending:
+                data = self._pending.pop(self._next_recv_seq)
+                self._pending_bytes -= len(data)
+                self._deliver(data)
+            if self._ahead and self._pending_bytes < MAX_PENDING_BYTES:
+                self._ahead = set()
+                self._update_stripe_reading()
+        else:
+            self._pending[seq] = data
+            self._pending_bytes += len(data)
+            self._server._stats.incr('stripe_reordered')
+            if self._pending_bytes >= MAX_PENDING_BYTES:
+                self._ahead.add(stripe)
+                stripe.set_reading(False)
+        if self._sock and not self._connecting:
+            self._on_write()
+
+    def _deliver(self, data):
+        self._out.append(data)
+        self._server._buffered_bytes += len(data)
+        self._next_recv_seq += 1
+
+    def _on_read(self):
+        received = 0
+        while not (self._closed or self._paused):
+            stripe = self._pick_stripe()
+            if not stripe or stripe.queued >= STRIPE_HIGH_WATERMARK:
+                if stripe:
+                    self._server._stats.incr('stripe_stalls')
+                self._paused = True
+                self._update_events()
+                break
+            try:
+                data = self._server._recv_arena.recv(self._sock, CHUNK_SIZE)
+            except (OSError, IOError) as e:
+                if tools.errno_from_exception(e) in (errno.EAGAIN,
+                                                     errno.EWOULDBLOCK):
+                    break
+                self.close()
+                break
+            if not data:
+                self._finish()
+                break
+            received += len(data)
+            stripe.send_chunk(self._next_send_seq, data)
+            self._next_send_seq += 1
+            if self._idle_timer:
+                self._idle_timer.rearm(self._idle_timeout)
+            if len(data) < CHUNK_SIZE:
+                break
+        return received
+
+    def _on_write(self):
+        if self._connecting:
+            self._connecting = False
+            self._paused = False
+            if self._connect_timer:
+                self._connect_timer.cancel()
+                self._connect_timer = None
+        sent_total = 0
+        try:
+            while self._out:
+                sent, complete = self._out.send(self._sock)
+                sent_total += sent
+                if not complete:
+                    break
+        except (OSError, IOError) as e:
+            if tools.errno_from_exception(e) not in (errno.EAGAIN,
+                                                     errno.EWOULDBLOCK):
+                self.close()
+                return
+        finally:
+            self._server._stats.incr('bytes_sent', sent_total)
+            self._server._release_buffer(sent_total)
+        if (self._end_seq is not None and not self._out and
+                self._next_recv_seq >= self._end_seq):
+            # the peer has finished, and everything is delivered
+            self.close()
+            return
+        congested = self._out.size >= STRIPE_HIGH_WATERMARK
+        if (congested != self._out_congested and
+                (congested or self._out.size <= STRIPE_LOW_WATERMARK)):
+            self._out_congested = congested
+            self._update_stripe_reading()
+        self._update_events()
+
+    def _finish(self):
+        # our socket is closed, send the last chunk on every stripe, the
+        # flow ends when they are all sent
+        self._close_sock()
+        for stripe in list(self._stripes):
+            if stripe.connected:
+                stripe.end(self._next_send_seq)
+            else:
+                stripe.close()
+        if not self._stripes:
+            self._release()
+
+    def handle_event(self, fd, evt):
+        '''
+        :rtype: int, bytes received while handling the events
+        '''
+
+        if self._closed or not self._sock:
+            return 0
+        if evt & select.EPOLLERR:
+            self.close()
+            return 0
+        received = 0
+        if evt & select.EPOLLOUT:
+            self._on_write()
+        if evt & EPOLL_READ and self._sock:
+            received = self._on_read()
+        self._server._stats.incr('bytes_received', received)
+        return received
+
+    def _close_sock(self):
+        if not self._sock:
+            return
+        self._server._release_buffer(self._out.size)
+        self._out.clear()
+        self._pending = {}
+        if self._idle_timer:
+            self._idle_timer.cancel()
+        if self._connect_timer:
+            self._connect_timer.cancel()
+        if self._egress_addr:
+            self._server._egress.release(self._egress_addr)
+            self._egress_addr = None
+        self._server._remove_handler(self._fd)
+        self._server._epoll.unregister(self._fd)
+        if self._server._dest_profile:
+            self._server._dest_profile.record(self._sock)
+        self._sock.close()
+        self._sock = None
+
+    def _release(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._server._stats.incr('connections', -1)
+        self._server._stats.incr('stripe_flows', -1)
+        if self._server._stripe_flows.pop(self._flow_id, None):
+            # a flow of the remote, see join()
+            _remember_ended(self._server, self._flow_id)
+        logging.debug('[STRIPE] Flow closed')
+
+    def close(self):
+        '''close the flow and all its stripes at once
+        '''
+
+        if self._closed:
+            return
+        self._close_sock()
+        stripes = self._stripes
+        self._stripes = []
+        self._release()
+        for stripe in stripes:
+            stripe.close()
@@ -0,0 +1,219 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import os
+import time
+import signal
+import logging
+from multiprocessing import Process, RawArray
+
+
+__all__ = ['Supervisor', 'SharedStats']
+
+
+'''Run the servers in worker processes and watch them
+
+The supervisor starts every worker in its own process, optionally pinned
+to a cpu, and restarts the crashed ones. A worker that exits with code 0
+has been stopped on purpose, it won't be restarted.
+
+Workers copy their counters to a shared memory segment periodically, the
+supervisor adds them up and logs the result. No locks and no messages are
+needed, every worker only writes its own slot.
+'''
+
+
+# counters shared with the supervisor
+SHARED_COUNTERS = ('accepted',
+                   'connections',
+                   'bytes_received',
+                   'bytes_sent',
+                   'packets_received',
+                   'packets_dropped',
+                   'shed')
+
+# shared counters that are not accumulated after the worker died
+SHARED_GAUGES = ('connections',)
+
+CHECK_INTERVAL = 0.5
+
+# the backoff of a worker is reset after it has run for this long
+STABLE_TIME = 60
+MAX_RESTART_BACKOFF = 60
+
+
+class SharedStats(object):
+
+    def __init__(self, slots, keys=SHARED_COUNTERS):
+        self._keys = keys
+        self._slots = slots
+        self._values = RawArray('q', slots * len(keys))
+        # counters of the dead workers, only used by the supervisor
+        self._retired = dict.fromkeys(keys, 0)
+
+    def publish(self, slot, stats):
+        '''copy counters of a ir.stats.Stats to slot, called by workers
+        '''
+
+        base = slot * len(self._keys)
+        for i, key in enumerate(self._keys):
+            self._values[base + i] = stats.get(key)
+
+    def get(self, slot):
+        base = slot * len(self._keys)
+        return dict(zip(self._keys,
+                        self._values[base:base + len(self._keys)]))
+
+    def retire(self, slot):
+        '''keep the counters of a dead worker and clear its slot
+        '''
+
+        for key, value in self.get(slot).items():
+            if key not in SHARED_GAUGES:
+                self._retired[key] += value
+        base = slot * len(self._keys)
+        for i in range(len(self._keys)):
+            self._values[base + i] = 0
+
+    def total(self):
+        total = dict(self._retired)
+        for slot in range(self._slots):
+            for key, value in self.get(slot).items():
+                total[key] += value
+        return total
+
+
+class _Worker(object):
+
+    def __init__(self, name, target, args, slot, cpu):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.slot = slot
+        self.cpu = cpu
+        self.process = None
+        self.started_at = 0
+        self.restart_at = None
+        self.restarts = 0
+        self.failures = 0
+
+
+def _worker_main(worker, shared_stats):
+    # restarted workers are forked after the supervisor set its handler
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if worker.cpu is not None:
+        try:
+            os.sched_setaffinity(0, {worker.cpu})
+        except (OSError, ValueError) as e:
+            logging.warn('[SUPERVISOR] Cannot pin %s to cpu %d: %s' % (
+                                            worker.name, worker.cpu, e))
+    worker.target(*worker.args, shared_stats=shared_stats,
+                  stats_slot=worker.slot)
+
+
+class Supervisor(object):
+
+    '''start, watch and restart the worker processes
+
+    Usage:
+        supervisor = Supervisor(config)
+        supervisor.add_worker('tcp-0', run_tcp, [server_cls, config_path])
+        supervisor.run()
+
+    The target of a worker is called as
+    target(*args, shared_stats=shared_stats, stats_slot=slot),
+    it should pass them to the server's share_stats().
+    '''
+
+    def __init__(self, config):
+        self._config = config
+        self._workers = []
+        self._cpus = config.get('worker_cpus') or []
+        self._backoff = config.get('worker_restart_backoff') or 1
+        self._shared_stats = None
+        self._running = False
+
+    def add_worker(self, name, target, args):
+        slot = len(self._workers)
+        cpu = self._cpus[slot % len(self._cpus)] if self._cpus else None
+        self._workers.append(_Worker(name, target, args, slot, cpu))
+
+    def _start_worker(self, worker):
+        worker.process = Process(target=_worker_main,
+                                 args=[worker, self._shared_stats],
+                                 name=worker.name)
+        worker.process.start()
+        worker.started_at = time.time()
+        worker.restart_at = None
+        if worker.cpu is None:
+            logging.info('[SUPERVISOR] Started %s, pid: %d' % (
+                                        worker.name, worker.process.pid))
+        else:
+            logging.info('[SUPERVISOR] Started %s on cpu %d, pid: %d' % (
+                            worker.name, worker.cpu, worker.process.pid))
+
+    def _check_worker(self, worker, now):
+        if worker.process is None:
+            if worker.restart_at is not None and now >= worker.restart_at:
+                worker.restarts += 1
+                self._start_worker(worker)
+            return
+        if worker.process.is_alive():
+            return
+        code = worker.process.exitcode
+        worker.process = None
+        self._shared_stats.retire(worker.slot)
+        if code == 0:
+            logging.info('[SUPERVISOR] %s exited' % worker.name)
+            return
+        if now - worker.started_at >= STABLE_TIME:
+            worker.failures = 0
+        delay = min(self._backoff * 2 ** worker.failures, MAX_RESTART_BACKOFF)
+        worker.failures += 1
+        worker.restart_at = now + delay
+        logging.warn('[SUPERVISOR] %s died with exit code %s, '
+                     'restart in %.1f sec.' % (worker.name, code, delay))
+
+    def _log_stats(self):
+        total = self._shared_stats.total()
+        total['workers'] = len([w for w in self._workers
+                                if w.process and w.process.is_alive()])
+        total['restarts'] = sum([w.restarts for w in self._workers])
+        items = ['%s=%s' % (k, v) for k, v in sorted(total.items())]
+        logging.info('[STATS] all workers: %s' % ', '.join(items))
+
+    def _on_signal(self, signum, frame):
+        self._running = False
+
+    def run(self):
+        self._shared_stats = SharedStats(len(self._workers))
+        for worker in self._workers:
+            self._start_worker(worker)
+        signal.signal(signal.SIGTERM, self._on_signal)
+        interval = self._config.get('stats_log_interval')
+        next_log = time.time() + (interval or 0)
+        self._running = True
+        try:
+            while self._running:
+                time.sleep(CHECK_INTERVAL)
+                now = time.time()
+                for worker in self._workers:
+                    self._check_worker(worker, now)
+                if interval and now >= next_log:
+                    self._log_stats()
+                    next_log = now + interval
+                if not [w for w in self._workers
+                        if w.process or w.restart_at is not None]:
+                    break
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def stop(self):
+        self._running = False
+        for worker in self._workers:
+            if worker.process and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self._workers:
+            if worker.process:
+                worker.process.join()
@@ -0,0 +1,172 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import math
+import time
+import logging
+
+
+__all__ = ['Timer', 'TimerWheel']
+
+
+'''A hierarchical timer wheel driven by the event loop
+
+    Level 0 has SLOTS slots and each slot covers one tick, level N has
+    SLOTS slots and each slot covers SLOTS ** N ticks. A timer is put into
+    the lowest level that can hold its deadline, and timers are moved to
+    lower levels (cascaded) when the level below them wraps around.
+
+    Arm and cancel are O(1). Re-arm is O(1) too: Timer.rearm only updates
+    the deadline, a timer found in an expired slot with a later deadline
+    is simply put back into the wheel. So, handlers can call rearm for
+    every packet without any cost of moving timers.
+
+    A timer shorter than one tick would be late by up to a whole tick, it's
+    kept apart in a set instead, next_timeout wakes the event loop up for
+    the earliest of them.
+'''
+
+
+SLOTS = 64
+LEVELS = 4
+
+
+class Timer(object):
+
+    __slots__ = ('deadline', '_callback', '_args', '_slot')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self._callback = callback
+        self._args = args
+        self._slot = None
+
+    def rearm(self, delay, now=None):
+        # Only postponing is supported, the timer stays in its slot and
+        # will be moved when the slot expires.
+        self.deadline = (now or time.time()) + delay
+
+    def cancel(self):
+        if self._slot is not None:
+            self._slot.discard(self)
+            self._slot = None
+
+    @property
+    def armed(self):
+        return self._slot is not None
+
+
+class TimerWheel(object):
+
+    def __init__(self, tick=0.1, now=None):
+        self._tick = tick
+        self._wheels = [[set() for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self._current_tick = int((now or time.time()) / tick)
+        # timers due in less than one tick
+        self._near = set()
+
+    def _insert(self, timer):
+        tick = max(int(math.ceil(timer.deadline / self._tick)),
+                   self._current_tick + 1)
+        delta = tick - self._current_tick
+        level = 0
+        span = SLOTS
+        while delta >= span and level < LEVELS - 1:
+            level += 1
+            span *= SLOTS
+        slot = self._wheels[level][(tick // SLOTS ** level) % SLOTS]
+        slot.add(timer)
+        timer._slot = slot
+
+    def call_later(self, delay, callback, *args):
+        '''call callback(*args) after delay seconds
+
+        :rtype: Timer
+        '''
+
+        timer = Timer(time.time() + delay, callback, args)
+        if delay < self._tick:
+            self._near.add(timer)
+            timer._slot = self._near
+        else:
+            self._insert(timer)
+        return timer
+
+    def _fire(self, timer):
+        timer._slot = None
+        try:
+            timer._callback(*timer._args)
+        except Exception as e:
+            logging.exception('[TIMER] Callback failed: %s' % e)
+
+    def _advance_near(self, now):
+        for timer in [t for t in self._near if t.deadline <= now]:
+            if timer._slot is not self._near:
+                # cancelled by the callback of another timer
+                continue
+            self._near.discard(timer)
+            self._fire(timer)
+        for timer in [t for t in self._near
+                      if t.deadline - now >= self._tick]:
+            # re-armed for later
+            self._near.discard(timer)
+            self._insert(timer)
+
+    def _cascade(self, level):
+        index = (self._current_tick // SLOTS ** level) % SLOTS
+        slot = self._wheels[level][index]
+        self._wheels[level][index] = set()
+        for timer in slot:
+            self._insert(timer)
+
+    def advance(self, now=None):
+        '''fire all expired timers
+        '''
+
+        now = now or time.time()
+        if self._near:
+            self._advance_near(now)
+        target = int(now / self._tick)
+        while self._current_tick < target:
+            self._current_tick += 1
+            level = 1
+            while level < LEVELS and self._current_tick % SLOTS ** level == 0:
+                level += 1
+            for lv in reversed(range(1, level)):
+                self._cascade(lv)
+
+            index = self._current_tick % SLOTS
+            slot = self._wheels[0][index]
+            if not slot:
+                continue
+            self._wheels[0][index] = set()
+            for timer in list(slot):
+                if timer._slot is not slot:
+                    # cancelled by the callback of another timer
+                    continue
+                if timer.deadline > now:
+                    # re-armed after it was put into the wheel
+                    self._insert(timer)
+                    continue
+                self._fire(timer)
+
+    def next_timeout(self, default):
+        '''seconds to wait before the next call of advance
+
+        :param default: max seconds to wait
+        '''
+
+        if self._near:
+            near = min(t.deadline for t in self._near) - time.time()
+            default = min(max(near, 0), default)
+        for i in range(1, SLOTS + 1):
+            tick = self._current_tick + i
+            if self._wheels[0][tick % SLOTS]:
+                break
+            if tick % SLOTS == 0:
+                # timers of upper levels may be cascaded here
+                break
+        else:
+            return default
+        timeout = tick * self._tick - time.time()
+        return min(max(timeout, 0), default)
@@ -4,7 +4,9 @@
 import hashlib
 import json
 import struct
+import socket
 import logging
+import resource
 
 
 class Initer(object):
@@ -85,6 +87,99 @@ def unpack_sockopt(opt):
     return struct.unpack('!HHBBBB', opt[:8])
 
 
+def read_netstat_counter(group, name, path='/proc/net/netstat'):
+    '''read a counter from /proc/net/netstat
+
+    :param group: such as 'TcpExt'
+    :param name: such as 'ListenOverflows'
+    :rtype: int, None if the counter is not available
+    '''
+
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except (OSError, IOError):
+        return None
+    # the file is made of pairs of lines, names first and values second
+    for names, values in zip(lines[::2], lines[1::2]):
+        names = names.split()
+        values = values.split()
+        if not names or names[0] != group + ':':
+            continue
+        if name in names:
+            return int(values[names.index(name)])
+    return None
+
+
+def reset_connection(sock):
+    '''close a tcp connection with RST, nothing will be kept in TIME_WAIT
+    '''
+
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                    struct.pack('ii', 1, 0))
+    sock.close()
+
+
+def set_nofile_limit(limit=None):
+    '''set the soft limit of RLIMIT_NOFILE
+
+    :param limit: the limit wanted, the hard limit will be used if it's None.
+                  The hard limit is raised too if it's not enough, which
+                  needs CAP_SYS_RESOURCE.
+    :rtype: int, the soft limit in effect
+    '''
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if not limit:
+        if hard == resource.RLIM_INFINITY:
+            return soft
+        limit = hard
+    if hard != resource.RLIM_INFINITY and limit > hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, limit))
+            return limit
+        except (ValueError, OSError) as e:
+            logging.warn('Cannot raise RLIMIT_NOFILE to %d: %s' % (limit, e))
+            limit = hard
+    if limit != soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        except (ValueError, OSError) as e:
+            logging.warn('Cannot set RLIMIT_NOFILE to %d: %s' % (limit, e))
+            return soft
+    return limit
+
+
+class RecvArena(object):
+
+    '''a preallocated buffer for the receive paths of a server
+
+    Data is received into the buffer with recv_into and friends, and
+    returned as a memoryview slice of it instead of a new bytes object.
+    There is only one event loop thread, so one buffer is enough, but the
+    returned data is only valid until the next receive: it must be
+    consumed (encrypted, decrypted or copied) before that.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+
+    def recv(self, sock, size):
+        n = sock.recv_into(self._view, size)
+        return self._view[:n]
+
+    def recvfrom(self, sock, size):
+        n, src = sock.recvfrom_into(self._view, size)
+        return self._view[:n], src
+
+    def recvmsg(self, sock, size, ancbufsize):
+        n, anc, flags, src = sock.recvmsg_into([self._view[:size]],
+                                               ancbufsize)
+        return self._view[:n], anc, flags, src
+
+
 # from tornado.util
 def errno_from_exception(e):
     """Provides the errno from an Exception object.
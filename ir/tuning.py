@@ -0,0 +1,234 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import errno
+import socket
+import struct
+import logging
+
+from ir import tools
+
+
+__all__ = ['TuningProfile', 'load_profiles']
+
+
+'''Named TCP tuning profiles, applied to tunnel or destination sockets
+
+The hop between the local side and the remote is long and lossy, the hop
+to the clients or to the destinations is usually short. tcp_profiles in the
+config names sets of socket options:
+
+    "tcp_profiles": {
+        "longhaul": {"congestion": "bbr", "bandwidth_mbps": 100,
+                     "rtt_ms": 200, "notsent_lowat": 131072,
+                     "keepalive_idle": 60, "keepalive_interval": 10,
+                     "keepalive_count": 5},
+        "lan": {}
+    }
+
+tcp_tunnel_profile is applied to the sockets between the local side and the
+remote, tcp_dest_profile to the sockets of the clients (local side) and of
+the destinations (remote side). SO_SNDBUF and SO_RCVBUF are set to the
+bandwidth-delay product, unless sndbuf or rcvbuf is given in bytes. Note
+that a fixed SO_RCVBUF turns off the receive buffer autotuning of the
+kernel, and both are capped by net.core.wmem_max and net.core.rmem_max.
+
+A TCP_INFO snapshot of every tuned socket is taken when it's closed and
+counted into the stats as "tcpinfo_<profile>_*", a profile without any
+option only records, as a baseline for the others.
+'''
+
+
+TCP_CONGESTION = 13
+TCP_NOTSENT_LOWAT = 25
+
+TCP_CA_NAME_MAX = 16
+
+# struct tcp_info, up to tcpi_bytes_retrans of linux 4.19
+TCP_INFO_SIZE = 216
+TCP_INFO_FIELDS = (
+    # name, offset, format
+    ('rtt', 68, 'I'),                   # us
+    ('rttvar', 72, 'I'),
+    ('snd_cwnd', 80, 'I'),              # segments
+    ('total_retrans', 100, 'I'),        # segments
+    ('bytes_acked', 120, 'Q'),
+    ('bytes_received', 128, 'Q'),
+    ('min_rtt', 148, 'I'),              # us
+    ('delivery_rate', 160, 'Q'),        # bytes per second
+    ('rwnd_limited', 176, 'Q'),         # us
+    ('sndbuf_limited', 184, 'Q'),       # us
+    ('bytes_retrans', 208, 'Q'),
+)
+
+RTT_BOUNDS_MS = (1, 5, 20, 50, 100, 200, 500)
+DELIVERY_BOUNDS_KBPS = (128, 1024, 8192, 65536)
+
+PROFILE_KEYS = ('congestion', 'bandwidth_mbps', 'rtt_ms', 'sndbuf', 'rcvbuf',
+                'notsent_lowat', 'keepalive_idle', 'keepalive_interval',
+                'keepalive_count')
+
+
+def tcp_info(sock):
+    '''take a snapshot of the TCP_INFO of sock
+
+    :rtype: dict of TCP_INFO_FIELDS, only the fields the kernel filled in,
+            None if the socket has gone
+    '''
+
+    try:
+        info = sock.getsockopt(socket.SOL_TCP, socket.TCP_INFO, TCP_INFO_SIZE)
+    except (OSError, IOError):
+        return None
+    snapshot = {}
+    for name, offset, fmt in TCP_INFO_FIELDS:
+        if offset + struct.calcsize(fmt) > len(info):
+            break
+        snapshot[name] = struct.unpack_from(fmt, info, offset)[0]
+    return snapshot
+
+
+class TuningProfile(object):
+
+    def __init__(self, name, options, stats):
+        unknown = set(options) - set(PROFILE_KEYS)
+        if unknown:
+            raise Exception('Unknown options of tcp profile %s: %s' % (
+                                                name, ', '.join(unknown)))
+        self.name = name
+        self._stats = stats
+        self._congestion = options.get('congestion')
+        bdp = None
+        if options.get('bandwidth_mbps') and options.get('rtt_ms'):
+            bdp = int(options['bandwidth_mbps'] * 125000 *
+                      options['rtt_ms'] / 1000)
+        self._sndbuf = options.get('sndbuf') or bdp
+        self._rcvbuf = options.get('rcvbuf') or bdp
+        self._notsent_lowat = options.get('notsent_lowat')
+        self._keepalive = (options.get('keepalive_idle'),
+                           options.get('keepalive_interval'),
+                           options.get('keepalive_count'))
+        self._buffer_checked = False
+
+    def __str__(self):
+        return '%s (congestion: %s, sndbuf: %s, rcvbuf: %s, ' \
+               'notsent_lowat: %s, keepalive: %s/%s/%s)' % (
+                    self.name, self._congestion or 'default',
+                    self._sndbuf or 'auto', self._rcvbuf or 'auto',
+                    self._notsent_lowat or 'off', *self._keepalive)
+
+    def _set_congestion(self, sock):
+        try:
+            sock.setsockopt(socket.SOL_TCP, TCP_CONGESTION,
+                            self._congestion.encode())
+        except (OSError, IOError) as e:
+            if tools.errno_from_exception(e) not in (errno.ENOENT,
+                                                     errno.EPERM):
+                raise
+            # the module is not loaded, or not in
+            # net.ipv4.tcp_allowed_congestion_control
+            logging.warn('[TUNING] Congestion control %s of profile %s is '
+                         'not available: %s' % (self._congestion,
+                                                self.name, e))
+            self._congestion = None
+
+    def _check_buffers(self, sock):
+        # the kernel doubles the value for its bookkeeping overhead,
+        # a smaller one was capped by wmem_max or rmem_max
+        for opt, size, sysctl in (
+                (socket.SO_SNDBUF, self._sndbuf, 'net.core.wmem_max'),
+                (socket.SO_RCVBUF, self._rcvbuf, 'net.core.rmem_max')):
+            if size and sock.getsockopt(socket.SOL_SOCKET, opt) < size * 2:
+                logging.warn('[TUNING] Buffers of profile %s are capped by '
+                             '%s, %d bytes wanted' % (self.name, sysctl, size))
+        self._buffer_checked = True
+
+    def apply(self, sock):
+        '''set the options of the profile on sock, before it's connected
+        or listening, so the window scale is chosen for the buffers
+        '''
+
+        if self._congestion:
+            self._set_congestion(sock)
+        if self._sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._sndbuf)
+        if self._rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._rcvbuf)
+        if not self._buffer_checked:
+            self._check_buffers(sock)
+        if self._notsent_lowat:
+            sock.setsockopt(socket.SOL_TCP, TCP_NOTSENT_LOWAT,
+                            self._notsent_lowat)
+        idle, interval, count = self._keepalive
+        if idle or interval or count:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if idle:
+                sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPIDLE, idle)
+            if interval:
+                sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPINTVL,
+                                interval)
+            if count:
+                sock.setsockopt(socket.SOL_TCP, socket.TCP_KEEPCNT, count)
+
+    def record(self, sock):
+        '''count a TCP_INFO snapshot of sock into the stats, call it right
+        before sock is closed
+        '''
+
+        snapshot = tcp_info(sock)
+        if not snapshot or not snapshot.get('rtt'):
+            # never established
+            return
+        logging.debug('[TUNING] TCP_INFO of %s: %s' % (self.name, snapshot))
+        key = 'tcpinfo_%s' % self.name
+        self._stats.incr('%s_sockets' % key)
+        self._stats.observe('%s_rtt_ms' % key, snapshot['rtt'] // 1000,
+                            RTT_BOUNDS_MS)
+        self._stats.incr('%s_retrans' % key, snapshot['total_retrans'])
+        if 'bytes_acked' in snapshot:
+            self._stats.incr('%s_bytes_acked' % key, snapshot['bytes_acked'])
+            self._stats.incr('%s_bytes_received' % key,
+                             snapshot['bytes_received'])
+        if 'min_rtt' in snapshot:
+            self._stats.observe('%s_min_rtt_ms' % key,
+                                snapshot['min_rtt'] // 1000, RTT_BOUNDS_MS)
+        if snapshot.get('delivery_rate'):
+            self._stats.observe('%s_delivery_kbps' % key,
+                                snapshot['delivery_rate'] // 1024,
+                                DELIVERY_BOUNDS_KBPS)
+        if 'sndbuf_limited' in snapshot:
+            # time spent waiting for the peer's window or our send buffer,
+            # tells if the buffers of the profile are too small
+            self._stats.incr('%s_rwnd_limited_ms' % key,
+                             snapshot['rwnd_limited'] // 1000)
+            self._stats.incr('%s_sndbuf_limited_ms' % key,
+                             snapshot['sndbuf_limited'] // 1000)
+        if 'bytes_retrans' in snapshot:
+            self._stats.incr('%s_bytes_retrans' % key,
+                             snapshot['bytes_retrans'])
+
+
+def load_profiles(config, stats):
+    '''build the profiles named by tcp_tunnel_profile and tcp_dest_profile
+
+    :rtype: tuple, (tunnel profile, destination profile), None for the
+            ones not configured
+    '''
+
+    profiles = config.get('tcp_profiles') or {}
+    if not isinstance(profiles, dict):
+        raise Exception('Format of tcp_profiles is invalid')
+    built = {}
+    result = []
+    for key in ('tcp_tunnel_profile', 'tcp_dest_profile'):
+        name = config.get(key)
+        if not name:
+            result.append(None)
+            continue
+        if name not in profiles:
+            raise Exception('%s %s is not in tcp_profiles' % (key, name))
+        if name not in built:
+            built[name] = TuningProfile(name, profiles[name], stats)
+            logging.info('[TUNING] Loaded profile %s' % built[name])
+        result.append(built[name])
+    return tuple(result)
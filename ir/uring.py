@@ -0,0 +1,642 @@
+#!/usr/bin/python3.6
+# coding: utf-8
+
+import os
+import mmap
+import errno
+import ctypes
+import socket
+import struct
+import logging
+
+from ir import tools
+from ir.crypto import Cryptor, preload_crypto_lib
+from ir.gcmanager import GCManager
+from ir.handler import (get_orig_dest_af,
+                        UP_STREAM_BUF_SIZE, DOWN_STREAM_BUF_SIZE,
+                        BUFFER_HIGH_WATERMARK, BUFFER_LOW_WATERMARK)
+from ir.protocol import PacketMaker, PacketParser
+from ir.server import TCPServer, POLL_TIMEOUT
+
+
+__all__ = ['IOUring', 'URingTCPServer', 'URingTCPHandler']
+
+
+'''io_uring backend of TCPServer
+
+We talk to the kernel with raw syscalls through ctypes, so liburing is
+not necessary. All recv/send/accept/connect operations prepared in one
+iteration of the event loop are submitted by one io_uring_enter, which
+also waits for completions and returns them in bulk.
+
+Set config['tcp_io_backend'] to 'io_uring' to use it. If the kernel
+doesn't support io_uring or any operation we need, the server falls back
+to the epoll engine.
+'''
+
+
+NR_IO_URING_SETUP = 425
+NR_IO_URING_ENTER = 426
+NR_IO_URING_REGISTER = 427
+
+IORING_OFF_SQ_RING = 0
+IORING_OFF_CQ_RING = 0x8000000
+IORING_OFF_SQES = 0x10000000
+
+IORING_ENTER_GETEVENTS = 1
+IORING_ENTER_EXT_ARG = 8
+IORING_FEAT_EXT_ARG = 1 << 8
+IORING_REGISTER_PROBE = 8
+IO_URING_OP_SUPPORTED = 1
+
+IORING_OP_ACCEPT = 13
+IORING_OP_CONNECT = 16
+IORING_OP_SEND = 26
+IORING_OP_RECV = 27
+
+REQUIRED_OPS = (IORING_OP_ACCEPT, IORING_OP_CONNECT,
+                IORING_OP_SEND, IORING_OP_RECV)
+
+PARAMS_SIZE = 120
+SQE_SIZE = 64
+CQE_SIZE = 16
+SQE_FORMAT = '<BBHiQQIIQHHiQQ'
+CQE_FORMAT = '<QiI'
+
+MSG_NOSIGNAL = 0x4000
+
+
+libc = ctypes.CDLL(None, use_errno=True)
+libc.syscall.restype = ctypes.c_long
+
+
+def _syscall(*args):
+    r = libc.syscall(*args)
+    if r < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return r
+
+
+def addr_of_bytes(data):
+    return ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+
+
+def pack_sockaddr_in(af):
+    ip, port = af
+    return struct.pack('=H', socket.AF_INET) + struct.pack('!H', port) +\
+            socket.inet_aton(ip) + b'\x00' * 8
+
+
+class IOUring(object):
+
+    def __init__(self, entries=4096):
+        params = ctypes.create_string_buffer(PARAMS_SIZE)
+        self._fd = _syscall(ctypes.c_long(NR_IO_URING_SETUP),
+                            ctypes.c_uint(entries), params)
+        p = params.raw
+        (self._sq_entries, self._cq_entries, _, _, _,
+                self.features) = struct.unpack_from('<6I', p, 0)
+        sq_off = struct.unpack_from('<7I', p, 40)
+        cq_off = struct.unpack_from('<6I', p, 80)
+
+        sq_size = sq_off[6] + self._sq_entries * 4
+        cq_size = cq_off[5] + self._cq_entries * CQE_SIZE
+        prot = mmap.PROT_READ | mmap.PROT_WRITE
+        self._sq = mmap.mmap(self._fd, sq_size, mmap.MAP_SHARED, prot,
+                             offset=IORING_OFF_SQ_RING)
+        self._cq = mmap.mmap(self._fd, cq_size, mmap.MAP_SHARED, prot,
+                             offset=IORING_OFF_CQ_RING)
+        self._sqes = mmap.mmap(self._fd, self._sq_entries * SQE_SIZE,
+                               mmap.MAP_SHARED, prot, offset=IORING_OFF_SQES)
+
+        (self._sq_head_off, self._sq_tail_off, sq_mask_off,
+                _, _, _, self._sq_array_off) = sq_off
+        self._sq_mask = struct.unpack_from('<I', self._sq, sq_mask_off)[0]
+        (self._cq_head_off, self._cq_tail_off, cq_mask_off,
+                _, _, self._cqes_off) = cq_off
+        self._cq_mask = struct.unpack_from('<I', self._cq, cq_mask_off)[0]
+
+        self._sq_tail = struct.unpack_from('<I', self._sq,
+                                           self._sq_tail_off)[0]
+        self._to_submit = 0
+        self._user_data = 0
+        # {user_data: (callback, args)}, args keep the buffers alive
+        # until the kernel is done with them
+        self._callbacks = {}
+        # sockets to close after the prepared operations are submitted
+        self._to_close = []
+        self.enter_calls = 0
+        self.submitted = 0
+        self.completed = 0
+
+    @classmethod
+    def supported(cls):
+        '''check if the kernel supports all things we need
+
+        :rtype: boolean
+        '''
+
+        try:
+            ring = cls(8)
+        except OSError as e:
+            logging.info('[URING] io_uring_setup failed: %s' % e)
+            return False
+        try:
+            if not ring.features & IORING_FEAT_EXT_ARG:
+                return False
+            probe = ctypes.create_string_buffer(16 + 256 * 8)
+            _syscall(ctypes.c_long(NR_IO_URING_REGISTER),
+                     ctypes.c_int(ring._fd),
+                     ctypes.c_uint(IORING_REGISTER_PROBE),
+                     probe, ctypes.c_uint(256))
+            last_op = struct.unpack_from('B', probe.raw, 0)[0]
+            for op in REQUIRED_OPS:
+                if op > last_op:
+                    return False
+                flags = struct.unpack_from('<H', probe.raw, 16 + op * 8 + 2)[0]
+                if not flags & IO_URING_OP_SUPPORTED:
+                    return False
+            return True
+        except OSError as e:
+            logging.info('[URING] io_uring probe failed: %s' % e)
+            return False
+        finally:
+            ring.close()
+
+    def _prep(self, opcode, fd, addr=0, length=0, off=0, op_flags=0,
+              callback=None, args=()):
+        sq_head = struct.unpack_from('<I', self._sq, self._sq_head_off)[0]
+        if self._sq_tail - sq_head >= self._sq_entries:
+            self.submit()
+        self._user_data += 1
+        self._callbacks[self._user_data] = (callback, args)
+        index = self._sq_tail & self._sq_mask
+        struct.pack_into(SQE_FORMAT, self._sqes, index * SQE_SIZE,
+                         opcode, 0, 0, fd, off, addr, length, op_flags,
+                         self._user_data, 0, 0, 0, 0, 0)
+        struct.pack_into('<I', self._sq, self._sq_array_off + index * 4, index)
+        self._sq_tail = (self._sq_tail + 1) & 0xFFFFFFFF
+        struct.pack_into('<I', self._sq, self._sq_tail_off, self._sq_tail)
+        self._to_submit += 1
+
+    def prep_accept(self, fd, callback, *args):
+        self._prep(IORING_OP_ACCEPT, fd, op_flags=socket.SOCK_CLOEXEC,
+                   callback=callback, args=args)
+
+    def prep_connect(self, fd, sockaddr, callback, *args):
+        self._prep(IORING_OP_CONNECT, fd, addr_of_bytes(sockaddr),
+                   off=len(sockaddr), callback=callback,
+                   args=(sockaddr,) + args)
+
+    def prep_recv(self, fd, buf_addr, length, callback, *args):
+        self._prep(IORING_OP_RECV, fd, buf_addr, length,
+                   callback=callback, args=args)
+
+    def prep_send(self, fd, data, callback, *args):
+        self._prep(IORING_OP_SEND, fd, addr_of_bytes(data), len(data),
+                   op_flags=MSG_NOSIGNAL, callback=callback,
+                   args=(data,) + args)
+
+    def close_after_submit(self, sock):
+        # The fd may be used by prepared operations, if we close it now,
+        # a new socket may get the same fd before these operations are
+        # submitted.
+        self._to_close.append(sock)
+
+    def _enter(self, min_complete, flags, arg=None, argsz=0):
+        self.enter_calls += 1
+        try:
+            n = _syscall(ctypes.c_long(NR_IO_URING_ENTER),
+                         ctypes.c_int(self._fd), ctypes.c_uint(self._to_submit),
+                         ctypes.c_uint(min_complete), ctypes.c_uint(flags),
+                         arg, ctypes.c_size_t(argsz))
+        except OSError as e:
+            if e.errno in (errno.ETIME, errno.EINTR, errno.EBUSY):
+                n = 0
+            else:
+                raise
+        self._to_submit -= n
+        self.submitted += n
+        for sock in self._to_close:
+            sock.close()
+        self._to_close = []
+
+    def submit(self):
+        if self._to_submit:
+            self._enter(0, 0)
+
+    def submit_and_wait(self, timeout):
+        '''submit prepared operations and wait for one completion at least
+        '''
+
+        ts = struct.pack('<qq', int(timeout), int((timeout % 1) * 1e9))
+        ts_buf = ctypes.create_string_buffer(ts, len(ts))
+        arg = struct.pack('<QIIQ', 0, 0, 0, ctypes.addressof(ts_buf))
+        arg_buf = ctypes.create_string_buffer(arg, len(arg))
+        self._enter(1, IORING_ENTER_GETEVENTS | IORING_ENTER_EXT_ARG,
+                    arg_buf, len(arg))
+
+    def reap(self):
+        '''call the callbacks of all completed operations
+
+        :rtype: int, number of completions
+        '''
+
+        head = struct.unpack_from('<I', self._cq, self._cq_head_off)[0]
+        tail = struct.unpack_from('<I', self._cq, self._cq_tail_off)[0]
+        cqes = []
+        while head != tail:
+            offset = self._cqes_off + (head & self._cq_mask) * CQE_SIZE
+            cqes.append(struct.unpack_from(CQE_FORMAT, self._cq, offset))
+            head = (head + 1) & 0xFFFFFFFF
+        struct.pack_into('<I', self._cq, self._cq_head_off, head)
+        self.completed += len(cqes)
+        for user_data, res, flags in cqes:
+            callback, args = self._callbacks.pop(user_data, (None, ()))
+            if callback:
+                callback(res, *args)
+        return len(cqes)
+
+    def close(self):
+        for m in (self._sq, self._cq, self._sqes):
+            m.close()
+        os.close(self._fd)
+
+
+class _RingSocket(object):
+
+    '''a socket and its state in a URingTCPHandler
+    '''
+
+    def __init__(self, sock, buf_size):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.buf_size = buf_size
+        self.buf = bytearray(buf_size)
+        self._cbuf = (ctypes.c_char * buf_size).from_buffer(self.buf)
+        self.buf_addr = ctypes.addressof(self._cbuf)
+        self.data_2_sock = []
+        self.pending_bytes = 0
+        self.connected = True
+        self.recving = False
+        self.sending = False
+        self.recv_paused = False
+
+
+class URingTCPHandler(object):
+
+    '''io_uring version of ir.handler.TCPHandler
+
+    Every socket has one recv and one send in flight at most. Data relayed
+    to a socket is stored while a send is in flight, then all of it is
+    sent by the next send. We stop receiving from a socket when the data
+    waiting for sending to its peer goes above the high watermark, and
+    resume when it goes below the low watermark.
+    '''
+
+    def __init__(self, server, ring, local_sock, src, config, is_local):
+        self._server = server
+        self._ring = ring
+        self._src = src
+        self._config = config
+        self._is_local = is_local
+        self._destroyed = False
+        self._server._stats.incr('connections')
+        self._buffer_high = (self._config.get('tcp_buffer_high') or
+                             BUFFER_HIGH_WATERMARK)
+        self._buffer_low = (self._config.get('tcp_buffer_low') or
+                            BUFFER_LOW_WATERMARK)
+        self._connect_timer = None
+        # source address of the remote socket, from the server's egress pool
+        self._egress_addr = None
+        self._idle_timer = None
+        self._idle_timeout = self._config.get('tcp_idle_timeout')
+        if self._idle_timeout:
+            self._idle_timer = self._server._timers.call_later(
+                                    self._idle_timeout, self._on_idle_timeout)
+        if self._is_local:
+            up_size, down_size = UP_STREAM_BUF_SIZE, DOWN_STREAM_BUF_SIZE
+        else:
+            up_size, down_size = DOWN_STREAM_BUF_SIZE, UP_STREAM_BUF_SIZE
+        local_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        self._local = _RingSocket(local_sock, up_size)
+        self._remote = None
+        self._remote_buf_size = down_size
+        if self._is_local:
+            self._iv_len = self._config.get('iv_len') or 32
+            self._iv = os.urandom(self._iv_len)
+            self._remote_af = (self._config.get('server_addr'),
+                               self._config.get('server_tcp_port'))
+            self._cryptor = Cryptor(self._config.get('cipher_name'),
+                                    self._config.get('passwd'),
+                                    self._config.get('crypto_libpath'),
+                                    self._iv)
+            self._handle_fpacket(b'')
+        else:
+            self._remote_af = None
+            self._cryptor = None
+        self._recv(self._local)
+
+    def _peer(self, rs):
+        return self._remote if rs is self._local else self._local
+
+    def _handle_fpacket(self, data):
+        if self._is_local:
+            self._dest_af = get_orig_dest_af(self._local.sock)
+            data = PacketMaker.make_tcp_fpacket(data, self._dest_af,
+                                                self._iv, self._cryptor,
+                                                self._server._iv_cryptor)
+            logging.info('[URING] Connecting to %s:%d' % self._dest_af)
+        else:
+            res = PacketParser.parse_tcp_fpacket(data,
+                                                 self._server._iv_cryptor,
+                                                 self._config)
+            if not res['valid'] or not res['dest_af']:
+                logging.info('[URING] Got invalid data from %s:%d' %\
+                                                            self._src)
+                self.destroy()
+                return
+            data = res['data']
+            self._remote_af = res['dest_af']
+            self._cryptor = res['cryptor']
+            logging.info('[URING] Connecting to %s:%d' % self._remote_af)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        profile = self._server._connected_profile
+        if profile:
+            profile.apply(sock)
+        if self._server._egress and not self._is_local:
+            try:
+                self._egress_addr = self._server._egress.bind(sock)
+            except (OSError, IOError) as e:
+                logging.warn('[URING] Cannot bind the remote socket: %s' % e)
+                sock.close()
+                self.destroy()
+                return
+        self._remote = _RingSocket(sock, self._remote_buf_size)
+        self._remote.connected = False
+        if data:
+            self._remote.data_2_sock.append(data)
+            self._remote.pending_bytes += len(data)
+            self._server._buffered_bytes += len(data)
+        try:
+            sockaddr = pack_sockaddr_in(
+                        (socket.gethostbyname(self._remote_af[0]),
+                         self._remote_af[1]))
+        except (OSError, IOError):
+            logging.warn('[URING] Invalid remote address: %s:%d' %\
+                                                         self._remote_af)
+            self.destroy()
+            return
+        self._ring.prep_connect(self._remote.fd, sockaddr, self._on_connected)
+        connect_timeout = self._config.get('tcp_connect_timeout') or 10
+        self._connect_timer = self._server._timers.call_later(
+                                        connect_timeout, self._on_timeout)
+
+    def _on_timeout(self):
+        logging.warn('[URING] Connecting timeout, do destroy()')
+        self.destroy()
+
+    def _on_idle_timeout(self):
+        logging.info('[URING] Connection idle timeout, do destroy()')
+        self.destroy()
+
+    def _on_connected(self, res, sockaddr):
+        if self._destroyed:
+            return
+        if res < 0:
+            logging.warn('[URING] Cannot connect to %s:%d, do destroy()' %\
+                                                         self._remote_af)
+            if res == -errno.EADDRNOTAVAIL and self._egress_addr:
+                # out of ports, the next connections take other addresses
+                self._server._egress.connect_failed(
+                        self._egress_addr, os.strerror(errno.EADDRNOTAVAIL))
+            self.destroy()
+            return
+        self._connect_timer.cancel()
+        self._remote.connected = True
+        self._flush(self._remote)
+        self._recv(self._remote)
+
+    def _recv(self, rs):
+        if rs.recving or self._destroyed:
+            return
+        rs.recving = True
+        self._ring.prep_recv(rs.fd, rs.buf_addr, rs.buf_size,
+                             self._on_recv, rs)
+
+    def _on_recv(self, res, rs):
+        rs.recving = False
+        if self._destroyed:
+            return
+        if res in (-errno.EAGAIN, -errno.EINTR):
+            self._recv(rs)
+            return
+        if res <= 0:
+            side = 'Local' if rs is self._local else 'Remote'
+            logging.info('[URING] %s socket closed, do destroy()' % side)
+            self.destroy()
+            return
+
+        # the buffer is not reused before the next recv is submitted
+        data = memoryview(rs.buf)[:res]
+        self._server._stats.incr('bytes_received', res)
+        if self._idle_timer:
+            self._idle_timer.rearm(self._idle_timeout)
+        if rs is self._local:
+            if self._is_local:
+                data = self._cryptor.encrypt(data)
+            elif not self._cryptor:
+                self._handle_fpacket(data)
+                self._recv(rs)
+                return
+            else:
+                data = self._cryptor.decrypt(data)
+        else:
+            if self._is_local:
+                data = self._cryptor.decrypt(data)
+            else:
+                data = self._cryptor.encrypt(data)
+
+        peer = self._peer(rs)
+        peer.data_2_sock.append(data)
+        peer.pending_bytes += len(data)
+        self._server._buffered_bytes += len(data)
+        self._flush(peer)
+        if peer.pending_bytes >= self._buffer_high:
+            rs.recv_paused = True
+            self._server._stats.incr('tcp_read_paused')
+        elif self._server._over_buffer_budget():
+            rs.recv_paused = True
+            self._server._stats.incr('tcp_read_paused')
+            # the server will resume us when the total goes down
+            self._server._wait_for_buffer_budget(self)
+        else:
+            self._recv(rs)
+
+    def resume_reading(self):
+        '''called by the server when the buffer budget is available again
+        '''
+
+        if self._destroyed:
+            return
+        for rs in (self._local, self._remote):
+            if (rs and rs.recv_paused and
+                    self._peer(rs).pending_bytes <= self._buffer_low):
+                rs.recv_paused = False
+                self._recv(rs)
+
+    def _flush(self, rs):
+        if rs.sending or not rs.connected or not rs.data_2_sock:
+            return
+        data = b''.join(rs.data_2_sock)
+        rs.data_2_sock = []
+        rs.sending = True
+        self._ring.prep_send(rs.fd, data, self._on_sent, rs)
+
+    def _on_sent(self, res, data, rs):
+        rs.sending = False
+        if self._destroyed:
+            return
+        if res in (-errno.EAGAIN, -errno.EINTR):
+            res = 0
+        elif res < 0:
+            logging.warn('[URING] Got error while sending, do destroy()')
+            self.destroy()
+            return
+        rs.pending_bytes -= res
+        self._server._release_buffer(res)
+        self._server._stats.incr('bytes_sent', res)
+        if res < len(data):
+            rs.data_2_sock.insert(0, data[res:])
+        self._flush(rs)
+        peer = self._peer(rs)
+        if peer.recv_paused and rs.pending_bytes <= self._buffer_low:
+            peer.recv_paused = False
+            self._recv(peer)
+
+    def destroy(self):
+        if self._destroyed:
+            return
+        self._destroyed = True
+        self._server._stats.incr('connections', -1)
+        for timer in (self._connect_timer, self._idle_timer):
+            if timer:
+                timer.cancel()
+        if self._egress_addr:
+            self._server._egress.release(self._egress_addr)
+            self._egress_addr = None
+        for rs, profile in ((self._local, self._server._accepted_profile),
+                            (self._remote, self._server._connected_profile)):
+            if not rs:
+                continue
+            if profile:
+                profile.record(rs.sock)
+            self._server._release_buffer(rs.pending_bytes)
+            rs.pending_bytes = 0
+            # operations in flight will be completed by shutdown()
+            try:
+                rs.sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, IOError):
+                pass
+            self._ring.close_after_submit(rs.sock)
+        logging.debug('[URING] Handler destroyed')
+
+    @property
+    def destroyed(self):
+        return self._destroyed
+
+
+class URingTCPServer(TCPServer):
+
+    # None if the server falls back to epoll
+    _ring = None
+
+    def _arm_accept(self):
+        self._ring.prep_accept(self._local_sock_fd, self._on_accepted)
+
+    def _on_accepted(self, res):
+        if self._accepting:
+            self._arm_accept()
+        if res < 0:
+            if -res not in (errno.EAGAIN, errno.EINTR):
+                logging.warn('[URING] Failed to accept connection: %s' %\
+                                                        os.strerror(-res))
+            return
+        conn = socket.socket(fileno=res)
+        try:
+            src = conn.getpeername()
+        except (OSError, IOError):
+            conn.close()
+            return
+        self._stats.incr('accepted')
+        reason = self._admit()
+        if reason:
+            logging.info('[URING] Refused connection from %s:%d, '
+                         'reason: %s' % (*src, reason))
+            self._shed(reason)
+            tools.reset_connection(conn)
+            return
+        logging.info('[URING] Accepted connection from %s:%d, fd: %d' %\
+                                                        (*src, res))
+        URingTCPHandler(self, self._ring, conn, src,
+                        self._config, self._is_local)
+
+    def _stop_accepting(self):
+        if not self._ring:
+            return TCPServer._stop_accepting(self)
+        # The accepts in flight cannot be taken back, the connections they
+        # got will be handled here as usual. Keep the socket open for them.
+        self._accepting = False
+
+    def _collect_stats(self):
+        TCPServer._collect_stats(self)
+        if not self._ring:
+            return
+        self._stats.set('uring_enter_calls', self._ring.enter_calls)
+        self._stats.set('uring_submitted', self._ring.submitted)
+        self._stats.set('uring_completed', self._ring.completed)
+
+    def run(self):
+        for key in ('tcp_mux', 'tcp_stripe'):
+            if self._config.get(key):
+                # the peer would get frames it doesn't expect, and the
+                # local side can't fall back, it's set up by LocalTCPServer
+                raise Exception('%s is not supported by the io_uring '
+                                'backend' % key)
+        if not IOUring.supported():
+            logging.warn('[URING] io_uring is not supported, use epoll')
+            return TCPServer.run(self)
+        if self._config.get('tcp_compress'):
+            logging.warn('[URING] tcp_compress is not supported, use epoll')
+            return TCPServer.run(self)
+
+        preload_crypto_lib(self._config.get('cipher_name'),
+                           self._config.get('crypto_libpath'))
+        self._before_run()
+        self._ring = IOUring(self._config.get('uring_entries') or 4096)
+        # io_uring waits for the socket, it doesn't need to be non-blocking
+        self._local_sock.setblocking(True)
+        self._accepting = True
+        for _ in range(min(self._accept_budget, 16)):
+            self._arm_accept()
+        self._start_stats_logging()
+        self._listen_handover()
+        GCManager(self._config, self._stats, self._timers).start()
+        logging.info('[URING] Using io_uring backend')
+        self._running = True
+        try:
+            while self._running:
+                timeout = self._timers.next_timeout(POLL_TIMEOUT)
+                self._ring.submit_and_wait(timeout)
+                self._ring.reap()
+                self._timers.advance()
+        except KeyboardInterrupt:
+            self.shutdown()
+        self._after_run()
+
+    def shutdown(self):
+        self._running = False
+        TCPServer.shutdown(self)
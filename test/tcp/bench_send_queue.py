@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+# Compare the old write path of TCPHandler (join the stored data, slice off
+# the sent part) with ir.handler.SendQueue.
+#
+# Both relay the same chunks to a slow reader through a socketpair with a
+# small send buffer, so the writes are often partial. The socket is wrapped
+# to count the bytes handed to send() or sendmsg() that are neither the
+# received chunk nor a view of it, so were copied in user space, the same
+# way for both paths.
+
+import os
+import sys
+import time
+import errno
+import select
+import socket
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from ir.handler import SendQueue
+
+
+chunk_size = 16384
+chunks = 4096
+sndbuf = 65536
+
+
+class CopyCounter(object):
+
+    def __init__(self, sock, payload):
+        self._sock = sock
+        self._payload = payload
+        # the buffers of the last call, a retry of the same one is no copy
+        self._last = []
+        self.copied = 0
+
+    def _count(self, bufs):
+        bases = [buf.obj if isinstance(buf, memoryview) else buf
+                 for buf in bufs]
+        for buf, base in zip(bufs, bases):
+            if base is self._payload:
+                continue
+            if any(base is last for last in self._last):
+                continue
+            self.copied += len(buf)
+        self._last = bases
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def send(self, data, *args):
+        self._count([data])
+        return self._sock.send(data, *args)
+
+    def sendmsg(self, bufs, *args):
+        self._count(bufs)
+        return self._sock.sendmsg(bufs, *args)
+
+
+def reader(sock, total):
+    received = 0
+    while received < total:
+        data = sock.recv(65536)
+        if not data:
+            break
+        received += len(data)
+
+
+def wait_writable(sock):
+    select.select([], [sock], [])
+
+
+def relay_join(sock, payload):
+    stored = []
+    for i in range(chunks):
+        stored.append(payload)
+        while stored:
+            data = b''.join(stored)
+            stored = []
+            try:
+                s = sock.send(data)
+            except (OSError, IOError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                s = 0
+            if s < len(data):
+                stored.append(data[s:])
+                if i < chunks - 1:
+                    break
+                wait_writable(sock)
+
+
+def relay_send_queue(sock, payload):
+    queue = SendQueue()
+    for i in range(chunks):
+        queue.append(payload)
+        while queue:
+            try:
+                s, complete = queue.send(sock)
+            except (OSError, IOError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                complete = False
+            if not complete:
+                if i < chunks - 1:
+                    break
+                wait_writable(sock)
+
+
+def run(name, relay):
+    a, b = socket.socketpair()
+    a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    a.setblocking(False)
+    total = chunk_size * chunks
+    t = threading.Thread(target=reader, args=(b, total))
+    t.start()
+    payload = os.urandom(chunk_size)
+    counter = CopyCounter(a, payload)
+    t0 = time.time()
+    relay(counter, payload)
+    t.join()
+    spent = time.time() - t0
+    a.close()
+    b.close()
+    print('%-10s relayed: %.2f MB, copied per relayed byte: %.3f, '
+          'time spent: %.2f sec.' % (name, total / 1048576,
+                                     counter.copied / total, spent))
+    return counter.copied
+
+
+if __name__ == '__main__':
+    copied_join = run('join', relay_join)
+    copied_send_queue = run('sendmsg', relay_send_queue)
+    assert copied_send_queue < copied_join, \
+        'SendQueue copied %d bytes, join %d' % (copied_send_queue,
+                                                copied_join)
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# coding: utf-8
+
+# A simple tool to compare the engines (config['engine']) of ir.
+#
+# Run "bench_throughput.py server" on a host behind the remote, and run
+# "bench_throughput.py" on a host whose traffic is redirected to the local.
+# Run it once for each engine with the same config.
+
+import os
+import sys
+import time
+import socket
+import threading
+
+
+server_addr = '192.168.122.1'
+server_port = 60060
+connections = 32
+bytes_per_connection = 16 * 1024 * 1024
+buf_size = 65536
+
+
+def serve(conn):
+    while True:
+        data = conn.recv(buf_size)
+        if not data:
+            break
+        conn.sendall(data)
+    conn.close()
+
+
+def run_server():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', server_port))
+    sock.listen(1024)
+    while True:
+        conn, _ = sock.accept()
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+
+def client(results):
+    t0 = time.time()
+    conn = socket.create_connection((server_addr, server_port))
+    t1 = time.time()
+    payload = os.urandom(buf_size)
+
+    def send():
+        sent = 0
+        while sent < bytes_per_connection:
+            conn.sendall(payload)
+            sent += len(payload)
+
+    threading.Thread(target=send, daemon=True).start()
+    received = 0
+    ttfb = None
+    while received < bytes_per_connection:
+        data = conn.recv(buf_size)
+        if not data:
+            break
+        if ttfb is None:
+            ttfb = time.time() - t1
+        received += len(data)
+    conn.close()
+    results.append((t1 - t0, ttfb or 0, received))
+
+
+def run_client():
+    results = []
+    threads = [threading.Thread(target=client, args=(results,))
+               for _ in range(connections)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    spent = time.time() - t0
+    total = sum([r[2] for r in results])
+    connect = sorted([r[0] * 1000 for r in results])
+    ttfb = sorted([r[1] * 1000 for r in results])
+    print('connections: %d, relayed: %.2f MB, time spent: %.2f sec.' % (
+                                    len(results), total / 1048576, spent))
+    print('throughput: %.2f MB/s' % (total / 1048576 / spent))
+    print('connect time (ms) min/avg/max = %.2f/%.2f/%.2f' % (
+                        connect[0], sum(connect) / len(connect), connect[-1]))
+    print('first byte (ms) min/avg/max = %.2f/%.2f/%.2f' % (
+                                ttfb[0], sum(ttfb) / len(ttfb), ttfb[-1]))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'server':
+        run_server()
+    else:
+        run_client()